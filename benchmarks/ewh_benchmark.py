@@ -0,0 +1,234 @@
+##############################################
+##          EWH Flex Benchmark Suite        ##
+##############################################
+# times every stage of the pipeline on synthetic households, for several simulated periods and resample
+# values, and writes the timings to a JSON file. A stored result can be used as baseline, to flag
+# the stages that got slower than a threshold.
+#
+#   python -m benchmarks.ewh_benchmark --days 1 7 --resample no 15m --output benchmarks/results.json
+#   python -m benchmarks.ewh_benchmark --baseline benchmarks/results.json --output benchmarks/new_results.json
+#   python -m benchmarks.ewh_benchmark --compare benchmarks/results.json benchmarks/new_results.json
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from ewh_flex import ewh_opt_functions
+from ewh_flex import (build_varBackpack, create_usage_dataset, real_ewh_load_estimator, verify_1min_resolution, convert_load_usage,
+                      resample_data, update_dataset_backpack, linear_regressors, build_milpBackpack, solve_milp_highspy,
+                      solve_milp_highs_cmd, solution_diagrams, ewh_kpis, return_results, plot_results_plotly)
+
+# pipeline stages, in the order they run
+STAGES = ['create_usage_dataset', 'real_ewh_load_estimator', 'verify_1min_resolution', 'convert_load_usage', 'resample_data',
+          'update_dataset_backpack', 'linear_regressors', 'build_model', 'solve', 'results', 'return_results', 'plot_results']
+
+# EWH parameters of the synthetic households (same as the examples)
+PARAMS_INPUT = {
+    "user": "benchmark_user",
+    "load_diagram_exists": 1,
+    "ewh_specs": {
+        "ewh_capacity": 100,
+        "ewh_power": 1800,
+        "ewh_max_temp": 80,
+        "ewh_std_temp": 60,
+        "user_comf_temp": 40,
+        "tariff": 1,
+        "price_simple": 0.119585,
+        "price_dual_day": 0.149118,
+        "price_dual_night": 0.070511,
+        "tariff_simple": 0.3604,
+        "tariff_dual": 0.4285
+    }
+}
+
+
+##############################################
+##          Synthetic Households            ##
+##############################################
+def synthetic_usage(days, seed=0):
+    # water usage calendar with 4 random usages per day (plus one day, the last day is left out of the dataset)
+    rng = np.random.default_rng(seed)
+    waterUsage = []
+    for day in pd.date_range('2022-12-07', periods=days + 1, freq='D'):
+        for hour in np.sort(rng.choice(np.arange(6, 23), size=4, replace=False)).tolist():
+            usageStart = day + pd.Timedelta(hours=hour, minutes=int(rng.integers(0, 50)))
+            waterUsage.append({'start': usageStart.strftime('%m/%d/%Y %H:%M'), 'duration': int(rng.integers(1, 15))})
+    return waterUsage
+
+
+def synthetic_load(dataset, days, seed=0):
+    # 1-min load diagram (W) of the non-optimized EWH, with 0.5% of the readings missing
+    rng = np.random.default_rng(seed)
+    load = pd.DataFrame({'timestamp': dataset['timestamp'].dt.tz_localize('UTC'), 'load': dataset['load'].to_numpy() / 0.9})
+    load = load.iloc[:days * 1440]
+    load = load.drop(index=rng.choice(len(load), size=len(load) // 200, replace=False))
+    return load.reset_index(drop=True)
+
+
+##############################################
+##              Benchmark Run               ##
+##############################################
+def benchmark_case(days, resample, solverPath=None, timeLimit=None, seed=0):
+    # runs the pipeline stages for one synthetic household, and returns the time of each stage and the model size
+    times = {}
+
+    @contextlib.contextmanager
+    def stage(name):
+        _start = time.perf_counter()
+        # pipeline prints are left out of the benchmark output
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+        times[name] = time.perf_counter() - _start
+
+    ## water usage calendar -> non-optimized load
+    paramsInput = json.loads(json.dumps(PARAMS_INPUT))
+    paramsInput['load_diagram_exists'] = 0
+    waterUsage = synthetic_usage(days, seed)
+    varBackpack = build_varBackpack(paramsInput, waterUsage)
+    with stage('create_usage_dataset'):
+        dataset = create_usage_dataset(waterUsage)
+    with stage('real_ewh_load_estimator'):
+        dataset['load'] = real_ewh_load_estimator(dataset, varBackpack)
+
+    ## load diagram -> optimization
+    load = synthetic_load(dataset, days, seed)
+    paramsInput['load_diagram_exists'] = 1
+    with stage('verify_1min_resolution'):
+        dataset = verify_1min_resolution(load)
+    varBackpack = build_varBackpack(paramsInput, dataset)
+    with stage('convert_load_usage'):
+        dataset['delta_use'] = convert_load_usage(dataset, varBackpack)
+    if resample != 'no':
+        with stage('resample_data'):
+            dataset = resample_data(dataset, resolution=resample)
+    with stage('update_dataset_backpack'):
+        dataset, varBackpack = update_dataset_backpack(dataset, varBackpack, resample)
+    # the regressors are cached between runs, the benchmark times the fit itself
+    ewh_opt_functions._regressor_coefficients.cache_clear()
+    with stage('linear_regressors'):
+        varBackpack = linear_regressors(dataset, varBackpack)
+    with stage('build_model'):
+        milpBackpack = build_milpBackpack(varBackpack)
+
+    # same solver settings as the pipeline (unless a time limit is given)
+    if timeLimit is None:
+        timeLimit = (varBackpack['daySim'] * 30) + 60
+    with stage('solve'):
+        if (solverPath is None) & (ewh_opt_functions.highspy is not None):
+            stat, x, milpStats = solve_milp_highspy(milpBackpack, timeLimit=timeLimit, gapRel=0.015, threads=1, msg=False)
+        else:
+            with tempfile.TemporaryDirectory(prefix='ewh_flex_') as workDir:
+                stat, x, milpStats = solve_milp_highs_cmd(milpBackpack, os.path.join(workDir, 'thermo_milp.mps'), solverPath=solverPath,
+                                                          timeLimit=timeLimit, gapRel=0.015, threads=1, msg=False)
+
+    with stage('results'):
+        solution = {name: np.where(idx >= 0, x[idx], np.nan) for name, idx in milpBackpack['col_index'].items()}
+        opt_output = ewh_kpis(dataset, varBackpack, solution_diagrams(dataset, solution), msg=False)
+    with stage('return_results'):
+        return_results(opt_output)
+    with stage('plot_results'):
+        plot_results_plotly(opt_output, plotOption='none')
+
+    model = {'time_steps': len(varBackpack['T']), 'num_col': int(milpBackpack['num_col']), 'num_row': int(milpBackpack['num_row']),
+             'num_nz': int(len(milpBackpack['a_value'])), 'status': stat, 'mip_gap': milpStats['mip_gap'],
+             'optimized_price': opt_output['optimized_price']}
+
+    return times, model
+
+
+def run_benchmarks(daysList, resampleList, repeat=1, solverPath=None, timeLimit=None):
+    # benchmarks every (days, resample) case, keeping the best time of each stage over the repeats
+    results = {}
+    for days in daysList:
+        for resample in resampleList:
+            case = f'{days}d_{resample}'
+            best = {}
+            for _ in range(repeat):
+                times, model = benchmark_case(days, resample, solverPath=solverPath, timeLimit=timeLimit)
+                best = {name: min(value, best.get(name, value)) for name, value in times.items()}
+            best['total'] = sum(best.values())
+            results[case] = {'days': days, 'resample': resample, 'stages': best, 'model': model}
+            print(f'{case:>10}: ' + ', '.join(f'{name} {best[name]:.3f}s' for name in STAGES + ['total'] if name in best))
+
+    return {'metadata': benchmark_metadata(solverPath, repeat), 'results': results}
+
+
+def benchmark_metadata(solverPath, repeat):
+    # machine and package versions of the run (timings are only comparable on the same machine)
+    highspy = ewh_opt_functions.highspy
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'pandas': pd.__version__,
+            'solver': 'highspy' if (solverPath is None) & (highspy is not None) else (solverPath or 'highs'), 'repeat': repeat}
+
+
+##############################################
+##          Baseline Comparison             ##
+##############################################
+def compare_benchmarks(baseline, benchmark, threshold=0.25, minDelta=0.05):
+    # stages slower than the baseline by more than threshold (relative) and minDelta (seconds, timer noise)
+    regressions = []
+    for case, result in benchmark['results'].items():
+        if case not in baseline['results']:
+            continue
+        baselineStages = baseline['results'][case]['stages']
+        for name, value in result['stages'].items():
+            if name not in baselineStages:
+                continue
+            reference = baselineStages[name]
+            if (value > reference * (1 + threshold)) & (value - reference > minDelta):
+                regressions.append({'case': case, 'stage': name, 'baseline': reference, 'time': value, 'ratio': value / reference})
+
+    for regression in regressions:
+        print(f"REGRESSION {regression['case']} {regression['stage']}: {regression['baseline']:.3f}s -> {regression['time']:.3f}s "
+              f"(x{regression['ratio']:.2f})")
+    if len(regressions) == 0:
+        print(f'No regressions over {100 * threshold:.0f}%.')
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='EWH Flex pipeline benchmarks')
+    parser.add_argument('--days', type=int, nargs='+', default=[1, 7, 30, 90])
+    parser.add_argument('--resample', nargs='+', default=['no', '15m', '1h'], choices=['no', '15m', '1h'])
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--solverPath', default=None, help='HiGHS binary (the python bindings are used by default)')
+    parser.add_argument('--timeLimit', type=float, default=None, help='solver time limit (s), instead of the pipeline one')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='stored results to compare with')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'), default=None, help='only compare two stored results')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative slowdown flagged as regression')
+    args = parser.parse_args(argv)
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            benchmark = json.load(f)
+    else:
+        benchmark = run_benchmarks(args.days, args.resample, repeat=args.repeat, solverPath=args.solverPath, timeLimit=args.timeLimit)
+        with open(args.output, 'w') as f:
+            json.dump(benchmark, f, indent=2)
+        if args.baseline is None:
+            return 0
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = compare_benchmarks(baseline, benchmark, threshold=args.threshold)
+
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
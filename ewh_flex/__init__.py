@@ -1,6 +1,62 @@
-from .auxiliary_functions import *
-from .ewh_opt_functions import *
-from .ewh_opt_pipeline import *
-from .ewh_power_functions import *
-from .read_data_functions import *
-from .results_functions import *
\ No newline at end of file
+##############################################
+##          Lazy Submodule Imports          ##
+##############################################
+# the submodules are only imported on the first use of one of their functions (PEP 562), so a plain
+# `import ewh_flex` does not load pandas, PuLP, matplotlib, plotly or the Data Space client (tsg_client, dotenv)
+import importlib
+import sys
+import types
+
+_submodules = {
+    'auxiliary_functions': ['fillDefaults', 'create_empty_nested_dict', 'round_up_hundred', 'run_length_encode',
+                            'is_valid_time_format'],
+    'ewh_opt_functions': ['build_varBackpack', 'resample_data', 'update_dataset_backpack', 'linear_regressors', 'build_milp_pulp',
+                          'MILP_VARIABLES', 'build_milpBackpack', 'milp_row_names', 'write_milp_mps', 'write_milp_lp', 'export_milp',
+                          'warm_start_schedule', 'build_milp_start', 'solve_milp_highs_cmd', 'solve_milp_highspy', 'cancel_highspy_solves',
+                          'ewh_solver', 'solve_milp', 'solution_diagrams', 'ewh_kpis', 'ewh_rolling_solver', 'ewh_stream_solver', 'build_milp_model', 'solve_milp_prices',
+                          'tariff_scenarios', 'ewh_price_sweep', 'ewh_solver_async', 'solve_milp_async', 'solve_milp_highs_cmd_async',
+                          'solve_milp_highspy_async'],
+    'ewh_opt_pipeline': ['ewh_optimization', 'ewh_optimization_async', 'ewh_price_sweep_optimization', 'ewh_chunked_optimization', 'ewh_fleet_optimization',
+                         'fleet_summary', 'OPTIMIZATION_STAGES', 'start_optimization_job', 'poll_optimization_job',
+                         'cancel_optimization_job'],
+    'job_queue_functions': ['JOB_STATUSES', 'submit_job', 'job_status', 'job_result', 'cancel_job', 'delete_job', 'run_job_workers',
+                            'start_job_workers'],
+    'ewh_power_functions': ['create_usage_dataset', 'real_ewh_load_estimator', 'simulate_ewh_thermostat', 'ewh_power_detection',
+                            'convert_load_usage', 'usage_blanks_mean', 'usage_blanks_stats', 'convert_load_usage_chunks'],
+    'read_data_functions': ['read_data', 'gui_data', 'parse_upload', 'read_load_diagram', 'read_usage_calendar', 'read_price_curve', 'read_columnar',
+                            'verify_1min_resolution', 'read_load_chunks', 'load_statistics', 'verify_1min_resolution_chunks',
+                            'data_space_parser'],
+    'dataspace_connection': ['dataspace_connection', 'dataspace_client', 'dataspace_request', 'dataspace_openapi_specs', 'dataspace_fetch'],
+    'results_functions': ['plot_results', 'plot_results_plotly', 'write_results', 'write_results_columnar', 'return_results'],
+}
+# submodule of each function
+_attributes = {name: module for module, names in _submodules.items() for name in names}
+
+__all__ = sorted(_attributes)
+
+
+def __getattr__(name):
+    if name in _attributes:
+        value = getattr(importlib.import_module('.' + _attributes[name], __name__), name)
+        # cached, so the next lookups don't go through __getattr__
+        globals()[name] = value
+        return value
+    if name in _submodules:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
+
+
+class _LazyPackage(types.ModuleType):
+    # the import system binds each submodule to the package once it is loaded, which would hide a function with the
+    # name of its submodule (dataspace_connection); the function is bound instead
+    def __setattr__(self, name, value):
+        if isinstance(value, types.ModuleType) & (name in _attributes):
+            value = getattr(value, name)
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _LazyPackage
@@ -1,4 +1,11 @@
+import asyncio
 import datetime
+import contextlib
+import functools
+import threading
+import time
+import tracemalloc
+import numpy as np
 
 ##############################################
 ##           Auxiliary Functions            ##
@@ -25,6 +32,76 @@ def round_up_hundred(x):
     x -= x % -100
     return x
 
+def run_length_encode(values):
+    # splits a series into blocks of equal consecutive values
+    # returns the first and last position of each block, and the block value
+    values = np.asarray(values)
+    if len(values) == 0:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, values[:0]
+    _change = np.flatnonzero(values[1:] != values[:-1]) + 1
+    starts = np.concatenate(([0], _change))
+    ends = np.concatenate((_change - 1, [len(values) - 1]))
+    return starts, ends, values[starts]
+
+# traced memory peak (bytes) of each open stage. tracemalloc only keeps one peak for the whole process, so it is
+# added to all the open stages before being reset (nested stages, or stages of concurrent runs)
+_stage_peaks = []
+_stage_peaks_lock = threading.Lock()
+
+
+def _fold_stage_peaks():
+    # adds the traced memory peak since the last reset to the open stages, and resets it
+    _peak = tracemalloc.get_traced_memory()[1]
+    for _stage in _stage_peaks:
+        _stage['peak'] = max(_stage['peak'], _peak)
+    tracemalloc.reset_peak()
+
+
+@contextlib.contextmanager
+def diagnostics_stage(diagnostics, name):
+    # wall time and peak memory of a pipeline stage, added up in diagnostics['stages'][name] (nothing without diagnostics).
+    # peak memory (bytes above the memory in use at the start) only covers python/numpy allocations, and only while tracemalloc is tracing.
+    # it is the peak of the whole process during the stage, so it includes the allocations of the stages running alongside
+    # diagnostics['progress_hook'] (if any) is called with the name of each stage, when it starts
+    if diagnostics is None:
+        yield
+        return
+    if diagnostics.get('progress_hook') is not None:
+        diagnostics['progress_hook'](name)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        with _stage_peaks_lock:
+            _fold_stage_peaks()
+            _memory = tracemalloc.get_traced_memory()[0]
+            _tracked = {'peak': _memory}
+            _stage_peaks.append(_tracked)
+    _start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage = diagnostics['stages'].setdefault(name, {'time': 0, 'peak_memory': None})
+        stage['time'] += time.perf_counter() - _start
+        if tracing:
+            with _stage_peaks_lock:
+                if tracemalloc.is_tracing():
+                    _fold_stage_peaks()
+                _stage_peaks[:] = [_stage for _stage in _stage_peaks if _stage is not _tracked]
+            stage['peak_memory'] = max(stage['peak_memory'] or 0, _tracked['peak'] - _memory)
+
+
+async def executor_call(executor, function, *args, onCancel=None, **kwargs):
+    # runs function in executor. If the caller is cancelled, onCancel (if given) stops the function sooner, and the
+    # cancellation is only raised when the function has returned (no solver or file writes left running behind)
+    future = asyncio.get_running_loop().run_in_executor(executor, functools.partial(function, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        if onCancel is not None:
+            onCancel()
+        await asyncio.wait([future])
+        raise
+
 
 
 
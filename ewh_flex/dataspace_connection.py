@@ -3,52 +3,96 @@
 ##############################################
 
 from dotenv import dotenv_values, find_dotenv
-from tsg_client.controllers import TSGController
-import os
-
-def dataspace_connection(guiBackpack):
-
-    # unpack data from GUI
-    endpoint = guiBackpack['endpoint']
-    user_id = guiBackpack['user_id']
-    datetime_start = guiBackpack['datetime_start']
-    datetime_end = guiBackpack['datetime_end']
-
-    # Find dotenv
-    found_dotenv = find_dotenv('.env')
-    # Load environment variables:
-    config = dotenv_values(found_dotenv)
-
-    if endpoint == 'sentinel':
-        # Sentinel Endpoint
-        EXTERNAL_CONNECTOR = {
-            "CONNECTOR_ID": 'urn:ids:enershare:connectors:connector-sentinel',
-            "ACCESS_URL": 'https://connector-sentinel.enershare.inesctec.pt',
-            "AGENT_ID": 'urn:ids:enershare:participants:INESCTEC-CPES'
-        }
-    else:
-        # SEL Endpoint
-        EXTERNAL_CONNECTOR = {
-            "CONNECTOR_ID": 'urn:ids:enershare:connectors:connector-sentinel',
-            "ACCESS_URL": 'https://connector-sentinel.enershare.inesctec.pt',
-            "AGENT_ID": 'urn:ids:enershare:participants:INESCTEC-CPES'
-        }
-
-    # Connect to our TSG connector:
-    conn = TSGController(
-        api_key=config['API_KEY'],
-        connector_id=config['CONNECTOR_ID'],
-        access_url=config['ACCESS_URL'],
-        agent_id=config['AGENT_ID'],
-        metadata_broker_url=config['METADATA_BROKER_URL']
-    )
+try:
+    from tsg_client.controllers import TSGController
+except ImportError:
+    TSGController = None
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-    # Get external connector info (self-descriptions):
-    self_description = conn.get_connector_selfdescription(
-        access_url=EXTERNAL_CONNECTOR['ACCESS_URL'],
-        connector_id=EXTERNAL_CONNECTOR['CONNECTOR_ID'],
-        agent_id=EXTERNAL_CONNECTOR['AGENT_ID']
-    )
+import pandas as pd
+
+from .read_data_functions import data_space_parser
+
+# external connectors of the GUI endpoints
+EXTERNAL_CONNECTORS = {
+    # Sentinel Endpoint
+    'sentinel': {
+        "CONNECTOR_ID": 'urn:ids:enershare:connectors:connector-sentinel',
+        "ACCESS_URL": 'https://connector-sentinel.enershare.inesctec.pt',
+        "AGENT_ID": 'urn:ids:enershare:participants:INESCTEC-CPES'
+    },
+    # SEL Endpoint
+    'sel': {
+        "CONNECTOR_ID": 'urn:ids:enershare:connectors:connector-sentinel',
+        "ACCESS_URL": 'https://connector-sentinel.enershare.inesctec.pt',
+        "AGENT_ID": 'urn:ids:enershare:participants:INESCTEC-CPES'
+    }
+}
+API_VERSION = "1.0.0"
+# status codes of the connector call that may come from outdated OpenAPI specs
+SPECS_REFRESH_STATUS = [401, 403, 404]
+METERING_ENDPOINT = '/dataspace/inesctec/observed/ceve_living-lab/metering/energy'
+
+
+def dataspace_connection(guiBackpack, client=None):
+    # metering data of the GUI household, through a client kept between calls (the default one, from .env, if not given)
+    if client is None:
+        client = default_dataspace_client()
+
+    return dataspace_request(client, guiBackpack['user_id'], guiBackpack['datetime_start'], guiBackpack['datetime_end'],
+                             endpoint=guiBackpack['endpoint'])
+
+
+##############################################
+##           Reusable Data Space Client     ##
+##############################################
+def dataspace_client(config=None, ttl=3600, controller=None):
+    ## Data Space client backpack, to be reused over many requests (e.g. many shelly_id): the TSG controller (and its
+    ## connections) is built once, from the .env settings by default, and the self-descriptions and OpenAPI specs of the
+    ## external connectors are cached for ttl seconds. config (ACCESS_URL, ...) and the external connectors of the
+    ## requests can point to a local (stub) connector, and a controller can be given instead of the TSG one
+
+    if config is None:
+        config = dotenv_values(find_dotenv('.env'))
+    if controller is None:
+        if TSGController is None:
+            raise RuntimeError('The Data Space client (tsg_client) is not installed, please install the requirements.')
+        # Connect to our TSG connector:
+        controller = TSGController(
+            api_key=config['API_KEY'],
+            connector_id=config['CONNECTOR_ID'],
+            access_url=config['ACCESS_URL'],
+            agent_id=config['AGENT_ID'],
+            metadata_broker_url=config['METADATA_BROKER_URL']
+        )
+
+    client = {}
+    client['controller'] = controller
+    client['config'] = config
+    client['ttl'] = ttl
+    # self-description and OpenAPI specs of each external connector, with the time they were fetched
+    client['cache'] = {}
+    # the specs of a connector are only fetched once, when requests run in parallel
+    client['lock'] = threading.Lock()
+
+    return client
+
+
+@functools.lru_cache(maxsize=1)
+def default_dataspace_client():
+    # client of the .env settings, shared by the GUI requests
+    return dataspace_client()
+
+
+def dataspace_request(client, user_id, datetime_start, datetime_end, endpoint='sentinel', externalConnector=None, msg=True):
+    # metering data of one household (shelly_id) between two dates, and returns the connector response
+    # (msg=False keeps the request prints out of stdout)
+
+    if externalConnector is None:
+        externalConnector = EXTERNAL_CONNECTORS.get(endpoint, EXTERNAL_CONNECTORS['sel'])
 
     # parameters
     params = {
@@ -59,36 +103,137 @@ def dataspace_connection(guiBackpack):
         'end_date': datetime_end.strftime('%Y-%m-%d 23:59'),
     }
 
-    # Get external connector OpenAPI specs:
-    api_version = "1.0.0"
-    open_api_specs = conn.get_openapi_specs(self_description, api_version)
-    endpoint = '/dataspace/inesctec/observed/ceve_living-lab/metering/energy'
+    _start = time.monotonic()
+    open_api_specs = dataspace_openapi_specs(client, externalConnector)
+    response = _openapi_request(client, externalConnector, open_api_specs, params, msg)
+    # cached specs may be outdated (e.g. the data app changed, refusing or not finding the request), so they are fetched
+    # again and the request repeated, unless they were fetched after this request started
+    if (response.status_code in SPECS_REFRESH_STATUS) & (client['cache'][_connector_key(externalConnector)]['time'] < _start):
+        open_api_specs = dataspace_openapi_specs(client, externalConnector, refresh=True)
+        response = _openapi_request(client, externalConnector, open_api_specs, params, msg)
+
+    if msg:
+        print("-" * 79)
+        print(f"> Connector {externalConnector['CONNECTOR_ID']} RESPONSE:")
+        print("Status Code:", response.status_code)
+        # print("Response Text:", response.text)
+        print("-" * 79)
+
+    return response
+
+
+def dataspace_openapi_specs(client, externalConnector, refresh=False):
+    # OpenAPI specs of an external connector (from its self-description), cached for the client ttl
+    key = _connector_key(externalConnector)
+    with client['lock']:
+        cached = client['cache'].get(key)
+        if refresh or (cached is None) or (time.monotonic() - cached['time'] > client['ttl']):
+            # Get external connector info (self-descriptions):
+            self_description = client['controller'].get_connector_selfdescription(
+                access_url=externalConnector['ACCESS_URL'],
+                connector_id=externalConnector['CONNECTOR_ID'],
+                agent_id=externalConnector['AGENT_ID']
+            )
+            # Get external connector OpenAPI specs:
+            open_api_specs = client['controller'].get_openapi_specs(self_description, API_VERSION)
+            cached = {'time': time.monotonic(), 'self_description': self_description, 'open_api_specs': open_api_specs}
+            client['cache'][key] = cached
+
+    return cached['open_api_specs']
+
+
+def _connector_key(externalConnector):
+    return (externalConnector['ACCESS_URL'], externalConnector['CONNECTOR_ID'], externalConnector['AGENT_ID'])
+
+
+def _openapi_request(client, externalConnector, open_api_specs, params, msg=True):
     data_app_agent_id = open_api_specs[0]["agent"]
 
-    print(f"""
+    if msg:
+        print(f"""
     Performing a request to:
     - Agent ID: {data_app_agent_id}
-    - API Version: {api_version}
-    - Endpoint: {endpoint}
+    - API Version: {API_VERSION}
+    - Endpoint: {METERING_ENDPOINT}
     """)
 
-    AUTH = {'Authorization': 'Token {}'.format(config['TOKEN'])}
+    AUTH = {'Authorization': 'Token {}'.format(client['config']['TOKEN'])}
 
     # Execute external OpenAPI request:
-    response = conn.openapi_request(
+    return client['controller'].openapi_request(
         headers=AUTH,
-        external_access_url=EXTERNAL_CONNECTOR['ACCESS_URL'],
+        external_access_url=externalConnector['ACCESS_URL'],
         data_app_agent_id=data_app_agent_id,
-        api_version=api_version,
-        endpoint=endpoint,
+        api_version=API_VERSION,
+        endpoint=METERING_ENDPOINT,
         params=params,
         method="get"
     )
 
-    print("-" * 79)
-    print(f"> Connector {EXTERNAL_CONNECTOR['CONNECTOR_ID']} RESPONSE:")
-    print("Status Code:", response.status_code)
-    # print("Response Text:", response.text)
-    print("-" * 79)
 
-    return response
\ No newline at end of file
+##############################################
+##         Chunked Data Space Fetch         ##
+##############################################
+def dataspace_fetch(client, shellyIds, datetime_start, datetime_end, endpoint='sentinel', externalConnector=None, chunkDays=1,
+                    maxWorkers=8, retries=3, backoff=0.5):
+    ## load diagrams of many households (shelly_id) between two dates, requested in chunks of chunkDays days, with at most
+    ## maxWorkers requests at the same time (over all the households). Each chunk is parsed (data_space_parser) as soon as
+    ## it arrives, and a chunk that failed with a server error (5xx status) or a connection error is requested again, up to
+    ## retries times (waiting backoff, 2*backoff, ... seconds); other errors (e.g. 4xx status) are not retried. Returns the load diagram of each household ({shelly_id: dataset}) and the error of
+    ## the households with a chunk that still failed ({shelly_id: error}), which are left out of the load diagrams
+    chunks = _date_chunks(datetime_start, datetime_end, chunkDays)
+
+    parts = {shellyId: [None] * len(chunks) for shellyId in shellyIds}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        futures = {executor.submit(_fetch_chunk, client, shellyId, chunkStart, chunkEnd, endpoint, externalConnector, retries, backoff):
+                   (shellyId, k) for shellyId in shellyIds for k, (chunkStart, chunkEnd) in enumerate(chunks)}
+        for future in as_completed(futures):
+            shellyId, k = futures[future]
+            if future.cancelled():
+                continue
+            try:
+                parts[shellyId][k] = future.result()
+            except Exception as e:
+                errors[shellyId] = f"{chunks[k][0].strftime('%Y-%m-%d')} to {chunks[k][1].strftime('%Y-%m-%d')}: {e}"
+                # the other chunks of the household are no longer needed
+                for other, (otherId, _) in futures.items():
+                    if otherId == shellyId:
+                        other.cancel()
+
+    datasets = {}
+    for shellyId in shellyIds:
+        if shellyId not in errors:
+            # chunks in date order (readings repeated over two chunks are kept from the last one, as in a single request)
+            dataset = pd.concat(parts[shellyId], ignore_index=True)
+            datasets[shellyId] = dataset.drop_duplicates(subset='timestamp', keep='last').reset_index(drop=True)
+
+    return datasets, errors
+
+
+def _date_chunks(datetime_start, datetime_end, chunkDays):
+    # (first day, last day) of each chunk
+    days = pd.date_range(pd.Timestamp(datetime_start).normalize(), pd.Timestamp(datetime_end).normalize(), freq='D')
+    return [(days[k], days[min(k + chunkDays, len(days)) - 1]) for k in range(0, len(days), chunkDays)]
+
+
+def _fetch_chunk(client, shellyId, chunkStart, chunkEnd, endpoint, externalConnector, retries, backoff):
+    # one chunk of a load diagram, parsed, requested again on server and connection errors
+    for attempt in range(retries + 1):
+        try:
+            response = dataspace_request(client, shellyId, chunkStart, chunkEnd, endpoint=endpoint, externalConnector=externalConnector,
+                                         msg=False)
+        except OSError as e:
+            # connection errors (ConnectionError, TimeoutError, requests exceptions, ...)
+            error = e
+        else:
+            if response.status_code < 400:
+                return data_space_parser(response, endpoint)
+            error = RuntimeError(f'status code {response.status_code}')
+            # client errors (4xx) are not solved by requesting again
+            if response.status_code < 500:
+                raise error
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+
+    raise error
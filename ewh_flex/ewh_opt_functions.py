@@ -3,15 +3,23 @@
 ##############################################
 import numpy as np
 import pandas as pd
-from pulp import *
 import re
 import math
-from sklearn.linear_model import LinearRegression
 import datetime
-from itertools import product
+import os
+import gzip
+import shutil
+import subprocess
+import tempfile
+import functools
+import asyncio
+try:
+    import highspy
+except ImportError:
+    highspy = None
 
 from .ewh_power_functions import ewh_power_detection
-from .auxiliary_functions import fillDefaults
+from .auxiliary_functions import fillDefaults, diagnostics_stage, executor_call
 
 
 ##############################################
@@ -312,71 +320,12 @@ def linear_regressors(original_dataset, varBackpack):
     waterHeatCap = varBackpack['waterHeatCap']
     ewh_capacity = varBackpack['ewh_capacity']
     delta_t =  varBackpack['delta_t']
-    delta_intervals = np.linspace(0, 1, int((delta_t*60)+1))
 
-    ### Regressor 1 with temp_ewh ranging from setpoint to max
-    # unique values of temp_inlet
-    temp_inlet = list(set(temp_inlet))
-    # unique values of temp_heat
-    temp_heat = [*range(tempSet, ewh_max_temp+1)]
-    # unique values of delta_intervals without zero
-    delta_intervals = list(delta_intervals)[1:]
-    # make all combinations
-    combinations = list(product(temp_inlet, temp_heat, delta_intervals))
-    # Create a DataFrame for regressor
-    regressor_aboveSet = pd.DataFrame(combinations, columns=['temp_inlet', 'temp_heat', 'delta_use'])
-    ## add remaining variables
-    regressor_aboveSet['temp_set'] = tempSet
-    regressor_aboveSet['flow_rate'] = flow_rate_value
-    ## calculate ewh_flow via fluid mix formula
-    regressor_aboveSet['ewh_flow'] = (regressor_aboveSet['flow_rate'] * (regressor_aboveSet['temp_set']-regressor_aboveSet['temp_inlet']) / (regressor_aboveSet['temp_heat']-regressor_aboveSet['temp_inlet']))
-    ## calculate ewh output energy
-    regressor_aboveSet['w_out'] = (regressor_aboveSet['ewh_flow']*regressor_aboveSet['delta_use'] * waterHeatCap * (regressor_aboveSet['temp_heat']) / 3600) * (60 * delta_t)
-    ## calculate internal water energy
-    regressor_aboveSet['w_water'] = (((regressor_aboveSet['temp_heat']*(ewh_capacity-regressor_aboveSet['ewh_flow']*regressor_aboveSet['delta_use']) + regressor_aboveSet['temp_inlet']*regressor_aboveSet['ewh_flow']*regressor_aboveSet['delta_use']) / ewh_capacity) * ewh_capacity * waterHeatCap/3600) * (60 * delta_t)
-
-    ### Regressor 2 with temp_ewh ranging from minimum of inlet to setpoint
-    # unique values of temp_inlet
-    temp_inlet = list(set(temp_inlet))
-    # unique values of temp_heat
-    temp_heat = [*range(np.floor(min(temp_inlet)).astype(int),tempSet+1)]
-    # unique values of delta_intervals
-    delta_intervals = list(delta_intervals)
-    # make all combinations
-    combinations = list(product(temp_inlet, temp_heat, delta_intervals))
-    # Create a DataFrame for regressor
-    regressor_belowSet = pd.DataFrame(combinations, columns=['temp_inlet', 'temp_heat', 'delta_use'])
-    ## add remaining variables
-    regressor_belowSet['temp_set'] = tempSet
-    regressor_belowSet['flow_rate'] = flow_rate_value / (60 * delta_t)
-    ## since internal temperature is below setpoint, the flow rate is a direct link from the EWH
-    regressor_belowSet['ewh_flow'] = flow_rate_value / (60 * delta_t)
-    ## calculate ewh output energy
-    regressor_belowSet['w_out'] = (regressor_belowSet['ewh_flow']*regressor_belowSet['delta_use'] * waterHeatCap * (regressor_belowSet['temp_heat']) / 3600) * (60 * delta_t)
-    ## calculate internal water energy
-    regressor_belowSet['w_water'] = (((regressor_belowSet['temp_heat']*(ewh_capacity-regressor_belowSet['ewh_flow']*regressor_belowSet['delta_use']) + regressor_belowSet['temp_inlet']*regressor_belowSet['ewh_flow']*regressor_belowSet['delta_use']) / ewh_capacity) * ewh_capacity * waterHeatCap/3600) * (60 * delta_t)
-    ## remove lines where temp_heat < temp_inlet (impossible)
-    regressor_belowSet = regressor_belowSet[regressor_belowSet['temp_heat'] >= regressor_belowSet['temp_inlet']]
-
-    ## Eq.(8)
-    ## above setpoint (regressor_aboveSet)
-    ## create the regression
-    reg = LinearRegression().fit(regressor_aboveSet[['temp_heat','delta_use']],regressor_aboveSet['w_water'].values.reshape(-1, 1))
-    ## regression R score
-    regressor_aboveSet_score = reg.score(regressor_aboveSet[['temp_heat','delta_use']],regressor_aboveSet['w_water'].values)
-    ## Extract coeffiecients
-    regressor_aboveSet_m_temp = list(reg.coef_[0])[0]
-    regressor_aboveSet_m_delta = list(reg.coef_[0])[1]
-    regressor_aboveSet_b = reg.intercept_[0]
-    ## below setpoint (regressor_belowSet)
-    ## create the regression
-    reg = LinearRegression().fit(regressor_belowSet[['temp_heat','delta_use']],regressor_belowSet['w_water'].values.reshape(-1, 1))
-    ## regression R score
-    regressor_belowSet_score = reg.score(regressor_belowSet[['temp_heat','delta_use']],regressor_belowSet['w_water'].values)
-    ## Extract coeffiecients
-    regressor_belowSet_m_temp = list(reg.coef_[0])[0]
-    regressor_belowSet_m_delta = list(reg.coef_[0])[1]
-    regressor_belowSet_b = reg.intercept_[0]
+    # the regressors only depend on the EWH specs, time resolution and unique values of temp_inlet,
+    # so they are reused by households with the same specs
+    (regressor_aboveSet_m_temp, regressor_aboveSet_m_delta, regressor_aboveSet_b,
+     regressor_belowSet_m_temp, regressor_belowSet_m_delta, regressor_belowSet_b) = \
+        _regressor_coefficients(tempSet, ewh_max_temp, ewh_capacity, waterHeatCap, delta_t, flow_rate_value, tuple(sorted(set(temp_inlet))))
 
     varBackpack['regressor_aboveSet_m_temp'] = regressor_aboveSet_m_temp
     varBackpack['regressor_aboveSet_m_delta'] = regressor_aboveSet_m_delta
@@ -387,18 +336,56 @@ def linear_regressors(original_dataset, varBackpack):
 
     return varBackpack
 
+
+@functools.lru_cache(maxsize=256)
+def _regressor_coefficients(tempSet, ewh_max_temp, ewh_capacity, waterHeatCap, delta_t, flow_rate_value, temp_inlet):
+    # Eq.(8) regressors: w_water = m_temp * temp_heat + m_delta * delta_use + b, fitted on the grid of all
+    # (temp_inlet, temp_heat, delta_use) combinations, above and below the setpoint
+    # delta_use intervals without zero
+    delta_intervals = np.linspace(0, 1, int((delta_t*60)+1))[1:]
+    temp_inlet = np.array(temp_inlet, dtype=float)
+
+    ### Regressor 1 with temp_ewh ranging from setpoint to max
+    inlet, heat, delta = np.meshgrid(temp_inlet, np.arange(tempSet, ewh_max_temp+1), delta_intervals, indexing='ij')
+    ## calculate ewh_flow via fluid mix formula
+    ewh_flow = flow_rate_value * (tempSet - inlet) / (heat - inlet)
+    ## calculate internal water energy
+    w_water = (((heat*(ewh_capacity-ewh_flow*delta) + inlet*ewh_flow*delta) / ewh_capacity) * ewh_capacity * waterHeatCap/3600) * (60 * delta_t)
+    aboveSet = _least_squares(heat.ravel(), delta.ravel(), w_water.ravel())
+
+    ### Regressor 2 with temp_ewh ranging from minimum of inlet to setpoint
+    inlet, heat, delta = np.meshgrid(temp_inlet, np.arange(np.floor(temp_inlet.min()).astype(int), tempSet+1), delta_intervals, indexing='ij')
+    ## since internal temperature is below setpoint, the flow rate is a direct link from the EWH
+    ewh_flow = flow_rate_value / (60 * delta_t)
+    ## calculate internal water energy
+    w_water = (((heat*(ewh_capacity-ewh_flow*delta) + inlet*ewh_flow*delta) / ewh_capacity) * ewh_capacity * waterHeatCap/3600) * (60 * delta_t)
+    ## remove combinations where temp_heat < temp_inlet (impossible)
+    possible = heat >= inlet
+    belowSet = _least_squares(heat[possible], delta[possible], w_water[possible])
+
+    return aboveSet + belowSet
+
+
+def _least_squares(temp_heat, delta_use, w_water):
+    # ordinary least squares with intercept (on centered data), returns (m_temp, m_delta, b)
+    X = np.column_stack([temp_heat, delta_use]).astype(float)
+    X_mean = X.mean(axis=0)
+    w_mean = w_water.mean()
+    coef = np.linalg.lstsq(X - X_mean, w_water - w_mean, rcond=None)[0]
+    return float(coef[0]), float(coef[1]), float(w_mean - X_mean @ coef)
+
 ##############################################
-##       Solving Optimization Problem       ##
+##       MILP Formulation (PuLP model)      ##
 ##############################################
-def ewh_solver(dataset, varBackpack, optSolver = 'HiGHS', solverPath=None):
+def build_milp_pulp(varBackpack):
+    # PuLP is only imported for this backend
+    from pulp import LpVariable, LpBinary, LpProblem, LpMinimize, lpSum
 
     # unpack some variables
     T = varBackpack['T']
     wh_init = varBackpack['wh_init']
     ewh_power = varBackpack['ewh_power']
     delta_t = varBackpack['delta_t']
-    daySim = varBackpack['daySim']
-    user = varBackpack['user']
     networkPrice = varBackpack['networkPrice']
     networkTariff = varBackpack['networkTariff']
     ewh_start_temp = varBackpack['ewh_start_temp']
@@ -501,115 +488,958 @@ def ewh_solver(dataset, varBackpack, optSolver = 'HiGHS', solverPath=None):
         else:
             milp += w_water[t] == (temp[t] * ewh_capacity * waterHeatCap / 3600) * delta_t * 60, f'Constraint_8.7_{t:03d}'
 
+    # variables of each family, per time step (same names as in the matrix model)
+    milpVariables = {'temp': temp, 'w_tot': w_tot, 'w_in': w_in, 'w_loss': w_loss, 'delta_in': delta_in,
+                     'w_water': w_water, 'costComfort': costComfort, 'binAux': binAux, 'price': energyCost}
 
+    return milp, milpVariables
 
 
+##############################################
+##      MILP Formulation (Matrix model)     ##
+##############################################
+# decision variables, in the same naming as the PuLP model
+MILP_VARIABLES = ['temp', 'w_tot', 'w_in', 'w_loss', 'delta_in', 'w_water', 'costComfort', 'binAux', 'price']
+
+def build_milpBackpack(varBackpack):
+    ## builds the same MILP as build_milp_pulp (Eqs. (1)-(8)) directly as arrays:
+    ## objective, variable bounds and a column-wise sparse constraint matrix.
+    ## columns and rows follow the PuLP ordering (variables sorted by name, constraints
+    ## in insertion order), so both backends hand over the exact same model to the solver
+
+    # unpack some variables
+    T = varBackpack['T']
+    wh_init = varBackpack['wh_init']
+    ewh_power = varBackpack['ewh_power']
+    delta_t = varBackpack['delta_t']
+    networkPrice = np.asarray(varBackpack['networkPrice'], dtype=float)
+    networkTariff = varBackpack['networkTariff']
+    ewh_start_temp = varBackpack['ewh_start_temp']
+    ewh_capacity = varBackpack['ewh_capacity']
+    waterHeatCap = varBackpack['waterHeatCap']
+    heatTransferCoeff = varBackpack['heatTransferCoeff']
+    ewh_area = varBackpack['ewh_area']
+    ambTemp = varBackpack['ambTemp']
+    wh_min = varBackpack['wh_min']
+    wh_max = varBackpack['wh_max']
+    ewh_min_temp = varBackpack['ewh_min_temp']
+    ewh_max_temp = varBackpack['ewh_max_temp']
+    delta_use = np.asarray(varBackpack['delta_use'], dtype=float)
+    tempSet = varBackpack['tempSet']
+    bigNumber = varBackpack['bigNumber']
+    regressor_aboveSet_m_temp = varBackpack['regressor_aboveSet_m_temp']
+    regressor_aboveSet_m_delta = varBackpack['regressor_aboveSet_m_delta']
+    regressor_aboveSet_b = varBackpack['regressor_aboveSet_b']
+    regressor_belowSet_m_temp = varBackpack['regressor_belowSet_m_temp']
+    regressor_belowSet_m_delta = varBackpack['regressor_belowSet_m_delta']
+    regressor_belowSet_b = varBackpack['regressor_belowSet_b']
+
+    n = len(T)
+    t = np.arange(n)
+    # Eq. (7) periods: hot water usage or the period right after it (t-1 wraps around at t=0)
+    delta_use_prev = np.roll(delta_use, 1)
+    usage_end = (delta_use - delta_use_prev != 0) & (delta_use - delta_use_prev == -delta_use_prev)
+    eq7 = (delta_use > 0) | usage_end
+    # Eq. (8) periods: hot water usage
+    eq8 = delta_use > 0
+
     ##############################################
-    ##           SAVING AND SOLVING             ##
+    ##           DECISION VARIABLES             ##
+    ##############################################
+
+    # variables by name; binAux only exists in the periods where it is used
+    used = {name: t for name in MILP_VARIABLES}
+    used['binAux'] = t[eq8]
+    names = np.array([f'{name}_{step:03d}' for name in MILP_VARIABLES for step in used[name].tolist()])
+    families = np.repeat(np.arange(len(MILP_VARIABLES)), [len(used[name]) for name in MILP_VARIABLES])
+    steps = np.concatenate([used[name] for name in MILP_VARIABLES])
+    # sort variables by name and map each variable family to its column positions (-1 if not used)
+    order = np.argsort(names, kind='stable')
+    col_names = names[order]
+    col_index = {}
+    for k, name in enumerate(MILP_VARIABLES):
+        col_index[name] = np.full(n, -1, dtype=np.int64)
+        col_index[name][steps[order[families[order] == k]]] = np.flatnonzero(families[order] == k)
+    num_col = len(col_names)
+
+    # bounds
+    col_lower = np.zeros(num_col)
+    col_upper = np.full(num_col, np.inf)
+    integrality = np.zeros(num_col, dtype=np.int8)
+    # thermal energy losses are free
+    col_lower[col_index['w_loss']] = -np.inf
+    # EWH operation status
+    col_upper[col_index['delta_in']] = 1
+    # binary variable for if-else expression
+    col_upper[col_index['binAux'][eq8]] = 1
+    integrality[col_index['binAux'][eq8]] = 1
+
+    # objective function
+    col_cost = np.zeros(num_col)
+    col_cost[col_index['price']] = 100
+    col_cost[col_index['costComfort']] = 1000
+
+    ##############################################
+    ##              CONSTRAINTS                 ##
+    ##############################################
+
+    # rows per period, in the PuLP insertion order: Eqs. (1)-(6.4), (7.1)-(7.2), (8.1)-(8.6) or (8.7)
+    rows_per_t = 9 + 2 * eq7 + np.where(eq8, 6, 1)
+    row_base = np.cumsum(rows_per_t) - rows_per_t
+    num_row = int(rows_per_t.sum())
+    row_label = np.empty(num_row, dtype=object)
+    row_step = np.empty(num_row, dtype=np.int64)
+    row_sense = np.empty(num_row, dtype='<U1')
+    row_rhs = np.zeros(num_row)
+    entries = []
+
+    def add_rows(label, steps, pos, sense, rhs, terms):
+        # adds one constraint per step: sum(coef * var) (sense) rhs
+        rows = row_base[steps] + pos
+        row_label[rows] = label
+        row_step[rows] = steps
+        row_sense[rows] = sense
+        row_rhs[rows] = rhs
+        for name, var_steps, coef in terms:
+            entries.append((rows, col_index[name][var_steps], np.broadcast_to(np.asarray(coef, dtype=float), rows.shape)))
+
+    t0, t1 = t[:1], t[1:]
+    w_loss_coeff = (delta_t*60) * (delta_t * (heatTransferCoeff * ewh_area))
+    comfort = ((tempSet * 1.005 * ewh_capacity * waterHeatCap / 3600) * delta_t * 60)
+    t7 = t[eq7]
+    t8 = t[eq8]
+    t87 = t[~eq8]
+    pos8 = 9 + 2 * eq7[eq8]
+    above = (regressor_aboveSet_m_delta * delta_use[eq8]) + regressor_aboveSet_b
+    below = (regressor_belowSet_m_delta * delta_use[eq8]) + regressor_belowSet_b
+
+    # Eq. (1)
+    add_rows('1', t0, 0, 'E', wh_init, [('w_tot', t0, 1)])
+    add_rows('1', t1, 0, 'E', 0, [('w_tot', t1, 1), ('w_water', t1-1, -1), ('w_in', t1-1, -1), ('w_loss', t1-1, 1)])
+    # Eq. (2)
+    add_rows('2', t, 1, 'E', 0, [('w_in', t, 1), ('delta_in', t, -((delta_t*60) * (ewh_power * delta_t)))])
+    # Eq. (3) Pricing
+    add_rows('3', t, 2, 'E', networkTariff * (delta_t/24), [('price', t, 1), ('delta_in', t, -(networkPrice * (ewh_power * delta_t)))])
+    # Eq. (4)
+    add_rows('4', t0, 3, 'E', ewh_start_temp, [('temp', t0, 1)])
+    add_rows('4', t1, 3, 'E', 0, [('temp', t1, 1), ('w_tot', t1, -((3600 / (delta_t*60)) / (ewh_capacity * waterHeatCap)))])
+    # Eq. (5)
+    add_rows('5', t, 4, 'E', (((-ambTemp) * (heatTransferCoeff * ewh_area)) * delta_t) * (delta_t*60), [('w_loss', t, 1), ('temp', t, -w_loss_coeff)])
+    # Eq. (6)
+    add_rows('6.1', t, 5, 'G', wh_min, [('w_tot', t, 1)])
+    add_rows('6.2', t, 6, 'L', wh_max, [('w_tot', t, 1)])
+    add_rows('6.3', t, 7, 'G', ewh_min_temp, [('temp', t, 1)])
+    add_rows('6.4', t, 8, 'L', ewh_max_temp, [('temp', t, 1)])
+    ## Eq.(7) assure that in the (t) period after the end of hot water usage (t-1), the EWH has, at least, 80L @ 45ºC [t]
+    add_rows('7.1', t7, 9, 'G', comfort, [('w_tot', t7, 1), ('costComfort', t7, 1)])
+    add_rows('7.2', t7, 10, 'G', comfort, [('w_tot', (t7-1) % n, 1), ('costComfort', (t7-1) % n, 1)])
+    ## Eq.(8) Internal water energy after usage
+    # binary definition with temp[t]
+    add_rows('8.1', t8, pos8, 'G', tempSet - bigNumber, [('temp', t8, 1), ('binAux', t8, -bigNumber)])
+    add_rows('8.2', t8, pos8 + 1, 'L', tempSet, [('temp', t8, 1), ('binAux', t8, -bigNumber)])
+    # if temp[t] > tempSet
+    add_rows('8.3', t8, pos8 + 2, 'G', above - bigNumber, [('w_water', t8, 1), ('temp', t8, -regressor_aboveSet_m_temp), ('binAux', t8, -bigNumber)])
+    add_rows('8.4', t8, pos8 + 3, 'L', above + bigNumber, [('w_water', t8, 1), ('temp', t8, -regressor_aboveSet_m_temp), ('binAux', t8, bigNumber)])
+    # else
+    add_rows('8.5', t8, pos8 + 4, 'G', below, [('w_water', t8, 1), ('temp', t8, -regressor_belowSet_m_temp), ('binAux', t8, bigNumber)])
+    add_rows('8.6', t8, pos8 + 5, 'L', below, [('w_water', t8, 1), ('temp', t8, -regressor_belowSet_m_temp), ('binAux', t8, -bigNumber)])
+    # no usage
+    add_rows('8.7', t87, 9 + 2 * eq7[~eq8], 'E', 0, [('w_water', t87, 1), ('temp', t87, -((60 * (delta_t * ((waterHeatCap * ewh_capacity) / 3600)))))])
+
+    # column-wise sparse matrix (entries of each column sorted by row)
+    a_row = np.concatenate([e[0] for e in entries])
+    a_col = np.concatenate([e[1] for e in entries])
+    a_value = np.concatenate([e[2] for e in entries])
+    # zero coefficients are dropped (as in PuLP)
+    nonzero = a_value != 0
+    a_row, a_col, a_value = a_row[nonzero], a_col[nonzero], a_value[nonzero]
+    order = np.lexsort((a_row, a_col))
+    a_index = a_row[order]
+    a_value = a_value[order]
+    a_start = np.concatenate(([0], np.cumsum(np.bincount(a_col, minlength=num_col))))
+
+    # row bounds
+    row_lower = np.where(row_sense == 'L', -np.inf, row_rhs)
+    row_upper = np.where(row_sense == 'G', np.inf, row_rhs)
+
+    milpBackpack = {}
+    # model dimensions
+    milpBackpack['num_col'] = num_col
+    milpBackpack['num_row'] = num_row
+    # column positions of each variable family, per time step (-1 if not used)
+    milpBackpack['col_index'] = col_index
+    milpBackpack['col_names'] = col_names
+    # objective and bounds
+    milpBackpack['col_cost'] = col_cost
+    milpBackpack['col_lower'] = col_lower
+    milpBackpack['col_upper'] = col_upper
+    milpBackpack['integrality'] = integrality
+    # constraints
+    milpBackpack['row_label'] = row_label
+    milpBackpack['row_step'] = row_step
+    milpBackpack['row_sense'] = row_sense
+    milpBackpack['row_rhs'] = row_rhs
+    milpBackpack['row_lower'] = row_lower
+    milpBackpack['row_upper'] = row_upper
+    milpBackpack['a_start'] = a_start
+    milpBackpack['a_index'] = a_index
+    milpBackpack['a_value'] = a_value
+
+    return milpBackpack
+
+
+def milp_row_names(milpBackpack):
+    # constraint names, as in the PuLP model
+    return ['Constraint_' + label + '_' + format(step, '03d') for label, step in zip(milpBackpack['row_label'], milpBackpack['row_step'])]
+
+
+def write_milp_mps(milpBackpack, filePath):
+    # writes the matrix model as a (free) MPS file, in the same layout PuLP uses
+
+    col_names = milpBackpack['col_names'].tolist()
+    row_names = milp_row_names(milpBackpack)
+    col_cost = milpBackpack['col_cost']
+    col_lower = milpBackpack['col_lower']
+    col_upper = milpBackpack['col_upper']
+    integrality = milpBackpack['integrality']
+    a_start = milpBackpack['a_start']
+    a_index = milpBackpack['a_index'].tolist()
+    a_value = milpBackpack['a_value'].tolist()
+    objName = 'Objective_Function'
+
+    lines = ['OBJSENSE\n', ' MIN\n', 'NAME          Thermo_MILP\n', 'ROWS\n', f' N  {objName}\n']
+    lines += [' ' + sense + '  ' + name + '\n' for sense, name in zip(milpBackpack['row_sense'].tolist(), row_names)]
+
+    # matrix
+    lines.append('COLUMNS\n')
+    for j, name in enumerate(col_names):
+        if integrality[j]:
+            lines.append("    MARK      'MARKER'                 'INTORG'\n")
+        lines += ['    %-8s  %-8s  % .12e\n' % (name, row_names[a_index[k]], a_value[k]) for k in range(a_start[j], a_start[j+1])]
+        if col_cost[j] != 0:
+            lines.append('    %-8s  %-8s  % .12e\n' % (name, objName, col_cost[j]))
+        if integrality[j]:
+            lines.append("    MARK      'MARKER'                 'INTEND'\n")
+
+    # right hand side
+    lines.append('RHS\n')
+    lines += ['    RHS       %-8s  % .12e\n' % (name, rhs if rhs != 0 else 0) for name, rhs in zip(row_names, milpBackpack['row_rhs'].tolist())]
+
+    # bounds
+    lines.append('BOUNDS\n')
+    for j, name in enumerate(col_names):
+        if integrality[j]:
+            lines.append(' BV BND       %-8s\n' % name)
+            continue
+        if col_lower[j] == -np.inf:
+            lines.append(' FR BND       %-8s\n' % name if col_upper[j] == np.inf else ' MI BND       %-8s\n' % name)
+        elif col_lower[j] != 0:
+            lines.append(' LO BND       %-8s  % .12e\n' % (name, col_lower[j]))
+        if col_upper[j] != np.inf:
+            lines.append(' UP BND       %-8s  % .12e\n' % (name, col_upper[j]))
+    lines.append('ENDATA\n')
+
+    with _open_model_file(filePath) as f:
+        f.write(''.join(lines))
+
+
+def write_milp_lp(milpBackpack, filePath):
+    # writes the matrix model as a (CPLEX) LP file, in the same layout PuLP uses
+    # (numbers are written in full precision, the big-M rows are sensitive to rounding)
+
+    col_names = milpBackpack['col_names'].tolist()
+    row_names = milp_row_names(milpBackpack)
+    col_cost = milpBackpack['col_cost']
+    col_lower = milpBackpack['col_lower'].tolist()
+    col_upper = milpBackpack['col_upper'].tolist()
+    integrality = milpBackpack['integrality']
+    # row-wise matrix (entries of each row sorted by column, i.e. by variable name)
+    a_col = np.repeat(np.arange(milpBackpack['num_col']), np.diff(milpBackpack['a_start']))
+    order = np.argsort(milpBackpack['a_index'], kind='stable')
+    r_start = np.concatenate(([0], np.cumsum(np.bincount(milpBackpack['a_index'], minlength=milpBackpack['num_row']))))
+    r_col = a_col[order].tolist()
+    r_value = milpBackpack['a_value'][order].tolist()
+
+    def lp_terms(cols, values):
+        terms = [('- ' if value < 0 else '+ ') + ('' if abs(value) == 1 else repr(abs(value)) + ' ') + col_names[col] for col, value in zip(cols, values)]
+        if len(terms) > 0 and terms[0][0] == '+':
+            terms[0] = terms[0][2:]
+        return terms
+
+    lines = ['\\* Thermo_MILP *\\\n', 'Minimize\n']
+    # objective function (a few terms per line)
+    objective = lp_terms(np.flatnonzero(col_cost).tolist(), col_cost[col_cost != 0].tolist())
+    lines += [('Objective_Function: ' if k == 0 else ' ') + ' '.join(objective[k:k+5]) + '\n' for k in range(0, len(objective), 5)]
+
+    # constraints
+    lines.append('Subject To\n')
+    senses = {'E': '=', 'G': '>=', 'L': '<='}
+    for i, (name, sense, rhs) in enumerate(zip(row_names, milpBackpack['row_sense'].tolist(), milpBackpack['row_rhs'].tolist())):
+        terms = lp_terms(r_col[r_start[i]:r_start[i+1]], r_value[r_start[i]:r_start[i+1]])
+        lines.append(name + ': ' + ' '.join(terms) + ' ' + senses[sense] + ' ' + repr(rhs if rhs != 0 else 0.0) + '\n')
+
+    # bounds (binaries are listed apart)
+    lines.append('Bounds\n')
+    for j, name in enumerate(col_names):
+        if integrality[j]:
+            continue
+        lower, upper = col_lower[j], col_upper[j]
+        if (lower == -np.inf) & (upper == np.inf):
+            lines.append(' %s free\n' % name)
+        elif upper == np.inf:
+            if lower != 0:
+                lines.append(' %s >= %r\n' % (name, lower))
+        elif lower == 0:
+            lines.append(' %s <= %r\n' % (name, upper))
+        else:
+            lines.append(' %s <= %s <= %r\n' % ('-inf' if lower == -np.inf else repr(lower), name, upper))
+    binaries = [col_names[j] + '\n' for j in np.flatnonzero(integrality).tolist()]
+    if len(binaries) > 0:
+        lines += ['Binaries\n'] + binaries
+    lines.append('End\n')
+
+    with _open_model_file(filePath) as f:
+        f.write(''.join(lines))
+
+
+def export_milp(milp, filePath):
+    # exports the milp (matrix model or PuLP problem) to a .lp or .mps file (gzip compressed if it ends with .gz)
+
+    compressed = filePath.lower().endswith('.gz')
+    fileFormat = os.path.splitext(filePath[:-3] if compressed else filePath)[1].lower()
+    if fileFormat not in ['.lp', '.mps']:
+        raise ValueError(f'Cannot export the model to {filePath}, please use a .lp, .mps or .mps.gz file.')
+
+    # matrix model
+    if isinstance(milp, dict):
+        if fileFormat == '.lp':
+            write_milp_lp(milp, filePath)
+        else:
+            write_milp_mps(milp, filePath)
+        return
+
+    # PuLP model (compressed files are written in a scratch directory first)
+    with tempfile.TemporaryDirectory(prefix='ewh_flex_') as workDir:
+        writePath = os.path.join(workDir, 'thermo_milp' + fileFormat) if compressed else filePath
+        if fileFormat == '.lp':
+            milp.writeLP(writePath)
+        else:
+            milp.writeMPS(writePath, with_objsense=True)
+        if compressed:
+            with open(writePath, 'rb') as f_in, gzip.open(filePath, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
+
+def _open_model_file(filePath):
+    # text file for the model export (gzip compressed if it ends with .gz)
+    if filePath.lower().endswith('.gz'):
+        return gzip.open(filePath, 'wt')
+    return open(filePath, 'w')
+
+
+
+##############################################
+##             MILP Warm Start              ##
+##############################################
+def warm_start_schedule(dataset, varBackpack, warmStart='baseline'):
+    # EWH operation (delta_in) to start the milp from: the non-optimized EWH operation ('baseline',
+    # from the original load diagram) or the calendar of a previous optimization (its opt_diagrams)
+    if isinstance(warmStart, str):
+        if warmStart != 'baseline':
+            raise ValueError(f'Unknown warm start {warmStart}, please use \'baseline\' or a previous opt_diagrams.')
+        # original load (W) over the EWH power, on each time step
+        delta_in = dataset['load'].to_numpy(dtype=float) / (1000 * varBackpack['ewh_power'] * 60 * varBackpack['delta_t'])
+    else:
+        delta_in = np.asarray(warmStart['delta_in'], dtype=float)
+        if len(delta_in) != len(dataset):
+            raise ValueError('The warm start calendar does not match the simulated period.')
+
+    return np.clip(np.nan_to_num(delta_in), 0, 1)
+
+
+def build_milp_start(varBackpack, delta_in):
+    ## complete milp solution (all variable families) for a given delta_in, following Eqs. (1)-(8) step by step.
+    ## delta_in is limited where needed to keep the EWH energy within the Eq. (6) bounds, so the start is feasible
+
+    # unpack some variables
+    ewh_power = varBackpack['ewh_power']
+    delta_t = varBackpack['delta_t']
+    networkPrice = np.asarray(varBackpack['networkPrice'], dtype=float).tolist()
+    networkTariff = varBackpack['networkTariff']
+    ewh_capacity = varBackpack['ewh_capacity']
+    waterHeatCap = varBackpack['waterHeatCap']
+    heatTransferCoeff = varBackpack['heatTransferCoeff']
+    ewh_area = varBackpack['ewh_area']
+    ambTemp = varBackpack['ambTemp']
+    wh_min = varBackpack['wh_min']
+    wh_max = varBackpack['wh_max']
+    delta_use = np.asarray(varBackpack['delta_use'], dtype=float)
+    tempSet = varBackpack['tempSet']
+    regressor_aboveSet_m_temp = varBackpack['regressor_aboveSet_m_temp']
+    regressor_belowSet_m_temp = varBackpack['regressor_belowSet_m_temp']
+
+    n = len(delta_use)
+    # coefficients of Eqs. (2)-(5) and (8), as in the milp
+    power_dt = (delta_t*60) * (ewh_power * delta_t)
+    temp_coeff = (3600 / (delta_t*60)) / (ewh_capacity * waterHeatCap)
+    w_loss_coeff = (delta_t*60) * (delta_t * (heatTransferCoeff * ewh_area))
+    w_loss_rhs = (((-ambTemp) * (heatTransferCoeff * ewh_area)) * delta_t) * (delta_t*60)
+    w_water_coeff = (60 * (delta_t * ((waterHeatCap * ewh_capacity) / 3600)))
+    above = ((varBackpack['regressor_aboveSet_m_delta'] * delta_use) + varBackpack['regressor_aboveSet_b']).tolist()
+    below = ((varBackpack['regressor_belowSet_m_delta'] * delta_use) + varBackpack['regressor_belowSet_b']).tolist()
+    use = (delta_use > 0).tolist()
+
+    start = {name: np.zeros(n) for name in MILP_VARIABLES}
+    _delta_in = np.asarray(delta_in, dtype=float).tolist()
+    _temp, _w_tot, _w_in, _w_loss, _w_water, _binAux = ([0.0] * n for _ in range(6))
+    w_tot = varBackpack['wh_init']
+    temp = varBackpack['ewh_start_temp']
+    for t in range(n):
+        # Eq. (5)
+        w_loss = w_loss_coeff * temp + w_loss_rhs
+        # Eq. (8): after usage, the regression above or below tempSet (binAux)
+        if use[t]:
+            binAux = 1.0 if temp > tempSet else 0.0
+            if binAux:
+                w_water = regressor_aboveSet_m_temp * temp + above[t]
+            else:
+                w_water = regressor_belowSet_m_temp * temp + below[t]
+        else:
+            binAux = 0.0
+            w_water = w_water_coeff * temp
+        # Eqs. (1), (2) and (6): EWH operation within the energy bounds of the next time step
+        if t < n - 1:
+            _delta_in[t] = min(max(_delta_in[t], (wh_min - w_water + w_loss) / power_dt), (wh_max - w_water + w_loss) / power_dt, 1.0)
+            _delta_in[t] = max(_delta_in[t], 0.0)
+        w_in = power_dt * _delta_in[t]
+
+        _temp[t], _w_tot[t], _w_in[t], _w_loss[t], _w_water[t], _binAux[t] = temp, w_tot, w_in, w_loss, w_water, binAux
+        # Eqs. (1) and (4), next time step
+        w_tot = w_water + w_in - w_loss
+        temp = temp_coeff * w_tot
+
+    start['temp'] = np.array(_temp)
+    start['w_tot'] = np.array(_w_tot)
+    start['w_in'] = np.array(_w_in)
+    start['w_loss'] = np.array(_w_loss)
+    start['w_water'] = np.array(_w_water)
+    start['delta_in'] = np.array(_delta_in)
+    start['binAux'] = np.array(_binAux)
+    # Eq. (3)
+    start['price'] = np.asarray(networkPrice) * (ewh_power * delta_t) * start['delta_in'] + networkTariff * (delta_t/24)
+    # Eq. (7): comfort cost where the EWH energy is below the comfort energy
+    comfort = ((tempSet * 1.005 * ewh_capacity * waterHeatCap / 3600) * delta_t * 60)
+    delta_use_prev = np.roll(delta_use, 1)
+    eq7 = (delta_use > 0) | ((delta_use - delta_use_prev != 0) & (delta_use - delta_use_prev == -delta_use_prev))
+    eq7 = eq7 | np.roll(eq7, -1)
+    start['costComfort'] = np.where(eq7, np.maximum(comfort - start['w_tot'], 0), 0)
+
+    return start
+
+
+def _start_vector(milpBackpack, start):
+    # milp start as a solution vector of the matrix model
+    x0 = np.zeros(milpBackpack['num_col'])
+    for name, idx in milpBackpack['col_index'].items():
+        x0[idx[idx >= 0]] = start[name][idx >= 0]
+    return x0
+
+
+
+##############################################
+##        HiGHS Command Line Solver         ##
+##############################################
+def solve_milp_highs_cmd(milpBackpack, modelPath, solverPath=None, timeLimit=None, gapRel=None, threads=None, msg=True, start=None):
+    # solves the matrix model with the HiGHS binary (from a start solution, if given)
+    # and returns the MILP status, the solution vector and some solver statistics
+
+    command, solverFiles = _highs_cmd_files(milpBackpack, modelPath, solverPath=solverPath, timeLimit=timeLimit, gapRel=gapRel,
+                                            threads=threads, msg=msg, start=start)
+    try:
+        if subprocess.run(command).returncode == -1:
+            raise RuntimeError('Error while executing HiGHS.')
+        stat, x, milpStats = _highs_cmd_results(milpBackpack, solverFiles, start)
+    finally:
+        _remove_files(solverFiles)
+
+    return stat, x, milpStats
+
+
+def _highs_cmd_files(milpBackpack, modelPath, solverPath=None, timeLimit=None, gapRel=None, threads=None, msg=True, start=None):
+    # writes the model, options and start files of the HiGHS binary, and returns its command and the solver files
+
+    solverPath = shutil.which(solverPath or 'highs')
+    if solverPath is None:
+        raise RuntimeError('Cannot execute the HiGHS binary, please check solverPath.')
+
+    write_milp_mps(milpBackpack, modelPath)
+    _base = os.path.splitext(modelPath)[0]
+    solutionPath = _base + '.sol'
+    optionsPath = _base + '.HiGHS'
+    logPath = _base + '.HiGHS_log'
+    startPath = _base + '.mst'
+
+    # solver options (same as PuLP HiGHS_CMD)
+    file_options = [f'solution_file={solutionPath}', 'write_solution_to_file=true', 'write_solution_style=0']
+    if not msg:
+        file_options.append('log_to_console=false')
+    if threads is not None:
+        file_options.append(f'threads={threads}')
+    if gapRel is not None:
+        file_options.append(f'mip_rel_gap={gapRel}')
+    file_options.append(f'log_file={logPath}')
+    with open(optionsPath, 'w') as options_file:
+        options_file.write('\n'.join(file_options))
+
+    command = [solverPath, modelPath, f'--options_file={optionsPath}']
+    if timeLimit is not None:
+        command.append(f'--time_limit={timeLimit}')
+    if threads is not None:
+        command.append('--parallel=on')
+    if start is not None:
+        _write_highs_solution(startPath, milpBackpack, _start_vector(milpBackpack, start))
+        command.append(f'--read_solution_file={startPath}')
+
+    solverFiles = {'solution': solutionPath, 'options': optionsPath, 'log': logPath, 'start': startPath}
+
+    return command, solverFiles
+
+
+def _highs_cmd_results(milpBackpack, solverFiles, start=None):
+    # MILP status, solution vector and solver statistics from the files of a HiGHS binary run
+    stat = _highs_log_status(solverFiles['log'])
+    milpStats = _highs_log_stats(solverFiles['log'])
+    milpStats['warm_start'] = start is not None
+    _lp_stats(milpBackpack, stat, milpStats)
+    x = np.full(milpBackpack['num_col'], np.nan)
+    if (stat == 'Optimal') & os.path.exists(solverFiles['solution']):
+        x = _read_highs_solution(solverFiles['solution'], milpBackpack)
+
+    return stat, x, milpStats
+
+
+def _remove_files(solverFiles):
+    for _path in solverFiles.values():
+        if os.path.exists(_path):
+            os.remove(_path)
+
+
+def _highs_log_status(logPath):
+    # model/solution status reported by HiGHS, mapped into the PuLP status names
+    with open(logPath) as log_file:
+        lines = [line.strip().split() for line in log_file.readlines()]
+    model_line = [line for line in lines if line[:2] == ['Model', 'status']]
+    if len(model_line) > 0:
+        model_status = ' '.join(model_line[0][3:])
+    else:
+        model_status = ' '.join([line for line in lines if 'Status' in line][0][1:])
+    sol_line = [line for line in lines if line[:2] == ['Solution', 'status']]
+    sol_status = sol_line[0][-1] if len(sol_line) > 0 else 'Not solved'
+    if (model_status.lower() == 'optimal') | (sol_status.lower() == 'feasible'):
+        return 'Optimal'
+    if model_status.lower() == 'infeasible':
+        return 'Infeasible'
+    if model_status.lower() == 'unbounded':
+        return 'Unbounded'
+    return 'Not Solved'
+
+
+def _highs_log_stats(logPath):
+    # solve time, final gap, branch-and-bound nodes and time of the first feasible solution (from the branch-and-bound table)
+    with open(logPath) as log_file:
+        lines = [line.strip().split() for line in log_file.readlines()]
+    milpStats = {'solve_time': None, 'mip_gap': None, 'nodes': None, 'first_incumbent_time': None}
+    for line in lines:
+        if (len(line) >= 9) and re.fullmatch(r'[0-9.]+s', line[-1]) and (line[-7] != 'inf') and (milpStats['first_incumbent_time'] is None):
+            milpStats['first_incumbent_time'] = float(line[-1][:-1])
+        if (len(line) >= 2) and (line[0] == 'Gap') and line[1].endswith('%'):
+            milpStats['mip_gap'] = float(line[1][:-1]) / 100
+        if (len(line) == 2) and (line[0] == 'Nodes') and line[1].isdigit():
+            milpStats['nodes'] = int(line[1])
+        if ((len(line) >= 2) and (line[0] == 'Timing')) or (line[:3] == ['HiGHS', 'run', 'time']):
+            milpStats['solve_time'] = float(line[-1] if line[0] == 'HiGHS' else line[1])
+    return milpStats
+
+
+def _lp_stats(milpBackpack, stat, milpStats):
+    # without hot water usage there are no binary variables, and the (LP) solution is the first and final one
+    if (stat == 'Optimal') & (not milpBackpack['integrality'].any()):
+        milpStats['mip_gap'] = 0.0
+        milpStats['nodes'] = 0
+        milpStats['first_incumbent_time'] = milpStats['solve_time']
+
+
+def _write_highs_solution(solutionPath, milpBackpack, x):
+    # writes a (start) solution vector as a raw HiGHS solution file (same as PuLP HiGHS_CMD warm start)
+    lines = ['Model status', 'None', '', '# Primal solution values', 'Feasible', '', f'# Columns {len(x)}']
+    lines += [f'{name} {value!r}' for name, value in zip(milpBackpack['col_names'].tolist(), x.tolist())]
+    with open(solutionPath, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def _read_highs_solution(solutionPath, milpBackpack):
+    # reads the primal values from a raw HiGHS solution file
+    with open(solutionPath) as f:
+        lines = f.readlines()
+    begin = [i for i, line in enumerate(lines) if line.startswith('# Columns')][0] + 1
+    end = [i for i, line in enumerate(lines) if line.startswith('# Rows')][0]
+    values = dict(line.split()[:2] for line in lines[begin:end])
+    return np.array([float(values[name]) for name in milpBackpack['col_names']])
+
+
+
+##############################################
+##        HiGHS In-Process Solver           ##
+##############################################
+# HiGHS instances solving in-process (cancel_highspy_solves)
+_highspy_solves = set()
+
+
+def solve_milp_highspy(milpBackpack, timeLimit=None, gapRel=None, threads=None, msg=True, start=None):
+    # solves the matrix model with the HiGHS python bindings (no files, no subprocess), from a start
+    # solution if given, and returns the MILP status, the solution vector and some solver statistics
+
+    h = _highspy_model(milpBackpack, timeLimit=timeLimit, gapRel=gapRel, threads=threads, msg=msg)
+
+    return _highspy_run(h, milpBackpack, start=start)
+
+
+def _highspy_model(milpBackpack, timeLimit=None, gapRel=None, threads=None, msg=True, highsArrays=None):
+    # HiGHS instance holding the matrix model (kept alive to re-solve it after changing some coefficients)
+
+    if highspy is None:
+        raise RuntimeError('The HiGHS python bindings (highspy) are not installed.')
+
+    h = highspy.Highs()
+    # solver options (same as the command line solver)
+    h.setOptionValue('output_flag', bool(msg))
+    if threads is not None:
+        h.setOptionValue('threads', int(threads))
+        h.setOptionValue('parallel', 'on')
+    if gapRel is not None:
+        h.setOptionValue('mip_rel_gap', float(gapRel))
+    if timeLimit is not None:
+        h.setOptionValue('time_limit', float(timeLimit))
+
+    _highspy_pass(h, _highspy_arrays(milpBackpack) if highsArrays is None else highsArrays)
+
+    return h
+
+
+def _highspy_arrays(milpBackpack):
+    # model arrays handed over to HiGHS (column-wise matrix), at the precision of the .mps file
+    highsArrays = {key: _mps_precision(milpBackpack[key]) for key in ['col_cost', 'col_lower', 'col_upper', 'row_lower', 'row_upper', 'a_value']}
+    highsArrays['a_start'] = np.asarray(milpBackpack['a_start'], dtype=np.int32)
+    highsArrays['a_index'] = np.asarray(milpBackpack['a_index'], dtype=np.int32)
+    highsArrays['integrality'] = np.where(milpBackpack['integrality'], int(highspy.HighsVarType.kInteger),
+                                          int(highspy.HighsVarType.kContinuous)).astype(np.int32)
+    return highsArrays
+
+
+def _highspy_pass(h, highsArrays):
+    # (re)places the model held by h with the model arrays, in a single call
+    h.passModel(len(highsArrays['col_cost']), len(highsArrays['row_lower']), len(highsArrays['a_value']), int(highspy.MatrixFormat.kColwise),
+                highspy.ObjSense.kMinimize, 0.0, highsArrays['col_cost'], highsArrays['col_lower'], highsArrays['col_upper'],
+                highsArrays['row_lower'], highsArrays['row_upper'], highsArrays['a_start'], highsArrays['a_index'], highsArrays['a_value'],
+                highsArrays['integrality'])
+
+
+def _highspy_run(h, milpBackpack, start=None):
+    # solves the model held by h (from a start solution, if given) and returns the MILP status,
+    # the solution vector and some solver statistics of this run
+
+    if start is not None:
+        startSolution = highspy.HighsSolution()
+        startSolution.col_value = _start_vector(milpBackpack, start)
+        h.setSolution(startSolution)
+    # time of the first feasible solution
+    incumbentTimes = []
+    onIncumbent = lambda e: incumbentTimes.append(e.data_out.running_time)
+    if hasattr(h, 'cbMipImprovingSolution'):
+        h.cbMipImprovingSolution.subscribe(onIncumbent)
+    # the interrupt callbacks let cancelSolve (and the signal handlers of the process) stop the run
+    if hasattr(h, 'cancelSolve') and (not h.HandleUserInterrupt):
+        h.HandleUserInterrupt = True
+    # the run time of a HiGHS instance adds up over its runs
+    runTime = h.getRunTime()
+    _highspy_solves.add(h)
+    try:
+        h.run()
+    finally:
+        _highspy_solves.discard(h)
+    if hasattr(h, 'cbMipImprovingSolution'):
+        h.cbMipImprovingSolution.unsubscribe(onIncumbent)
+
+    stat = _highspy_status(h)
+    x = np.full(milpBackpack['num_col'], np.nan)
+    if stat == 'Optimal':
+        # the solution is kept at the precision of the HiGHS solution file (as with the command line solver)
+        x = _mps_precision(np.array(h.getSolution().col_value))
+    milpStats = {'solve_time': h.getRunTime() - runTime, 'mip_gap': h.getInfo().mip_gap, 'nodes': h.getInfo().mip_node_count,
+                 'first_incumbent_time': incumbentTimes[0] if len(incumbentTimes) > 0 else None, 'warm_start': start is not None}
+    _lp_stats(milpBackpack, stat, milpStats)
+
+    return stat, x, milpStats
+
+
+def _mps_precision(values):
+    # rounds the model data to the precision of the .mps file (13 significant digits),
+    # so the in-process and the command line solvers get the exact same model (and give the same solution)
+    unique, inverse = np.unique(values, return_inverse=True)
+    unique = np.array([float('%.12e' % value) for value in unique.tolist()])
+    return unique[inverse].reshape(np.shape(values))
+
+
+def cancel_highspy_solves():
+    # stops the in-process HiGHS runs of this process (e.g. from a signal handler or another thread),
+    # which return as 'Not Solved'
+    for h in list(_highspy_solves):
+        h.cancelSolve()
+
+
+def _highspy_solver(optSolver='HiGHS', solverPath=None):
+    # the milp is solved in-process with the HiGHS python bindings if they are installed and no HiGHS binary is given,
+    # and with the HiGHS binary (solverPath, or highs in the system PATH) otherwise or if asked for (optSolver='HiGHS_CMD')
+    return (optSolver == 'HiGHS') & (solverPath is None) & (highspy is not None)
+
+
+def _highspy_status(h):
+    # model/solution status reported by HiGHS, mapped into the PuLP status names
+    model_status = h.getModelStatus()
+    if (model_status == highspy.HighsModelStatus.kOptimal) | (h.getInfo().primal_solution_status == 2):
+        return 'Optimal'
+    if model_status == highspy.HighsModelStatus.kInfeasible:
+        return 'Infeasible'
+    if model_status == highspy.HighsModelStatus.kUnbounded:
+        return 'Unbounded'
+    return 'Not Solved'
+
+
+
+##############################################
+##       Solving Optimization Problem       ##
+##############################################
+def ewh_solver(dataset, varBackpack, optSolver = 'HiGHS', solverPath=None, modelBackend='matrix', exportModel=None, warmStart=None,
+               msg=True, diagnostics=None):
+
+    # milp start from a known EWH operation (optional)
+    start = None
+    if warmStart is not None:
+        start = _warm_start(dataset, varBackpack, warmStart, diagnostics=diagnostics)
+
+    stat, opt_val, solution, milpStats = solve_milp(varBackpack, optSolver=optSolver, solverPath=solverPath, modelBackend=modelBackend,
+                                                    exportModel=exportModel, start=start, msg=msg, diagnostics=diagnostics)
+
+    return _solver_output(dataset, varBackpack, stat, opt_val, solution, milpStats, msg=msg, diagnostics=diagnostics)
+
+
+def _warm_start(dataset, varBackpack, warmStart, diagnostics=None):
+    with diagnostics_stage(diagnostics, 'warm_start'):
+        return build_milp_start(varBackpack, warm_start_schedule(dataset, varBackpack, warmStart))
+
+
+def _solver_output(dataset, varBackpack, stat, opt_val, solution, milpStats, msg=True, diagnostics=None):
+
     ##############################################
+    ##             Export Results               ##
+    ##############################################
+    with diagnostics_stage(diagnostics, 'results'):
+        # Outputs stored in sheet "general"
+        general_outputs = {'MILP status': stat, 'Objective Function Value': opt_val}
+        # create template for diagram df
+        opt_diagrams = solution_diagrams(dataset, solution)
+
+        opt_output = ewh_kpis(dataset, varBackpack, opt_diagrams, msg=msg)
+    opt_output['milp_stats'] = milpStats
+
+    return opt_output
+
+
+def solve_milp(varBackpack, optSolver = 'HiGHS', solverPath=None, modelBackend='matrix', exportModel=None, start=None, msg=True,
+               diagnostics=None):
+    # builds and solves the milp (from a start solution, if given), and returns the MILP status, the objective function value,
+    # the solution of each variable family, per time step (variables left out of the model are NaN), and some solver statistics.
+    # with diagnostics, the build/solve stages and the model size are recorded there
+
+    # unpack some variables
+    daySim = varBackpack['daySim']
 
-    # Write the milp to a .lp file
-    milp.writeLP('thermo_milp.lp')
+
+    ##############################################
+    ##           SAVING AND SOLVING             ##
+    ##############################################
 
     #time limit depends on simulated days plus 1 minute
-    timeLimit = (daySim * 30) + 60
+    timeLimit = _solver_time_limit(daySim)
     if daySim > 35:
         gapRel = 0.05
     else:
         gapRel = 0.015
 
-    if (optSolver == 'HiGHS'):
-        solver = getSolver('HiGHS_CMD', msg=True, timeLimit=timeLimit, path=solverPath, gapRel=0.015, threads=1)
-    if (optSolver == 'CBC'):
-        solver = getSolver('PULP_CBC_CMD', msg=True, timeLimit=timeLimit, gapRel=gapRel)
+    # CBC is only available through PuLP
+    if (optSolver == 'CBC') | (modelBackend == 'pulp'):
+        from pulp import getSolver, LpStatus, value
+        with diagnostics_stage(diagnostics, 'build_model'):
+            milp, milpVariables = build_milp_pulp(varBackpack)
+        modelSize = {'num_row': len(milp.constraints), 'num_col': len(milp.variables()),
+                     'num_nz': sum(len(constraint) for constraint in milp.constraints.values()),
+                     'num_binary': sum(variable.cat == 'Integer' for variable in milp.variables())}
+
+        # Write the milp to a .lp/.mps file (only on request)
+        if exportModel is not None:
+            with diagnostics_stage(diagnostics, 'export_model'):
+                export_milp(milp, exportModel)
+
+        # start values of the variables (optional)
+        if start is not None:
+            for name, variables in milpVariables.items():
+                for variable, startValue in zip(variables, start[name].tolist()):
+                    variable.setInitialValue(startValue)
+
+        if (optSolver == 'HiGHS') | (optSolver == 'HiGHS_CMD'):
+            solver = getSolver('HiGHS_CMD', msg=msg, timeLimit=timeLimit, path=solverPath, gapRel=0.015, threads=1, warmStart=start is not None)
+        if (optSolver == 'CBC'):
+            solver = getSolver('PULP_CBC_CMD', msg=msg, timeLimit=timeLimit, gapRel=gapRel, warmStart=start is not None)
+
+        if msg:
+            print('Running optimization for ' + str(daySim) + ' days.')
+
+        # solver files are kept in a scratch directory of this run (removed after solving)
+        with diagnostics_stage(diagnostics, 'solve'), tempfile.TemporaryDirectory(prefix='ewh_flex_') as workDir:
+            solver.tmpDir = workDir
+            _start = datetime.datetime.now()
+            milp.solve(solver)
+            milpStats = {'solve_time': (datetime.datetime.now() - _start).total_seconds(), 'mip_gap': None, 'nodes': None,
+                         'first_incumbent_time': None, 'warm_start': start is not None}
+        # -- LpStatus is a dictionary with the status of solution:
+        # -- {0: 'Not Solved', 1: 'Optimal', -1: 'Infeasible', -2: 'Unbounded', -3: 'Undefined'}
+        stat = LpStatus[milp.status]
+        opt_val = value(milp.objective)  # objective function value
+        # solution of each variable family, per time step (variables left out of the model are NaN)
+        solution = {name: np.array([v.varValue for v in variables], dtype=float) for name, variables in milpVariables.items()}
+    else:
+        milpBackpack, modelSize = _matrix_model(varBackpack, exportModel=exportModel, diagnostics=diagnostics)
 
-    print('Running optimization for ' + str(daySim) + ' days.')
+        if msg:
+            print('Running optimization for ' + str(daySim) + ' days.')
 
-    milp.solve(solver)
-    # -- LpStatus is a dictionary with the status of solution:
-    # -- {0: 'Not Solved', 1: 'Optimal', -1: 'Infeasible', -2: 'Unbounded', -3: 'Undefined'}
-    stat = LpStatus[milp.status]
-    opt_val = value(milp.objective)  # objective function value
+        with diagnostics_stage(diagnostics, 'solve'):
+            if _highspy_solver(optSolver, solverPath):
+                # the milp is solved in-process with the HiGHS python bindings
+                stat, x, milpStats = solve_milp_highspy(milpBackpack, timeLimit=timeLimit, gapRel=0.015, threads=1, msg=msg, start=start)
+            else:
+                # the milp is written to a .mps file in a scratch directory of this run and solved with the HiGHS binary
+                with tempfile.TemporaryDirectory(prefix='ewh_flex_') as workDir:
+                    stat, x, milpStats = solve_milp_highs_cmd(milpBackpack, os.path.join(workDir, 'thermo_milp.mps'), solverPath=solverPath,
+                                                              timeLimit=timeLimit, gapRel=0.015, threads=1, msg=msg, start=start)
+        opt_val, solution = _matrix_solution(milpBackpack, stat, x)
+    milpStats['status'] = stat
+    _record_model_size(diagnostics, modelSize)
 
+    return stat, opt_val, solution, milpStats
 
 
-    ##############################################
-    ##             Export Results               ##
-    ##############################################
-    # Outputs stored in sheet "general"
-    general_outputs = {'MILP status': stat, 'Objective Function Value': opt_val}
-    # create template for diagram df
+def _record_model_size(diagnostics, modelSize):
+    # size of the (largest) model solved
+    if diagnostics is not None:
+        for key, size in modelSize.items():
+            diagnostics['model'][key] = max(size, diagnostics['model'].get(key, 0))
+
+
+def _solver_time_limit(daySim):
+    return (daySim * 30) + 60
+
+
+def _matrix_model(varBackpack, exportModel=None, diagnostics=None):
+    # matrix model of the milp and its size (written to a .lp/.mps file, on request)
+    with diagnostics_stage(diagnostics, 'build_model'):
+        milpBackpack = build_milpBackpack(varBackpack)
+    modelSize = {'num_row': int(milpBackpack['num_row']), 'num_col': int(milpBackpack['num_col']),
+                 'num_nz': len(milpBackpack['a_value']), 'num_binary': int(milpBackpack['integrality'].sum())}
+
+    # Write the milp to a .lp/.mps file (only on request)
+    if exportModel is not None:
+        with diagnostics_stage(diagnostics, 'export_model'):
+            export_milp(milpBackpack, exportModel)
+
+    return milpBackpack, modelSize
+
+
+def _matrix_solution(milpBackpack, stat, x):
+    opt_val = float(milpBackpack['col_cost'] @ x) if stat == 'Optimal' else None  # objective function value
+    # solution of each variable family, per time step (variables left out of the model are NaN)
+    solution = {name: np.where(idx >= 0, x[idx], np.nan) for name, idx in milpBackpack['col_index'].items()}
+
+    return opt_val, solution
+
+
+def solution_diagrams(dataset, solution):
+    # opt_diagrams template, with one column per variable (binAux only exists with hot water usage)
     opt_diagrams = dataset[['timestamp','temp_inlet','delta_use']].copy()
+    for name in ['binAux', 'delta_in', 'price', 'temp', 'w_in', 'w_loss', 'w_tot', 'w_water']:
+        if (name != 'binAux') | (dataset['delta_use'] > 0).any():
+            opt_diagrams[name] = solution[name]
 
+    return opt_diagrams
 
-    for v in milp.variables():
-
-        temp_idx = int(''.join(filter(str.isdigit, str(v))))
-
-        ## find variables and store data
-        if re.search(f'temp_', v.name):
-            opt_diagrams.loc[temp_idx,'temp'] = v.varValue
-        if re.search(f'w_tot_', v.name):
-            opt_diagrams.loc[temp_idx,'w_tot'] = v.varValue
-        if re.search(f'w_water_', v.name):
-            opt_diagrams.loc[temp_idx, 'w_water'] = v.varValue
-        if re.search(f'w_in_', v.name):
-            opt_diagrams.loc[temp_idx,'w_in'] = v.varValue
-        if re.search(f'w_out_', v.name):
-            opt_diagrams.loc[temp_idx,'w_out'] = v.varValue
-        if re.search(f'w_loss_', v.name):
-            opt_diagrams.loc[temp_idx,'w_loss'] = v.varValue
-        if re.search(f'delta_in_', v.name):
-            opt_diagrams.loc[temp_idx,'delta_in'] = v.varValue
-        if re.search(f'binAux_', v.name):
-            opt_diagrams.loc[temp_idx,'binAux'] = v.varValue
-        if re.search(f'price_', v.name):
-            opt_diagrams.loc[temp_idx,'price'] = v.varValue
+
+def ewh_kpis(dataset, varBackpack, opt_diagrams, msg=True):
+    # flexibility, load and price indicators of an optimized calendar (adds the flex and load diagrams to opt_diagrams),
+    # printed to stdout unless msg=False
+
+    # unpack some variables
+    ewh_power = varBackpack['ewh_power']
+    delta_t = varBackpack['delta_t']
+    daySim = varBackpack['daySim']
+    user = varBackpack['user']
+    networkPrice = np.asarray(varBackpack['networkPrice'], dtype=float)
+    networkTariff = varBackpack['networkTariff']
+    tempSet = varBackpack['tempSet']
 
     # fix delta_in very low and close to 1 values
-    opt_diagrams.loc[opt_diagrams['delta_in']<0.001,'delta_in'] = 0
-    opt_diagrams.loc[opt_diagrams['delta_in']>0.999,'delta_in'] = 1
+    delta_in = opt_diagrams['delta_in'].to_numpy(dtype=float)
+    delta_in = np.where(delta_in < 0.001, 0, np.where(delta_in > 0.999, 1, delta_in))
+    opt_diagrams['delta_in'] = delta_in
     ## add variable of flexibility (1-delta_in):
-    opt_diagrams['flex'] = 1-opt_diagrams['delta_in']
+    opt_diagrams['flex'] = 1 - delta_in
     ## total flexibility (min)
-    total_flex = round(sum(opt_diagrams['flex']) * (60*delta_t),4)
+    total_flex = round(float(np.sum(1 - delta_in)) * (60*delta_t),4)
     # percentage flexibility
     perc_flex = 100*total_flex/(len(opt_diagrams)*60*delta_t)
     ## average daily flexiblity
     avgDailyFlex = total_flex/daySim
     avgDailyFlex_srt = str(datetime.timedelta(minutes=avgDailyFlex) - datetime.timedelta(microseconds=datetime.timedelta(minutes=avgDailyFlex).microseconds))
     ## optimized load
-    optimized_load = sum(opt_diagrams['delta_in']) * ewh_power * delta_t
+    optimized_load = float(np.sum(delta_in)) * ewh_power * delta_t
     ## average daily load
     avgDailyLoad = optimized_load/daySim
-    ## (deleted microseconds)
-    # avgDailyLoad_str = str(datetime.timedelta(minutes=avgDailyLoad) - datetime.timedelta(microseconds=datetime.timedelta(minutes=avgDailyLoad).microseconds))
     ## calculate total optimized load diagram
-    opt_diagrams['optimized_load'] = opt_diagrams['delta_in']*1000*ewh_power
+    opt_diagrams['optimized_load'] = delta_in*1000*ewh_power
     ## add original load
     opt_diagrams['original_load'] = dataset['load']
     ## optimized price
-    optimized_price = sum(opt_diagrams['price'])
+    optimized_price = float(np.sum(opt_diagrams['price'].to_numpy(dtype=float)))
     ## original load
-    original_load = (dataset['load'].sum()/1000) * (1/60)
-    original_load_list = (dataset['load'] / 1000) * (1 / 60)
+    load = dataset['load'].to_numpy(dtype=float)
+    original_load = (load.sum()/1000) * (1/60)
+    original_load_list = (load / 1000) * (1 / 60)
     ## original price
     ## network price per minute
     networkTariff_minute = networkTariff * (delta_t/24)
     networkTariff_used = networkTariff_minute * len(dataset)
-    original_price = sum(original_load_list * networkPrice) + networkTariff_used
-
-
-    print("Simulated Period:", str(datetime.timedelta(minutes=len(dataset))))
-    print("Time Resolution:", int(60*delta_t), 'min')
-    print("Optimized Price:", "{:.2f}".format(optimized_price), '€')
-    print("Optimized Load:", "{:.2f}".format(optimized_load), 'kWh')
-    print("Original Price:", "{:.2f}".format(original_price), '€')
-    print("Original Load:", "{:.2f}".format(original_load), 'kWh')
-    print("Avg. Consumption per day:", "{:.2f}".format(avgDailyLoad), 'kWh')
-    print("Total Flexibility:", str(datetime.timedelta(minutes=total_flex)))
-    print("Perc. Flexibility:", "{:.2f}".format(perc_flex), '%')
-    print("Avg. Flexibililty per day:", avgDailyFlex_srt)
+    original_price = float(np.sum(original_load_list * networkPrice)) + networkTariff_used
+
+    if msg:
+        print("Simulated Period:", str(datetime.timedelta(minutes=len(dataset))))
+        print("Time Resolution:", int(60*delta_t), 'min')
+        print("Optimized Price:", "{:.2f}".format(optimized_price), '€')
+        print("Optimized Load:", "{:.2f}".format(optimized_load), 'kWh')
+        print("Original Price:", "{:.2f}".format(original_price), '€')
+        print("Original Load:", "{:.2f}".format(original_load), 'kWh')
+        print("Avg. Consumption per day:", "{:.2f}".format(avgDailyLoad), 'kWh')
+        print("Total Flexibility:", str(datetime.timedelta(minutes=total_flex)))
+        print("Perc. Flexibility:", "{:.2f}".format(perc_flex), '%')
+        print("Avg. Flexibililty per day:", avgDailyFlex_srt)
 
     opt_output = {}
     opt_output['user'] = user
@@ -628,4 +1458,440 @@ def ewh_solver(dataset, varBackpack, optSolver = 'HiGHS', solverPath=None):
     opt_output['savings_energy'] = original_load - optimized_load
     opt_output['opt_diagrams'] = opt_diagrams
 
-    return opt_output
\ No newline at end of file
+    return opt_output
+
+
+##############################################
+##          Rolling Horizon Solver          ##
+##############################################
+def ewh_rolling_solver(dataset, varBackpack, windowDays=2, commitDays=1, optSolver='HiGHS', solverPath=None, modelBackend='matrix',
+                       warmStart=None, msg=True, diagnostics=None):
+    ## solves the horizon in overlapping windows of windowDays, keeping the first commitDays of each window.
+    ## the EWH energy at the end of the committed days is the initial energy of the next window,
+    ## and the committed days are stitched into a single opt_output
+
+    if (commitDays <= 0) | (windowDays < commitDays):
+        raise ValueError('The rolling horizon needs 0 < commitDays <= windowDays.')
+
+    # unpack some variables
+    delta_t = varBackpack['delta_t']
+
+    n = len(varBackpack['T'])
+    stepsDay = int(round(24 / delta_t))
+    windowSteps = int(round(windowDays * stepsDay))
+    commitSteps = int(round(commitDays * stepsDay))
+
+    # EWH operation to start each window from (optional)
+    if warmStart is not None:
+        with diagnostics_stage(diagnostics, 'warm_start'):
+            warmStart = warm_start_schedule(dataset, varBackpack, warmStart)
+
+    solution = {name: np.full(n, np.nan) for name in MILP_VARIABLES}
+    milpStats = {'solve_time': 0, 'mip_gap': 0, 'nodes': 0, 'first_incumbent_time': 0, 'warm_start': warmStart is not None}
+    wh_init = varBackpack['wh_init']
+    ewh_start_temp = varBackpack['ewh_start_temp']
+    start = 0
+    while start < n:
+        stop = min(start + windowSteps, n)
+        # the last window commits everything that is left
+        commit = n if stop == n else start + commitSteps
+
+        # same milp, on the window time steps and from the carried over EWH state
+        windowBackpack = dict(varBackpack)
+        for key in ['flow_rate', 'delta_use', 'temp_inlet', 'networkPrice']:
+            windowBackpack[key] = list(varBackpack[key][start:stop])
+        windowBackpack['T'] = range(stop - start)
+        windowBackpack['daySim'] = int(np.ceil((stop - start) / stepsDay))
+        windowBackpack['wh_init'] = wh_init
+        windowBackpack['ewh_start_temp'] = ewh_start_temp
+
+        windowStart = None
+        if warmStart is not None:
+            with diagnostics_stage(diagnostics, 'warm_start'):
+                windowStart = build_milp_start(windowBackpack, warmStart[start:stop])
+
+        stat, _, windowSolution, windowStats = solve_milp(windowBackpack, optSolver=optSolver, solverPath=solverPath,
+                                                          modelBackend=modelBackend, start=windowStart, msg=msg, diagnostics=diagnostics)
+        # solver statistics over all windows (total times and nodes, worst gap, status of the last window)
+        milpStats['status'] = stat
+        for key in ['solve_time', 'nodes', 'first_incumbent_time']:
+            milpStats[key] = None if (milpStats[key] is None) | (windowStats[key] is None) else milpStats[key] + windowStats[key]
+        milpStats['mip_gap'] = None if (milpStats['mip_gap'] is None) | (windowStats['mip_gap'] is None) else max(milpStats['mip_gap'], windowStats['mip_gap'])
+        for name in MILP_VARIABLES:
+            solution[name][start:commit] = windowSolution[name][:commit - start]
+        if stat != 'Optimal':
+            # no state to carry over, the remaining time steps are left without solution
+            if msg:
+                print('Rolling horizon stopped at step ' + str(start) + ' (MILP status: ' + stat + ').')
+            break
+
+        wh_init, ewh_start_temp = _carry_state(varBackpack, windowSolution, commit - start - 1)
+        start = commit
+
+    with diagnostics_stage(diagnostics, 'results'):
+        opt_diagrams = solution_diagrams(dataset, solution)
+
+        opt_output = ewh_kpis(dataset, varBackpack, opt_diagrams, msg=msg)
+    opt_output['milp_stats'] = milpStats
+
+    return opt_output
+
+
+def _carry_state(varBackpack, windowSolution, last):
+    # EWH energy at the first step after the committed ones (Eq. (1)) and respective temperature (Eq. (4))
+    wh_init = windowSolution['w_water'][last] + windowSolution['w_in'][last] - windowSolution['w_loss'][last]
+    # kept within Eq. (6) bounds (solver tolerances)
+    wh_init = min(max(wh_init, varBackpack['wh_min']), varBackpack['wh_max'])
+    ewh_start_temp = ((3600 / (varBackpack['delta_t']*60)) / (varBackpack['ewh_capacity'] * varBackpack['waterHeatCap'])) * wh_init
+
+    return wh_init, ewh_start_temp
+
+
+def _stream_window(minutes, varBackpack, minuteStart, resample, diagnostics):
+    # dataset and backpack of a window of the stream (1-min rows from minuteStart), at the chosen resolution
+    windowBackpack = dict(varBackpack)
+    if varBackpack['tariff'] == 3:
+        windowBackpack['price_dynamic'] = varBackpack['price_dynamic'].iloc[minuteStart:minuteStart + len(minutes)]
+    if resample != 'no':
+        with diagnostics_stage(diagnostics, 'resample_data'):
+            minutes = resample_data(minutes, resolution=resample)
+    with diagnostics_stage(diagnostics, 'update_dataset_backpack'):
+        window, windowBackpack = update_dataset_backpack(minutes, windowBackpack, resample)
+
+    return window, windowBackpack
+
+
+def ewh_stream_solver(chunks, varBackpack, resample='no', windowDays=2, commitDays=1, optSolver='HiGHS', solverPath=None,
+                      modelBackend='matrix', msg=True, diagnostics=None):
+    ## rolling horizon over a stream of 1-min chunks (timestamp, load, delta_use), e.g. from convert_load_usage_chunks.
+    ## only the 1-min data of the current window is kept, and each window is resampled and prepared on its own,
+    ## so a year long history is solved without building the full 1-min dataset. varBackpack is the one from
+    ## build_varBackpack (before update_dataset_backpack). once a window is not solved, the rest of the stream is
+    ## prepared at once and left without solution
+
+    if (commitDays <= 0) | (windowDays < commitDays):
+        raise ValueError('The rolling horizon needs 0 < commitDays <= windowDays.')
+
+    windowMinutes = int(round(windowDays * 1440))
+    commitMinutes = int(round(commitDays * 1440))
+
+    committed = []
+    solution = {name: [] for name in MILP_VARIABLES}
+    networkPrice = []
+    milpStats = {'solve_time': 0, 'mip_gap': 0, 'nodes': 0, 'first_incumbent_time': 0, 'warm_start': False}
+    carry = None
+    minuteStart = 0
+    buffer = []
+    buffered = 0
+    chunks = iter(chunks)
+    exhausted = False
+    while True:
+        # read chunks until there is more than a window (or the stream ends)
+        while (not exhausted) & (buffered <= windowMinutes):
+            try:
+                rows = next(chunks)
+            except StopIteration:
+                exhausted = True
+                break
+            buffer.append(rows)
+            buffered += len(rows)
+        if buffered == 0:
+            break
+        minutes = pd.concat(buffer, ignore_index=True)
+        # the last window commits everything that is left
+        last = buffered <= windowMinutes
+        window, windowBackpack = _stream_window(minutes.iloc[:windowMinutes].reset_index(drop=True), varBackpack, minuteStart,
+                                                resample, diagnostics)
+        with diagnostics_stage(diagnostics, 'linear_regressors'):
+            windowBackpack = linear_regressors(window, windowBackpack)
+        if carry is not None:
+            windowBackpack['wh_init'], windowBackpack['ewh_start_temp'] = carry
+        steps = len(window)
+        commit = steps if last else int(round(commitDays * 24 / windowBackpack['delta_t']))
+
+        stat, _, windowSolution, windowStats = solve_milp(windowBackpack, optSolver=optSolver, solverPath=solverPath,
+                                                          modelBackend=modelBackend, msg=msg, diagnostics=diagnostics)
+        # solver statistics over all windows (total times and nodes, worst gap, status of the last window)
+        milpStats['status'] = stat
+        for key in ['solve_time', 'nodes', 'first_incumbent_time']:
+            milpStats[key] = None if (milpStats[key] is None) | (windowStats[key] is None) else milpStats[key] + windowStats[key]
+        milpStats['mip_gap'] = None if (milpStats['mip_gap'] is None) | (windowStats['mip_gap'] is None) else max(milpStats['mip_gap'], windowStats['mip_gap'])
+        if stat != 'Optimal':
+            # no state to carry over, the remaining time steps are left without solution
+            if msg:
+                print('Rolling horizon stopped at ' + str(window['timestamp'].iloc[0]) + ' (MILP status: ' + stat + ').')
+        else:
+            carry = _carry_state(windowBackpack, windowSolution, commit - 1)
+
+        # keep the committed time steps
+        committed.append(window.iloc[:commit])
+        networkPrice.extend(list(windowBackpack['networkPrice'])[:commit])
+        for name in MILP_VARIABLES:
+            solution[name].append(np.asarray(windowSolution[name], dtype=float)[:commit])
+        if last:
+            break
+        buffer = [minutes.iloc[commitMinutes:]]
+        buffered -= commitMinutes
+        minuteStart += commitMinutes
+
+        if stat != 'Optimal':
+            # the remaining time steps are read and prepared at once (no more windows to solve)
+            rest, windowBackpack = _stream_window(pd.concat(buffer + list(chunks), ignore_index=True), varBackpack, minuteStart,
+                                                  resample, diagnostics)
+            committed.append(rest)
+            networkPrice.extend(list(windowBackpack['networkPrice']))
+            for name in MILP_VARIABLES:
+                solution[name].append(np.full(len(rest), np.nan))
+            break
+
+    if len(committed) == 0:
+        raise ValueError('The load diagram is empty, please check the chunks.')
+
+    with diagnostics_stage(diagnostics, 'results'):
+        # committed days stitched into a single dataset, on the backpack of the full period
+        dataset = pd.concat(committed, ignore_index=True)
+        windowBackpack['T'] = range(len(dataset))
+        windowBackpack['daySim'] = (dataset.timestamp.max() - dataset.timestamp.min()).days + 1
+        windowBackpack['networkPrice'] = networkPrice
+        solution = {name: np.concatenate(values) for name, values in solution.items()}
+        opt_diagrams = solution_diagrams(dataset, solution)
+
+        opt_output = ewh_kpis(dataset, windowBackpack, opt_diagrams, msg=msg)
+    opt_output['milp_stats'] = milpStats
+
+    return opt_output
+
+
+##############################################
+##          Price Scenario Solver           ##
+##############################################
+def build_milp_model(varBackpack, optSolver='HiGHS', solverPath=None, msg=True):
+    ## milp that is built once and re-solved for new prices (solve_milp_prices).
+    ## networkPrice and networkTariff only enter Eq. (3), so a new price scenario only changes the
+    ## delta_in coefficients and the right hand side of the Eq. (3) rows. msg=False keeps the solves out of stdout
+
+    # unpack some variables
+    daySim = varBackpack['daySim']
+
+    milpBackpack = build_milpBackpack(varBackpack)
+
+    milpModel = {}
+    milpModel['varBackpack'] = varBackpack
+    milpModel['milpBackpack'] = milpBackpack
+    milpModel['solverPath'] = solverPath
+    milpModel['msg'] = msg
+    # time limit depends on simulated days plus 1 minute (as in solve_milp)
+    milpModel['timeLimit'] = _solver_time_limit(daySim)
+    # Eq. (3) rows and their delta_in coefficients in the sparse matrix, per time step
+    milpModel['price_rows'], milpModel['price_entries'] = _price_entries(milpBackpack)
+    # the milp is kept in-process with the HiGHS python bindings (unless the HiGHS binary is given or asked for),
+    # with the model arrays it was handed over
+    milpModel['highs'] = None
+    milpModel['highs_arrays'] = None
+    if _highspy_solver(optSolver, solverPath):
+        milpModel['highs_arrays'] = _highspy_arrays(milpBackpack)
+        milpModel['highs'] = _highspy_model(milpBackpack, timeLimit=milpModel['timeLimit'], gapRel=0.015, threads=1, msg=msg,
+                                            highsArrays=milpModel['highs_arrays'])
+    # solution of the last solve (start of the next one)
+    milpModel['solution'] = None
+
+    return milpModel
+
+
+def solve_milp_prices(milpModel, networkPrice, networkTariff=0):
+    # re-solves the milp model for new prices, from the solution of the previous prices (if any),
+    # and returns the same as solve_milp
+
+    # unpack some variables
+    varBackpack = milpModel['varBackpack']
+    ewh_power = varBackpack['ewh_power']
+    delta_t = varBackpack['delta_t']
+    daySim = varBackpack['daySim']
+
+    networkPrice = np.asarray(networkPrice, dtype=float)
+    if networkPrice.shape != (len(varBackpack['T']),):
+        raise ValueError('The price scenario needs one networkPrice per time step, please check its length.')
+
+    # Eq. (3) with the new prices (same coefficients as build_milpBackpack)
+    milpBackpack = milpModel['milpBackpack']
+    coef = -(networkPrice * (ewh_power * delta_t))
+    rhs = networkTariff * (delta_t/24)
+    highsArrays = milpModel['highs_arrays']
+    if np.array_equal(milpModel['price_entries'] >= 0, coef != 0):
+        milpBackpack['a_value'][milpModel['price_entries'][coef != 0]] = coef[coef != 0]
+        for key in ['row_rhs', 'row_lower', 'row_upper']:
+            milpBackpack[key][milpModel['price_rows']] = rhs
+        if highsArrays is not None:
+            highsArrays['a_value'][milpModel['price_entries'][coef != 0]] = _mps_precision(coef[coef != 0])
+            for key in ['row_lower', 'row_upper']:
+                highsArrays[key][milpModel['price_rows']] = _mps_precision(rhs)
+    else:
+        # zero prices change the sparsity of the matrix, so the model arrays are rebuilt (and the HiGHS ones with them)
+        milpBackpack = build_milpBackpack(dict(varBackpack, networkPrice=networkPrice.tolist(), networkTariff=networkTariff))
+        milpModel['milpBackpack'] = milpBackpack
+        milpModel['price_rows'], milpModel['price_entries'] = _price_entries(milpBackpack)
+        if highsArrays is not None:
+            milpModel['highs_arrays'] = highsArrays = _highspy_arrays(milpBackpack)
+
+    # the previous solution is still feasible, with the energy cost of the new prices
+    start = None
+    if milpModel['solution'] is not None:
+        start = dict(milpModel['solution'])
+        start['price'] = networkPrice * (ewh_power * delta_t) * start['delta_in'] + rhs
+
+    if milpModel['msg']:
+        print('Running optimization for ' + str(daySim) + ' days.')
+
+    h = milpModel['highs']
+    if h is not None:
+        # the new coefficients and bounds (or the rebuilt matrix) are handed over at once
+        _highspy_pass(h, highsArrays)
+        stat, x, milpStats = _highspy_run(h, milpBackpack, start=start)
+    else:
+        with tempfile.TemporaryDirectory(prefix='ewh_flex_') as workDir:
+            stat, x, milpStats = solve_milp_highs_cmd(milpBackpack, os.path.join(workDir, 'thermo_milp.mps'), solverPath=milpModel['solverPath'],
+                                                      timeLimit=milpModel['timeLimit'], gapRel=0.015, threads=1, msg=milpModel['msg'], start=start)
+    opt_val = float(milpBackpack['col_cost'] @ x) if stat == 'Optimal' else None  # objective function value
+    # solution of each variable family, per time step (variables left out of the model are NaN)
+    solution = {name: np.where(idx >= 0, x[idx], np.nan) for name, idx in milpBackpack['col_index'].items()}
+    if stat == 'Optimal':
+        milpModel['solution'] = solution
+    milpStats['status'] = stat
+
+    return stat, opt_val, solution, milpStats
+
+
+def _price_entries(milpBackpack):
+    # Eq. (3) row of each time step and position of its delta_in coefficient in a_value (-1 if zero)
+    rows = np.flatnonzero(milpBackpack['row_label'] == '3')
+    entries = np.full(len(rows), -1, dtype=np.int64)
+    # column of each matrix entry
+    a_col = np.repeat(np.arange(milpBackpack['num_col']), np.diff(milpBackpack['a_start']))
+    delta_in = np.zeros(milpBackpack['num_col'], dtype=bool)
+    delta_in[milpBackpack['col_index']['delta_in']] = True
+    found = np.flatnonzero((milpBackpack['row_label'][milpBackpack['a_index']] == '3') & delta_in[a_col])
+    entries[milpBackpack['row_step'][milpBackpack['a_index'][found]]] = found
+    return rows, entries
+
+
+def tariff_scenarios(dataset, varBackpack):
+    # price scenarios of the simple (1) and dual (2) tariffs, plus the dynamic one (3) if the household has it
+    priceScenarios = [{'name': 'tariff_1', 'networkPrice': list(dataset.price1), 'networkTariff': varBackpack['tariff_simple']},
+                      {'name': 'tariff_2', 'networkPrice': list(dataset.price2), 'networkTariff': varBackpack['tariff_dual']}]
+    if varBackpack['tariff'] == 3:
+        priceScenarios.append({'name': 'tariff_3', 'networkPrice': list(varBackpack['networkPrice']), 'networkTariff': 0})
+    return priceScenarios
+
+
+def ewh_price_sweep(dataset, varBackpack, priceScenarios, optSolver='HiGHS', solverPath=None, msg=True):
+    ## solves the same household for several price scenarios ({'name', 'networkPrice', 'networkTariff'}),
+    ## building the milp only once (build_milp_model), and returns one opt_output per scenario (in the same order).
+    ## networkPrice has one price per time step; networkTariff is 0 if not given (as in the dynamic tariff)
+
+    milpModel = build_milp_model(varBackpack, optSolver=optSolver, solverPath=solverPath, msg=msg)
+
+    sweepOutput = []
+    for k, scenario in enumerate(priceScenarios):
+        scenarioBackpack = dict(varBackpack)
+        scenarioBackpack['networkPrice'] = list(scenario['networkPrice'])
+        scenarioBackpack['networkTariff'] = scenario.get('networkTariff', 0)
+
+        stat, _, solution, milpStats = solve_milp_prices(milpModel, scenarioBackpack['networkPrice'], scenarioBackpack['networkTariff'])
+
+        opt_diagrams = solution_diagrams(dataset, solution)
+        opt_output = ewh_kpis(dataset, scenarioBackpack, opt_diagrams, msg=msg)
+        opt_output['milp_stats'] = milpStats
+        opt_output['price_scenario'] = scenario.get('name', k)
+        sweepOutput.append(opt_output)
+
+    return sweepOutput
+
+
+
+##############################################
+##             Asyncio Solvers              ##
+##############################################
+async def ewh_solver_async(dataset, varBackpack, optSolver='HiGHS', solverPath=None, warmStart=None, msg=True, diagnostics=None,
+                           solveSemaphore=None, executor=None):
+    # asyncio variant of ewh_solver (HiGHS, matrix model): the model build and the results run in executor (a thread pool,
+    # the loop default if None), and the solve is awaited. Same results as ewh_solver
+
+    start = None
+    if warmStart is not None:
+        start = await executor_call(executor, _warm_start, dataset, varBackpack, warmStart, diagnostics=diagnostics)
+
+    stat, opt_val, solution, milpStats = await solve_milp_async(varBackpack, optSolver=optSolver, solverPath=solverPath, start=start,
+                                                                msg=msg, diagnostics=diagnostics, solveSemaphore=solveSemaphore,
+                                                                executor=executor)
+
+    return await executor_call(executor, _solver_output, dataset, varBackpack, stat, opt_val, solution, milpStats, msg=msg,
+                               diagnostics=diagnostics)
+
+
+async def solve_milp_async(varBackpack, optSolver='HiGHS', solverPath=None, start=None, msg=True, diagnostics=None, solveSemaphore=None,
+                           executor=None):
+    # asyncio variant of solve_milp (matrix model), with the HiGHS python bindings or the HiGHS binary (as in solve_milp).
+    # solveSemaphore (an asyncio.Semaphore shared by the callers) limits the concurrent solves
+
+    # unpack some variables
+    daySim = varBackpack['daySim']
+
+    milpBackpack, modelSize = await executor_call(executor, _matrix_model, varBackpack, diagnostics=diagnostics)
+
+    if msg:
+        print('Running optimization for ' + str(daySim) + ' days.')
+
+    if solveSemaphore is not None:
+        await solveSemaphore.acquire()
+    try:
+        with diagnostics_stage(diagnostics, 'solve'):
+            if _highspy_solver(optSolver, solverPath):
+                stat, x, milpStats = await solve_milp_highspy_async(milpBackpack, timeLimit=_solver_time_limit(daySim), gapRel=0.015,
+                                                                    threads=1, msg=msg, start=start, executor=executor)
+            else:
+                with tempfile.TemporaryDirectory(prefix='ewh_flex_') as workDir:
+                    stat, x, milpStats = await solve_milp_highs_cmd_async(milpBackpack, os.path.join(workDir, 'thermo_milp.mps'),
+                                                                          solverPath=solverPath, timeLimit=_solver_time_limit(daySim),
+                                                                          gapRel=0.015, threads=1, msg=msg, start=start, executor=executor)
+    finally:
+        if solveSemaphore is not None:
+            solveSemaphore.release()
+    opt_val, solution = _matrix_solution(milpBackpack, stat, x)
+    milpStats['status'] = stat
+    _record_model_size(diagnostics, modelSize)
+
+    return stat, opt_val, solution, milpStats
+
+
+async def solve_milp_highs_cmd_async(milpBackpack, modelPath, solverPath=None, timeLimit=None, gapRel=None, threads=None, msg=True,
+                                     start=None, executor=None):
+    # asyncio variant of solve_milp_highs_cmd: the HiGHS binary runs as an asyncio subprocess (killed if the call is cancelled)
+
+    command, solverFiles = await executor_call(executor, _highs_cmd_files, milpBackpack, modelPath, solverPath=solverPath,
+                                                timeLimit=timeLimit, gapRel=gapRel, threads=threads, msg=msg, start=start)
+    try:
+        process = await asyncio.create_subprocess_exec(*command)
+        try:
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        if returncode == -1:
+            raise RuntimeError('Error while executing HiGHS.')
+        stat, x, milpStats = await executor_call(executor, _highs_cmd_results, milpBackpack, solverFiles, start)
+    finally:
+        _remove_files(solverFiles)
+
+    return stat, x, milpStats
+
+
+async def solve_milp_highspy_async(milpBackpack, timeLimit=None, gapRel=None, threads=None, msg=True, start=None, executor=None):
+    # asyncio variant of solve_milp_highspy: HiGHS runs in executor, and is interrupted if the call is cancelled
+    # (highspy versions without cancelSolve run until the time limit, the call only returns then)
+
+    h = await executor_call(executor, _highspy_model, milpBackpack, timeLimit=timeLimit, gapRel=gapRel, threads=threads, msg=msg)
+    onCancel = h.cancelSolve if hasattr(h, 'cancelSolve') else None
+
+    return await executor_call(executor, _highspy_run, h, milpBackpack, start=start, onCancel=onCancel)
+
@@ -1,21 +1,367 @@
-from .ewh_power_functions import (create_usage_dataset, real_ewh_load_estimator, convert_load_usage)
-from .ewh_opt_functions import (resample_data, build_varBackpack, update_dataset_backpack, linear_regressors, ewh_solver)
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import traceback
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from .auxiliary_functions import diagnostics_stage, executor_call
+from .read_data_functions import read_load_chunks, load_statistics, verify_1min_resolution_chunks
+from .ewh_power_functions import (create_usage_dataset, real_ewh_load_estimator, convert_load_usage, usage_blanks_stats,
+                                  convert_load_usage_chunks)
+from .ewh_opt_functions import (resample_data, build_varBackpack, update_dataset_backpack, linear_regressors, ewh_solver,
+                                ewh_rolling_solver, ewh_stream_solver, tariff_scenarios, ewh_price_sweep, ewh_solver_async,
+                                cancel_highspy_solves)
 
 ##############################################
 ##      Optimization Pipeline Function      ##
 ##############################################
 
-def ewh_optimization(params_input, dataset, resample = 'no', optSolver = 'HiGHS', solverPath=None):
-    varBackpack = build_varBackpack(params_input, dataset)
+def ewh_optimization(params_input, dataset, resample = 'no', optSolver = 'HiGHS', solverPath=None, modelBackend='matrix', exportModel=None,
+                     windowDays=None, commitDays=1, warmStart=None, solverMsg=True, traceMemory=False, diagnosticsHook=None,
+                     progressHook=None):
+    ## opt_output['diagnostics'] has the wall time (and peak memory, with traceMemory) of each stage, the model size and
+    ## the solver statistics. diagnosticsHook (e.g. a logger call) receives them at the end of the run, progressHook
+    ## receives the name of each stage when it starts, and solverMsg=False keeps the solver log and the results summary
+    ## out of stdout
+    diagnostics = {'stages': {}, 'model': {}, 'solver': {}, 'progress_hook': progressHook}
+    _start = time.perf_counter()
+    # peak memory through tracemalloc (slows down the run, so only on request)
+    traceMemory = traceMemory & (not tracemalloc.is_tracing())
+    if traceMemory:
+        tracemalloc.start()
+    try:
+        dataset, varBackpack = _household_backpack(params_input, dataset, resample, diagnostics=diagnostics)
+        if windowDays is None:
+            opt_output = ewh_solver(dataset, varBackpack, optSolver=optSolver, solverPath=solverPath, modelBackend=modelBackend, exportModel=exportModel,
+                                    warmStart=warmStart, msg=solverMsg, diagnostics=diagnostics)
+        else:
+            # rolling horizon (long simulation periods)
+            opt_output = ewh_rolling_solver(dataset, varBackpack, windowDays=windowDays, commitDays=commitDays, optSolver=optSolver,
+                                            solverPath=solverPath, modelBackend=modelBackend, warmStart=warmStart, msg=solverMsg,
+                                            diagnostics=diagnostics)
+    finally:
+        if traceMemory:
+            tracemalloc.stop()
+        diagnostics.pop('progress_hook')
+    diagnostics['solver'] = dict(opt_output['milp_stats'])
+    diagnostics['total_time'] = time.perf_counter() - _start
+    opt_output['diagnostics'] = diagnostics
+    if diagnosticsHook is not None:
+        diagnosticsHook(diagnostics)
+
+    return opt_output
+
+
+async def ewh_optimization_async(params_input, dataset, resample='no', optSolver='HiGHS', solverPath=None, warmStart=None, solverMsg=True,
+                                 timeout=None, solveSemaphore=None, executor=None, diagnosticsHook=None, progressHook=None):
+    ## asyncio variant of ewh_optimization (HiGHS solver, matrix model), with the same results. The data preparation, model
+    ## build and results run in executor (a thread pool, the loop default if None), and the solver in-process in the executor
+    ## (highspy) or, with solverPath, without highspy or with optSolver='HiGHS_CMD', as an asyncio subprocess. Cancelling the
+    ## call (or timeout, in seconds) stops the solver; the call returns once the stage being run has stopped. solveSemaphore
+    ## (asyncio.Semaphore, shared by the callers) limits the concurrent solves
+    if timeout is not None:
+        return await asyncio.wait_for(ewh_optimization_async(params_input, dataset, resample=resample, optSolver=optSolver,
+                                                             solverPath=solverPath, warmStart=warmStart, solverMsg=solverMsg,
+                                                             solveSemaphore=solveSemaphore, executor=executor,
+                                                             diagnosticsHook=diagnosticsHook, progressHook=progressHook), timeout)
+
+    diagnostics = {'stages': {}, 'model': {}, 'solver': {}, 'progress_hook': progressHook}
+    _start = time.perf_counter()
+    try:
+        dataset, varBackpack = await executor_call(executor, _household_backpack, params_input, dataset, resample, diagnostics=diagnostics)
+        opt_output = await ewh_solver_async(dataset, varBackpack, optSolver=optSolver, solverPath=solverPath, warmStart=warmStart,
+                                            msg=solverMsg, diagnostics=diagnostics, solveSemaphore=solveSemaphore, executor=executor)
+    finally:
+        diagnostics.pop('progress_hook')
+    diagnostics['solver'] = dict(opt_output['milp_stats'])
+    diagnostics['total_time'] = time.perf_counter() - _start
+    opt_output['diagnostics'] = diagnostics
+    if diagnosticsHook is not None:
+        diagnosticsHook(diagnostics)
+
+    return opt_output
+
+
+def ewh_price_sweep_optimization(params_input, dataset, priceScenarios=None, resample='no', optSolver='HiGHS', solverPath=None,
+                                 solverMsg=True):
+    ## optimizes the same household for several price scenarios, building the milp only once.
+    ## by default, the household is optimized for the simple and dual tariffs (and the dynamic one, if given)
+    dataset, varBackpack = _household_backpack(params_input, dataset, resample)
+    if priceScenarios is None:
+        priceScenarios = tariff_scenarios(dataset, varBackpack)
+    sweepOutput = ewh_price_sweep(dataset, varBackpack, priceScenarios, optSolver=optSolver, solverPath=solverPath, msg=solverMsg)
+
+    return sweepOutput
+
+
+def ewh_chunked_optimization(params_input, dataset_filePath, chunkDays=7, resample='15m', windowDays=2, commitDays=1, optSolver='HiGHS',
+                             solverPath=None, modelBackend='matrix', solverMsg=True, cacheRows=200000):
+    ## optimizes a load diagram file longer than a month (e.g. a year of 1-min readings) in rolling horizon, reading it
+    ## in chunks of chunkDays. only a few days of 1-min data are in memory at a time, and each window milp is solved on its own.
+    ## the load statistics, the average blank period and the verification/conversion/optimization are three passes over the
+    ## chunks: files up to cacheRows readings (and verified 1-min rows) are parsed and verified once, and kept in memory
+    ## between the passes, longer ones are read again on each pass
+    if params_input['load_diagram_exists'] != 1:
+        raise ValueError('The chunked optimization needs a load diagram file, please set load_diagram_exists to 1.')
+
+    fileCache = {'chunks': [], 'rows': 0}
+    verifiedCache = {'chunks': [], 'rows': 0}
+
+    def file_chunks():
+        if fileCache['chunks'] is not None:
+            return iter(fileCache['chunks'])
+        return read_load_chunks(dataset_filePath, chunkDays=chunkDays)
+
+    def verified_chunks():
+        if verifiedCache['chunks'] is not None:
+            return iter(verifiedCache['chunks'])
+        return verify_1min_resolution_chunks(file_chunks(), medianLoad, maxCarryDays=chunkDays)
+
+    medianLoad, heatingLoad = load_statistics(_cache_chunks(read_load_chunks(dataset_filePath, chunkDays=chunkDays), fileCache, cacheRows))
+    # the EWH power (if not given) is detected from the heating loads
+    varBackpack = build_varBackpack(params_input, heatingLoad)
+    blanksMean, lastBlankTime = usage_blanks_stats(_cache_chunks(verify_1min_resolution_chunks(file_chunks(), medianLoad,
+                                                                                               maxCarryDays=chunkDays),
+                                                                 verifiedCache, cacheRows), varBackpack)
+    opt_output = ewh_stream_solver(convert_load_usage_chunks(verified_chunks(), varBackpack, blanksMean, lastBlankTime), varBackpack,
+                                   resample=resample, windowDays=windowDays, commitDays=commitDays, optSolver=optSolver, solverPath=solverPath,
+                                   modelBackend=modelBackend, msg=solverMsg)
+
+    return opt_output
+
+
+def _cache_chunks(chunks, cache, maxRows):
+    # yields the chunks, keeping them in cache['chunks'] while they add up to at most maxRows rows (None past that)
+    for chunk in chunks:
+        if cache['chunks'] is not None:
+            cache['rows'] += len(chunk[2]) if isinstance(chunk, tuple) else len(chunk)
+            if cache['rows'] <= maxRows:
+                cache['chunks'].append(chunk)
+            else:
+                cache['chunks'] = None
+        yield chunk
+
+
+def _household_backpack(params_input, dataset, resample, diagnostics=None):
+    # usage/load diagrams, resampling and model parameters of a household (stages recorded in diagnostics, if given)
+    with diagnostics_stage(diagnostics, 'build_varBackpack'):
+        varBackpack = build_varBackpack(params_input, dataset)
     if varBackpack['load_diagram_exists'] == 0:
-        dataset = create_usage_dataset(dataset)
-        dataset['load'] = real_ewh_load_estimator(dataset, varBackpack)
+        with diagnostics_stage(diagnostics, 'create_usage_dataset'):
+            dataset = create_usage_dataset(dataset)
+        with diagnostics_stage(diagnostics, 'real_ewh_load_estimator'):
+            dataset['load'] = real_ewh_load_estimator(dataset, varBackpack)
     if varBackpack['load_diagram_exists'] == 1:
-        dataset['delta_use'] = convert_load_usage(dataset, varBackpack)
+        with diagnostics_stage(diagnostics, 'convert_load_usage'):
+            dataset['delta_use'] = convert_load_usage(dataset, varBackpack)
     if resample != 'no':
-        dataset = resample_data(dataset, resolution=resample)
-    dataset, varBackpack = update_dataset_backpack(dataset, varBackpack, resample)
-    varBackpack = linear_regressors(dataset, varBackpack)
-    opt_output = ewh_solver(dataset, varBackpack, optSolver=optSolver, solverPath=solverPath)
+        with diagnostics_stage(diagnostics, 'resample_data'):
+            dataset = resample_data(dataset, resolution=resample)
+    with diagnostics_stage(diagnostics, 'update_dataset_backpack'):
+        dataset, varBackpack = update_dataset_backpack(dataset, varBackpack, resample)
+    with diagnostics_stage(diagnostics, 'linear_regressors'):
+        varBackpack = linear_regressors(dataset, varBackpack)
+
+    return dataset, varBackpack
+
+
+##############################################
+##        Fleet Optimization Functions      ##
+##############################################
+
+def ewh_fleet_optimization(households, resample='no', optSolver='HiGHS', solverPath=None, modelBackend='matrix',
+                           windowDays=None, commitDays=1, warmStart=None, solverMsg=True, maxWorkers=None, maxPending=None):
+    ## optimizes many households (iterable of (params_input, dataset) pairs) in a pool of worker processes.
+    ## results are yielded as soon as each household is done (not in the input order), and only maxPending
+    ## households are read from the iterable ahead of the finished ones, to keep memory bounded.
+    ## a failed household is reported in its result, without stopping the others. if a worker process dies, the households
+    ## running in the pool at that time are reported as failed, and the next ones are optimized in a new pool
+
+    optKwargs = {'resample': resample, 'optSolver': optSolver, 'solverPath': solverPath, 'modelBackend': modelBackend,
+                 'windowDays': windowDays, 'commitDays': commitDays, 'warmStart': warmStart, 'solverMsg': solverMsg}
+    households = enumerate(households)
+
+    if maxWorkers is None:
+        maxWorkers = os.cpu_count() or 1
+    # twice the workers by default, so no worker waits for the next household
+    if maxPending is None:
+        maxPending = 2 * maxWorkers
+
+    executor = ProcessPoolExecutor(max_workers=maxWorkers)
+    pending = {}
+    exhausted = False
+    try:
+        while True:
+            # submit households until maxPending are running/queued
+            while (not exhausted) & (len(pending) < maxPending):
+                try:
+                    index, (params_input, dataset) = next(households)
+                except StopIteration:
+                    exhausted = True
+                    break
+                user = params_input.get('user', index)
+                try:
+                    future = executor.submit(_household_optimization, params_input, dataset, optKwargs)
+                except BrokenProcessPool:
+                    # a worker process died (its households are reported as failed below), the next ones go to a new pool
+                    executor.shutdown(wait=True)
+                    executor = ProcessPoolExecutor(max_workers=maxWorkers)
+                    future = executor.submit(_household_optimization, params_input, dataset, optKwargs)
+                pending[future] = (index, user)
+            if len(pending) == 0:
+                break
+            # wait for (at least) one household to finish
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, user = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    # the worker process itself failed
+                    result = {'status': 'failed', 'opt_output': None, 'error': traceback.format_exc(), 'elapsed': None}
+                result['index'] = index
+                result['user'] = user
+                yield result
+    finally:
+        # households still queued are dropped if the results are no longer consumed
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _household_optimization(params_input, dataset, optKwargs):
+    # full pipeline for a single household (runs in a worker process)
+    start = time.perf_counter()
+    try:
+        opt_output = ewh_optimization(params_input, dataset, **optKwargs)
+        result = {'status': 'optimized', 'opt_output': opt_output, 'error': None}
+    except Exception:
+        result = {'status': 'failed', 'opt_output': None, 'error': traceback.format_exc()}
+    result['elapsed'] = time.perf_counter() - start
+
+    return result
+
+
+def fleet_summary(fleetResults):
+    # aggregated indicators of the households optimized by ewh_fleet_optimization
+
+    optimized = [result for result in fleetResults if result['status'] == 'optimized']
+    failed = [result for result in fleetResults if result['status'] != 'optimized']
+
+    summary = {}
+    summary['households'] = len(optimized) + len(failed)
+    summary['optimized'] = len(optimized)
+    summary['failed'] = len(failed)
+    summary['failed_users'] = [result['user'] for result in failed]
+    for key in ['original_price', 'optimized_price', 'savings_cost', 'original_load', 'optimized_load', 'savings_energy',
+                'total_flexibility']:
+        summary[key] = sum(result['opt_output'][key] for result in optimized)
+    # average flexibility per household
+    summary['perc_flexibility'] = (sum(result['opt_output']['perc_flexibility'] for result in optimized) / len(optimized)
+                                   if len(optimized) > 0 else None)
+    # total optimization time (sum over the workers)
+    summary['elapsed'] = sum(result['elapsed'] for result in fleetResults if result['elapsed'] is not None)
+
+    return summary
+
+
+##############################################
+##        Background Optimization Jobs      ##
+##############################################
+# pipeline stages in the order they start (progressHook), for progress bars
+OPTIMIZATION_STAGES = ['build_varBackpack', 'create_usage_dataset', 'real_ewh_load_estimator', 'convert_load_usage', 'resample_data',
+                       'update_dataset_backpack', 'linear_regressors', 'warm_start', 'build_model', 'export_model', 'solve', 'results']
+
+
+def start_optimization_job(params_input, dataset, **optKwargs):
+    ## runs ewh_optimization in a separate process (e.g. behind a GUI), and returns the job backpack.
+    ## poll_optimization_job updates it with the stages already started and the result, and
+    ## cancel_optimization_job stops it (including the HiGHS binary, if it is solving)
+    # spawn, a fork of the (multi-threaded) GUI server is not safe
+    context = multiprocessing.get_context('spawn')
+    progressQueue = context.Queue()
+    process = context.Process(target=_optimization_job_worker, args=(params_input, dataset, optKwargs, progressQueue), daemon=True)
+    process.start()
+
+    job = {'process': process, 'queue': progressQueue, 'status': 'running', 'stage': None, 'progress': 0.0,
+           'opt_output': None, 'error': None, 'start': time.perf_counter(), 'elapsed': None}
+
+    return job
+
+
+def poll_optimization_job(job):
+    # reads the messages of the job process (without waiting), and returns the job status
+    # ('running', 'optimized', 'failed', 'cancelling' or 'cancelled')
+    if job['status'] == 'cancelling':
+        # a cancelled job process is reaped once it has stopped, and killed past its grace period
+        if job['process'].is_alive():
+            if time.perf_counter() >= job['kill_time']:
+                job['process'].kill()
+            return job['status']
+        job['process'].join()
+        job['status'] = 'cancelled'
+        job['elapsed'] = time.perf_counter() - job['start']
+    if job['status'] != 'running':
+        return job['status']
+    alive = job['process'].is_alive()
+    while True:
+        try:
+            # a finished process has already sent everything
+            kind, value = job['queue'].get(timeout=0.1) if not alive else job['queue'].get_nowait()
+        except queue.Empty:
+            break
+        if kind == 'stage':
+            job['stage'] = value
+            if value in OPTIMIZATION_STAGES:
+                job['progress'] = max(job['progress'], OPTIMIZATION_STAGES.index(value) / len(OPTIMIZATION_STAGES))
+        elif kind == 'optimized':
+            job['status'], job['opt_output'], job['progress'] = 'optimized', value, 1.0
+        else:
+            job['status'], job['error'] = 'failed', value
+    if (job['status'] == 'running') & (not alive):
+        job['status'], job['error'] = 'failed', 'The optimization process stopped (exit code ' + str(job['process'].exitcode) + ').'
+    if job['status'] != 'running':
+        job['elapsed'] = time.perf_counter() - job['start']
+        job['process'].join()
+
+    return job['status']
+
+
+def cancel_optimization_job(job, gracePeriod=5, wait=True):
+    # stops a running job. the job process is killed if it has not stopped gracePeriod (seconds) after the terminate.
+    # with wait=False, the job process is only signalled ('cancelling'), and poll_optimization_job reaps it ('cancelled')
+    if job['status'] == 'running':
+        job['process'].terminate()
+        job['status'] = 'cancelling'
+        job['kill_time'] = time.perf_counter() + gracePeriod
+    if wait & (job['status'] == 'cancelling'):
+        job['process'].join(max(job['kill_time'] - time.perf_counter(), 0))
+        if job['process'].is_alive():
+            job['process'].kill()
+            job['process'].join()
+        poll_optimization_job(job)
+
+    return job['status']
+
+
+def _optimization_job_worker(params_input, dataset, optKwargs, progressQueue):
+    # full pipeline in the job process, sending each stage and the result (or the error) through progressQueue
+    # on terminate, SystemExit stops the solver subprocess as well. an in-process solve runs the handler in its
+    # interrupt callbacks, where it is cancelled before the SystemExit
+    signal.signal(signal.SIGTERM, _terminate_job)
+    try:
+        opt_output = ewh_optimization(params_input, dataset, progressHook=lambda stage: progressQueue.put(('stage', stage)), **optKwargs)
+        progressQueue.put(('optimized', opt_output))
+    except Exception:
+        progressQueue.put(('failed', traceback.format_exc()))
+
+
+def _terminate_job(signum, frame):
+    cancel_highspy_solves()
+    raise SystemExit(1)
 
-    return opt_output
@@ -4,10 +4,8 @@
 
 import pandas as pd
 import numpy as np
-import math
-import datetime
 
-from .auxiliary_functions import round_up_hundred
+from .auxiliary_functions import round_up_hundred, run_length_encode
 
 
 ##############################################
@@ -24,16 +22,29 @@ def create_usage_dataset(waterUsage):
     dataset = pd.DataFrame(pd.date_range(firstUsage, lastUsage, freq='min'), columns=['timestamp'])
     # delete last row (midnight of next day)
     dataset = dataset[:-1]
-    # add delta_use column
-    dataset['delta_use'] = 0
 
-    # mark periods of usage
-    for i in range(0,len(waterUsage)):
-        _start = pd.to_datetime(waterUsage.loc[i,'start'])
-        _duration = int(waterUsage.loc[i,'duration'])
-        _end = _start + pd.DateOffset(minutes=_duration-1)
-        _period = pd.date_range(_start, _end, freq='min')
-        dataset.loc[dataset['timestamp'].isin(list(_period)),'delta_use'] = 1
+    # map each usage to integer minute offsets on the dataset grid
+    _grid_start = dataset['timestamp'].iloc[0].to_datetime64()
+    try:
+        _start = pd.to_datetime(waterUsage['start'])
+    except (ValueError, TypeError):
+        # mixed formats, parse each usage on its own
+        _start = waterUsage['start'].map(pd.to_datetime)
+    _start = _start.to_numpy(dtype='datetime64[ns]')
+    _offset = (_start - _grid_start).astype(np.int64)
+    # only usages starting at a full minute fall on the grid
+    _on_grid = (_offset % 60_000_000_000) == 0
+    _first = _offset[_on_grid] // 60_000_000_000
+    _last = _first + np.maximum(waterUsage['duration'].astype(int).to_numpy()[_on_grid], 0)
+    # clip to the dataset length
+    _first = np.clip(_first, 0, len(dataset))
+    _last = np.clip(_last, 0, len(dataset))
+
+    # mark periods of usage via a difference array
+    _marks = np.zeros(len(dataset) + 1, dtype=np.int64)
+    np.add.at(_marks, _first, 1)
+    np.add.at(_marks, _last, -1)
+    dataset['delta_use'] = (np.cumsum(_marks[:-1]) > 0).astype(np.int64)
 
     return dataset
 
@@ -44,6 +55,14 @@ def create_usage_dataset(waterUsage):
 ##############################################
 def real_ewh_load_estimator(dataset, varBackpack):
 
+    # simulate the non-optimized thermostat and keep the resulting load
+    dataset = simulate_ewh_thermostat(dataset, varBackpack)
+
+    return dataset['load']
+
+
+def simulate_ewh_thermostat(dataset, varBackpack):
+
     # unpack some variables
     ewh_capacity = varBackpack['ewh_capacity']
     tempSet = varBackpack['tempSet']
@@ -59,56 +78,85 @@ def real_ewh_load_estimator(dataset, varBackpack):
 
     dataset = dataset[['timestamp','delta_use']].copy()
 
-    # ewh starts off
-    delta_in = 0
     # assumes 1min resolution
     delta_t = 1/60
+    # run the thermostat kernel over plain arrays (no per-minute pandas indexing)
+    simulation = _thermostat_kernel(dataset['delta_use'].tolist(), ewh_capacity, tempSet, temp_inlet, waterHeatCap,
+                                    flow_rate_min, wh_init, heatTransferCoeff, ewh_area, ambTemp, ewh_std_temp,
+                                    ewh_power, delta_t)
 
-    for t in range(len(dataset)):
-        if t == 0:
-            w_tot = wh_init
-        else:
-            w_water_prev = dataset.loc[t-1, 'w_water']
-            w_in_prev = dataset.loc[t-1, 'w_in']
-            w_loss_prev = dataset.loc[t-1, 'w_loss']
-            w_tot = w_water_prev + w_in_prev - w_loss_prev
+    # fill variables in dataset
+    for col, values in simulation.items():
+        dataset[col] = values
 
-        temp = (w_tot * 3600 / (delta_t * 60)) / (ewh_capacity * waterHeatCap)
-        ewh_flow = flow_rate_min * (tempSet-temp_inlet)/(temp-temp_inlet)
-        delta_use = dataset.loc[t, 'delta_use']
+    return dataset
+
+
+def _thermostat_kernel(delta_use, ewh_capacity, tempSet, temp_inlet, waterHeatCap, flow_rate_min, wh_init,
+                       heatTransferCoeff, ewh_area, ambTemp, ewh_std_temp, ewh_power, delta_t):
+
+    # preallocate output arrays
+    n = len(delta_use)
+    w_water_arr = np.empty(n)
+    w_in_arr = np.empty(n)
+    w_loss_arr = np.empty(n)
+    w_tot_arr = np.empty(n)
+    temp_arr = np.empty(n)
+    delta_in_arr = np.empty(n)
+    load_arr = np.empty(n)
+
+    # constant terms (same floating point operations as the per-minute formulas)
+    temp_div = delta_t * 60
+    temp_cap = ewh_capacity * waterHeatCap
+    mix_flow = flow_rate_min * (tempSet-temp_inlet)
+    heat_ratio = waterHeatCap/3600
+    loss_coeff = heatTransferCoeff * ewh_area
+    power_dt = ewh_power * delta_t
+    low_temp = ewh_std_temp-3
+
+    # ewh starts off
+    delta_in = 0
+    w_tot = wh_init
+
+    for t in range(n):
+        temp = (w_tot * 3600 / temp_div) / temp_cap
 
         # guarantees that the ewh turns on when reaching 5ºC below working temperature
         # and turns off when reaching working temperature
-        if (temp < (ewh_std_temp-3)):
+        if temp < low_temp:
             delta_in = 1
-        if (temp >= ewh_std_temp):
+        if temp >= ewh_std_temp:
             delta_in = 0
 
         # calculates stored energy after mixing water with inlet
-        if delta_use == 1:
+        if delta_use[t] == 1:
             if temp > tempSet:
-                w_water = ((ewh_capacity-ewh_flow)*temp + ewh_flow*temp_inlet) * (waterHeatCap/3600)
+                ewh_flow = mix_flow/(temp-temp_inlet)
+                w_water = ((ewh_capacity-ewh_flow)*temp + ewh_flow*temp_inlet) * heat_ratio
             else:
-                w_water = ((ewh_capacity-flow_rate_min)*temp + flow_rate_min*temp_inlet) * (waterHeatCap/3600)
+                w_water = ((ewh_capacity-flow_rate_min)*temp + flow_rate_min*temp_inlet) * heat_ratio
         else:
             w_water = (temp * ewh_capacity * waterHeatCap / 3600)
 
         # calculate thermal losses
-        w_loss = (heatTransferCoeff * ewh_area * ((temp - ambTemp)) * delta_t)
+        w_loss = (loss_coeff * ((temp - ambTemp)) * delta_t)
 
         # calculate input energy (on/off)
-        w_in = ewh_power * delta_t * delta_in
+        w_in = power_dt * delta_in
 
-        # fill variables in dataset
-        dataset.loc[t, 'w_water'] = w_water
-        dataset.loc[t, 'w_in'] = w_in
-        dataset.loc[t, 'w_loss'] = w_loss
-        dataset.loc[t, 'w_tot'] = w_tot
-        dataset.loc[t, 'temp'] = temp
-        dataset.loc[t, 'delta_in'] = delta_in
-        dataset.loc[t, 'load'] = delta_in * ewh_power * 1000
+        w_water_arr[t] = w_water
+        w_in_arr[t] = w_in
+        w_loss_arr[t] = w_loss
+        w_tot_arr[t] = w_tot
+        temp_arr[t] = temp
+        delta_in_arr[t] = delta_in
+        load_arr[t] = delta_in * ewh_power * 1000
 
-    return dataset['load']
+        # energy balance for the next minute
+        w_tot = w_water + w_in - w_loss
+
+    return {'w_water': w_water_arr, 'w_in': w_in_arr, 'w_loss': w_loss_arr, 'w_tot': w_tot_arr,
+            'temp': temp_arr, 'delta_in': delta_in_arr, 'load': load_arr}
 
 
 
@@ -116,6 +164,10 @@ def real_ewh_load_estimator(dataset, varBackpack):
 ##        EWH Spec Power Detection          ##
 ##############################################
 def ewh_power_detection(dataset):
+    # dataset is a load diagram (timestamp, load), or the count of each load value (as in load_statistics)
+    if isinstance(dataset, pd.Series):
+        return _ewh_power_detection_counts(dataset)
+
     _temp_load = pd.DataFrame(dataset.copy())
     _temp_load.columns = ['timestamp','load']
     _temp_load['timestamp'] = pd.to_datetime(_temp_load['timestamp'], utc=True)
@@ -130,6 +182,29 @@ def ewh_power_detection(dataset):
     return _ewh_estimated_power
 
 
+def _ewh_power_detection_counts(counts):
+    # ewh_power_detection on the count of each load value (value: count)
+    _load = counts.index.to_numpy(dtype=float)
+    _count = counts.to_numpy()
+
+    # delete observations where load is low
+    _keep = _load > (0.15 * _load.max()/.95)
+    _load, _count = _load[_keep], _count[_keep]
+    # filter out bottom and top 10% values (linear interpolation, as in pandas quantile)
+    _order = np.argsort(_load)
+    _load, _count = _load[_order], _count[_order]
+    _cumulative = np.cumsum(_count)
+    _quantile = []
+    for q in [0.1, 0.9]:
+        _position = (_cumulative[-1] - 1) * q
+        _low, _high = _load[np.searchsorted(_cumulative, [np.floor(_position), np.ceil(_position)], side='right')]
+        _quantile.append(_low + (_high - _low) * (_position - np.floor(_position)))
+    _keep = (_load >= _quantile[0]) & (_load <= _quantile[1])
+    # estimated load is the average of the selected observations
+    _ewh_estimated_power = round_up_hundred(np.sum(_load[_keep] * _count[_keep]) / np.sum(_count[_keep])/.9)
+    return _ewh_estimated_power
+
+
 
 ##############################################
 ##         Convert Load to Usage            ##
@@ -138,14 +213,70 @@ def convert_load_usage(dataset, varBackpack):
 
     # unpack some variables
     ewh_power = varBackpack['ewh_power_original']
-    ewh_max_temp = varBackpack['ewh_max_temp']
-    temp_set = varBackpack['tempSet']
 
     # dataset copy
     _temp_load = pd.DataFrame(dataset.copy())
     _temp_load.columns = ['timestamp','load']
     _temp_load['timestamp'] = pd.to_datetime(_temp_load['timestamp'], utc=True)
 
+    # variable that flags EWH heating
+    _temp_load['heating'] = _heating_flag(_temp_load['load'], ewh_power)
+
+
+    # split the heating flag into consecutive heating/blank blocks (run-length encoding)
+    _timestamps = _temp_load['timestamp'].to_numpy(dtype='datetime64[ns]')
+    _starts, _ends, _values = run_length_encode(_temp_load['heating'].to_numpy())
+    # total minutes of each block (from its first to its last instance)
+    _block_time = _minutes(_timestamps[_ends] - _timestamps[_starts])
+    # only blocks followed by another block are closed
+    _closed = np.arange(len(_starts)) < len(_starts) - 1
+
+
+    # 1st step: detect average duration of periods between automatic re-heating
+    # objective, disregard periods where the EWH activates without water usage
+    # list of blank blocks duration
+    blanks_list = _block_time[(_values == 0) & _closed]
+    # only saves blocks if larger than 90min
+    # blanks_list = blanks_list[blanks_list > 90]
+    blanks_mean = blanks_list.mean() if len(blanks_list) > 0 else np.nan
+
+    # 2nd step: convert each closed heating block into a water usage block
+    _heating_blocks = np.flatnonzero((_values == 1) & _closed)
+    # duration of the blank block right before each heating block. a load diagram starting with heating has no blank
+    # before its first block, and keeps the last blank block of the 1st step (as the original loops did)
+    blank_time = np.where(_heating_blocks > 0, _block_time[np.maximum(_heating_blocks - 1, 0)], _last_blank(blanks_list))
+    _start, _end = _usage_periods(_timestamps[_starts[_heating_blocks]], _block_time[_heating_blocks], blank_time, blanks_mean, varBackpack)
+
+    # variable that flags water usage
+    _temp_load['usage'] = _mark_usage(_timestamps, _start, _end)
+
+    return _temp_load['usage']
+
+
+def _last_blank(blanks_list):
+    # minutes of the last closed blank block (NaN if none, where the original loops raised an UnboundLocalError)
+    return blanks_list[-1] if len(blanks_list) > 0 else np.nan
+
+
+def _heating_flag(load, ewh_power):
+    # flags the instances where the EWH is heating (kilowatts with 90% efficiency)
+    ewh_power = 0.9 * ewh_power/1000
+    return ((load / 100) > (ewh_power / 5)).astype(np.int64).to_numpy()
+
+
+def _minutes(timedelta):
+    # timedelta64 array in (whole) minutes
+    return (timedelta.astype(np.int64) / 1e9 / 60).astype(np.int64)
+
+
+def _usage_periods(block_start, heating_time, blank_time, blanks_mean, varBackpack):
+    # start and end of the water usage of each closed heating block (only if it is flagged as usage)
+
+    # unpack some variables
+    ewh_power = varBackpack['ewh_power_original']
+    ewh_max_temp = varBackpack['ewh_max_temp']
+    temp_set = varBackpack['tempSet']
+
     # required data
     ewh_power = 0.9 * ewh_power/1000  # kilowatts with 90% efficiency
     ewh_max_temp = 0.9 * ewh_max_temp # assumes 80% of max temperature
@@ -165,77 +296,103 @@ def convert_load_usage(dataset, varBackpack):
     # calculates heating per minute
     w_in = ewh_power * delta_t
 
-    # variable that flags EWH heating
-    _temp_load['heating'] = 0
-    _temp_load.loc[(_temp_load['load'] / 100) > (ewh_power / 5), 'heating'] = 1
-
-
-    # 1st step: detect average duration of periods between automatic re-heating
-    # objective, disregard periods where the EWH activates without water usage
-    # auxiliary variable for flagging blanks blocks
-    blank = 0
-    # list of blank blocks duration
-    blanks_list = list()
-    for i in range(0, len(_temp_load)):
-        if (_temp_load.loc[i, 'heating'] == 0) & (blank == 0):
-            _start = _temp_load.loc[i, 'timestamp']
-            blank = 1
-            # flag instance as heating
-            continue
-
-        if (_temp_load.loc[i, 'heating'] == 1) & (blank == 1):
-            _end = _temp_load.loc[i - 1, 'timestamp']
-            blank = 0
-            # calculate total minutes of blank
-            blank_time = int((_end - _start).total_seconds() / 60)
-            # only saves blocks if larger than 90min
-            # if blank_time > 90:
-            #     blanks_list.append(blank_time)
-            blanks_list.append(blank_time)
+    # calculate total minutes of usage via formula
+    usage_time_float = heating_time / (1 + ((ewh_max_temp * flow_ewh * waterHeatCap) / (3600 * w_in)))
+    # save int/ceiled version
+    usage_time = np.ceil(usage_time_float).astype(np.int64)
+    # only flags if blank is less than 90% of average, and higher than 1 min, or just higher than 2 min
+    _flag = ((blank_time < blanks_mean*0.9) & (usage_time_float > 1)) | (usage_time_float > 2)
+    # extract start and end of usage (subtract one, since start date already included)
+    _start = block_start[_flag]
+    _end = _start + (usage_time[_flag] - 1).astype('timedelta64[m]')
 
-    blanks_list = np.array(blanks_list)
-
-    blank = 0
-    heating = 0
-    # variable that flags water usage
-    _temp_load['usage'] = 0
-    for i in range(0, len(_temp_load)):
+    return _start, _end
 
-        if (_temp_load.loc[i, 'heating'] == 0) & (blank == 0):
-            _start_blank = _temp_load.loc[i, 'timestamp']
-            blank = 1
-            # flag instance as heating
 
-        if (_temp_load.loc[i, 'heating'] == 1) & (blank == 1):
-            _end_blank = _temp_load.loc[i - 1, 'timestamp']
-            blank = 0
-            # calculate total minutes of blank
-            blank_time = int((_end_blank - _start_blank).total_seconds() / 60)
+def _mark_usage(timestamps, start, end):
+    # flags the (sorted) timestamps inside the usage periods, via a difference array
+    _usage = np.zeros(len(timestamps) + 1, dtype=np.int64)
+    np.add.at(_usage, np.searchsorted(timestamps, start, side='left'), 1)
+    np.add.at(_usage, np.searchsorted(timestamps, end, side='right'), -1)
+    return (np.cumsum(_usage[:-1]) > 0).astype(np.int64)
 
 
-        if (_temp_load.loc[i, 'heating'] == 1) & (heating == 0):
-            _start = _temp_load.loc[i, 'timestamp']
-            heating = 1
-            # flag instance as heating
+def _heating_block_chunks(chunks, varBackpack, lastBlankTime=np.nan):
+    ## splits the chunks of a load diagram into heating/blank blocks, with the last block of each chunk carried over
+    ## to the next one (a heating block keeps its rows until it is closed). yields the rows of the closed blocks,
+    ## their closed heating blocks (start, minutes, minutes of the blank block before) and the minutes of the closed blank blocks.
+    ## a first heating block (no blank before it) takes lastBlankTime, as in convert_load_usage
+    ewh_power = varBackpack['ewh_power_original']
+    _held = None
+    _open = None
+    _blank_time = lastBlankTime
+    for rows in chunks:
+        if len(rows) == 0:
             continue
-
-        if (_temp_load.loc[i, 'heating'] == 0) & (heating == 1):
-            _end = _temp_load.loc[i - 1, 'timestamp']
-            heating = 0
-            # calculate total minutes of heating
-            heating_time = int((_end - _start).total_seconds() / 60)
-            # calculate total minutes of usage via formula
-            usage_time = heating_time / (1 + ((ewh_max_temp * flow_ewh * waterHeatCap) / (3600 * w_in)))
-            # save float version
-            usage_time_float = usage_time
-            # save int/ceiled version
-            usage_time = math.ceil(usage_time)
-            # extract end of usage (subtract one, since start date already included)
-            _end = _start + datetime.timedelta(minutes=(usage_time - 1))
-            # only flags if blank is less than 90% of average, and higher than 1 min, or just higher than 2 min
-            if ((blank_time < blanks_list.mean()*0.9) & (usage_time_float > 1)) | (usage_time_float > 2):
-                # flag as using water
-                _temp_load.loc[(_temp_load['timestamp'] >= _start) & (_temp_load['timestamp'] <= _end), 'usage'] = 1
+        rows = rows[['timestamp', 'load']].reset_index(drop=True)
+        _timestamps = pd.to_datetime(rows['timestamp'], utc=True).to_numpy(dtype='datetime64[ns]')
+        _starts, _ends, _values = run_length_encode(_heating_flag(rows['load'], ewh_power))
+        _block_start = _timestamps[_starts]
+        _block_end = _timestamps[_ends]
+        # the open block of the previous chunk goes on, or is closed by the first block of this one
+        if _open is not None:
+            if _open[0] == _values[0]:
+                _block_start[0] = _open[1]
+            else:
+                _values = np.r_[_open[0], _values]
+                _block_start = np.r_[_open[1], _block_start]
+                _block_end = np.r_[_open[2], _block_end]
+        _block_time = _minutes(_block_end - _block_start)
+        # minutes of the block before each block (the last closed blank block, for the first one)
+        _previous_time = np.r_[_blank_time, _block_time[:-1]]
+
+        # all blocks are closed, except the last
+        _heating = np.flatnonzero(_values[:-1] == 1)
+        _blanks = _block_time[:-1][_values[:-1] == 0]
+        if len(_blanks) > 0:
+            _blank_time = _blanks[-1]
+        _open = (_values[-1], _block_start[-1], _block_end[-1])
+
+        # the rows of an open heating block are held until it is closed
+        if _held is not None:
+            rows = pd.concat([_held, rows], ignore_index=True)
+            _timestamps = np.r_[_held['timestamp'].to_numpy(dtype='datetime64[ns]'), _timestamps]
+        _split = np.searchsorted(_timestamps, _block_start[-1]) if _values[-1] == 1 else len(rows)
+        _held = rows.iloc[_split:].reset_index(drop=True) if _split < len(rows) else None
+
+        yield rows.iloc[:_split], _block_start[_heating], _block_time[_heating], _previous_time[_heating], _blanks
+
+    # the last block is never closed
+    if _held is not None:
+        yield _held, np.array([], dtype='datetime64[ns]'), np.array([], dtype=np.int64), np.array([]), np.array([], dtype=np.int64)
+
+
+def usage_blanks_mean(chunks, varBackpack):
+    ## average duration of the periods between automatic re-heating (1st step of convert_load_usage), over load diagram chunks
+    return usage_blanks_stats(chunks, varBackpack)[0]
+
+
+def usage_blanks_stats(chunks, varBackpack):
+    ## average duration of the periods between automatic re-heating (1st step of convert_load_usage), over load diagram chunks,
+    ## and the duration of the last one (the blank before a load diagram that starts with heating, in convert_load_usage)
+    _total = 0
+    _count = 0
+    _last = np.nan
+    for rows, block_start, heating_time, blank_time, blanks_list in _heating_block_chunks(chunks, varBackpack):
+        _total += int(blanks_list.sum())
+        _count += len(blanks_list)
+        _last = _last_blank(blanks_list) if len(blanks_list) > 0 else _last
+
+    return (_total / _count if _count > 0 else np.nan), _last
+
+
+def convert_load_usage_chunks(chunks, varBackpack, blanksMean, lastBlankTime=np.nan):
+    ## convert_load_usage over load diagram chunks, with the average and last blank periods of usage_blanks_stats.
+    ## yields the chunks (timestamp, load) with the water usage flags in delta_use
+    for rows, block_start, heating_time, blank_time, blanks_list in _heating_block_chunks(chunks, varBackpack, lastBlankTime):
+        if len(rows) == 0:
             continue
-
-    return _temp_load['usage']
\ No newline at end of file
+        _start, _end = _usage_periods(block_start, heating_time, blank_time, blanksMean, varBackpack)
+        rows = rows.copy()
+        rows['delta_use'] = _mark_usage(rows['timestamp'].to_numpy(dtype='datetime64[ns]'), _start, _end)
+        yield rows
@@ -0,0 +1,213 @@
+##############################################
+##         Local Optimization Job Queue     ##
+##############################################
+# optimization jobs are stored in a local SQLite file (no broker), so the GUI sessions (or any other process) only
+# submit jobs and poll them, while a single pool of workers runs them: at most numWorkers solves at the same time,
+# each in its own process (and solver temp dir), in the order they were submitted.
+#
+#   python -m ewh_flex.job_queue_functions --db ./output/jobs.sqlite --workers 4
+
+import argparse
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+
+from .ewh_opt_pipeline import start_optimization_job, poll_optimization_job, cancel_optimization_job
+
+# job statuses ('cancelling' is a running job waiting for its worker to stop it)
+JOB_STATUSES = ['queued', 'running', 'cancelling', 'optimized', 'failed', 'cancelled']
+
+_JOBS_TABLE = '''CREATE TABLE IF NOT EXISTS jobs (
+                     id TEXT PRIMARY KEY, status TEXT NOT NULL, params BLOB, dataset BLOB, options BLOB, result BLOB, error TEXT,
+                     stage TEXT, progress REAL DEFAULT 0, submitted REAL, started REAL, finished REAL, worker INTEGER)'''
+
+
+def _connect(dbPath):
+    # autocommit connection (transactions are explicit), waiting for the locks of the other processes
+    if os.path.dirname(dbPath) != '':
+        os.makedirs(os.path.dirname(dbPath), exist_ok=True)
+    db = sqlite3.connect(dbPath, timeout=30, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute(_JOBS_TABLE)
+    db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, submitted)')
+    return db
+
+
+##############################################
+##            Job Submission / Polling      ##
+##############################################
+def submit_job(dbPath, params_input, dataset, **optKwargs):
+    # queues an optimization (same arguments as ewh_optimization), and returns the job id
+    jobId = uuid.uuid4().hex
+    db = _connect(dbPath)
+    try:
+        db.execute('INSERT INTO jobs (id, status, params, dataset, options, submitted) VALUES (?, ?, ?, ?, ?, ?)',
+                   (jobId, 'queued', pickle.dumps(params_input), pickle.dumps(dataset), pickle.dumps(optKwargs), time.time()))
+    finally:
+        db.close()
+
+    return jobId
+
+
+def job_status(dbPath, jobId):
+    # status of a job: status, current stage, progress (0-1), error, elapsed time (s) and position in the queue
+    db = _connect(dbPath)
+    try:
+        row = db.execute('SELECT status, stage, progress, error, submitted, started, finished FROM jobs WHERE id = ?', (jobId,)).fetchone()
+        if row is None:
+            raise ValueError(f'Unknown job {jobId}, please check the job id.')
+        status = dict(row)
+        # jobs queued before this one
+        status['position'] = (db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND submitted < ?",
+                                          (row['submitted'],)).fetchone()[0] if row['status'] == 'queued' else 0)
+    finally:
+        db.close()
+    status['elapsed'] = (None if status['started'] is None else (status['finished'] or time.time()) - status['started'])
+
+    return status
+
+
+def job_result(dbPath, jobId):
+    # opt_output of an optimized job (None otherwise)
+    db = _connect(dbPath)
+    try:
+        row = db.execute('SELECT result FROM jobs WHERE id = ?', (jobId,)).fetchone()
+    finally:
+        db.close()
+    if (row is None) or (row['result'] is None):
+        return None
+
+    return pickle.loads(row['result'])
+
+
+def cancel_job(dbPath, jobId):
+    # a queued job is cancelled at once, a running one is stopped by its worker (on the next poll)
+    db = _connect(dbPath)
+    try:
+        db.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status = 'queued'", (time.time(), jobId))
+        db.execute("UPDATE jobs SET status = 'cancelling' WHERE id = ? AND status = 'running'", (jobId,))
+    finally:
+        db.close()
+
+
+def delete_job(dbPath, jobId):
+    # removes a finished job (and its stored result) from the queue
+    db = _connect(dbPath)
+    try:
+        db.execute("DELETE FROM jobs WHERE id = ? AND status IN ('optimized', 'failed', 'cancelled')", (jobId,))
+    finally:
+        db.close()
+
+
+##############################################
+##              Worker Pool                 ##
+##############################################
+def run_job_workers(dbPath, numWorkers=None, pollInterval=0.5, stopEvent=None):
+    ## runs the queued jobs, with at most numWorkers optimizations at the same time (one per core by default,
+    ## the solver runs with a single thread), until stopEvent is set. The running jobs are cancelled on stop.
+    ## jobs left running by a worker pool that stopped abruptly are queued again
+    if numWorkers is None:
+        numWorkers = os.cpu_count() or 1
+    db = _connect(dbPath)
+    _requeue_orphan_jobs(db)
+
+    running = {}
+    try:
+        while (stopEvent is None) or (not stopEvent.is_set()):
+            # start the queued jobs while there are free workers
+            while len(running) < numWorkers:
+                row = _claim_job(db)
+                if row is None:
+                    break
+                running[row['id']] = start_optimization_job(pickle.loads(row['params']), pickle.loads(row['dataset']),
+                                                            **pickle.loads(row['options']))
+
+            for jobId, job in list(running.items()):
+                # the job process is only signalled, and reaped on a later poll (the other jobs keep being polled)
+                if db.execute('SELECT status FROM jobs WHERE id = ?', (jobId,)).fetchone()['status'] == 'cancelling':
+                    cancel_optimization_job(job, wait=False)
+                status = poll_optimization_job(job)
+                if status in ['running', 'cancelling']:
+                    db.execute('UPDATE jobs SET stage = ?, progress = ? WHERE id = ?', (job['stage'], job['progress'], jobId))
+                    continue
+                result = pickle.dumps(job['opt_output']) if status == 'optimized' else None
+                db.execute('UPDATE jobs SET status = ?, stage = ?, progress = ?, result = ?, error = ?, finished = ?, '
+                           'params = NULL, dataset = NULL WHERE id = ?',
+                           (status, job['stage'], job['progress'], result, job['error'], time.time(), jobId))
+                del running[jobId]
+
+            time.sleep(pollInterval)
+    finally:
+        # all the running jobs are signalled at once, so they stop within a single grace period
+        for job in running.values():
+            cancel_optimization_job(job, wait=False)
+        for jobId, job in running.items():
+            cancel_optimization_job(job)
+            db.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ?", (time.time(), jobId))
+        db.close()
+
+
+def start_job_workers(dbPath, numWorkers=None, pollInterval=0.5):
+    # runs the worker pool in a daemon thread (e.g. once per GUI server), and returns (thread, stopEvent)
+    stopEvent = threading.Event()
+    thread = threading.Thread(target=run_job_workers, args=(dbPath, numWorkers, pollInterval, stopEvent), daemon=True,
+                              name='ewh_job_workers')
+    thread.start()
+
+    return thread, stopEvent
+
+
+def _claim_job(db):
+    # oldest queued job, marked as running by this worker pool (the transaction keeps other pools from claiming it)
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute("SELECT id, params, dataset, options FROM jobs WHERE status = 'queued' ORDER BY submitted LIMIT 1").fetchone()
+        if row is not None:
+            db.execute("UPDATE jobs SET status = 'running', started = ?, worker = ? WHERE id = ?", (time.time(), os.getpid(), row['id']))
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+
+    return row
+
+
+def _requeue_orphan_jobs(db):
+    # running jobs of worker pools that are no longer alive
+    for row in db.execute("SELECT id, worker FROM jobs WHERE status IN ('running', 'cancelling')").fetchall():
+        if not _process_alive(row['worker']):
+            db.execute("UPDATE jobs SET status = CASE status WHEN 'running' THEN 'queued' ELSE 'cancelled' END, started = NULL, "
+                       "worker = NULL WHERE id = ?", (row['id'],))
+
+
+def _process_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='EWH Flex optimization job workers')
+    parser.add_argument('--db', default='./output/jobs.sqlite', help='job queue file')
+    parser.add_argument('--workers', type=int, default=None, help='concurrent optimizations (default: number of cores)')
+    parser.add_argument('--pollInterval', type=float, default=0.5)
+    args = parser.parse_args(argv)
+
+    try:
+        run_job_workers(args.db, numWorkers=args.workers, pollInterval=args.pollInterval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
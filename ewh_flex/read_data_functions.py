@@ -3,9 +3,10 @@
 ##############################################
 
 import pandas as pd
+import numpy as np
+import io
 import json
-import sys
-from .dataspace_connection import dataspace_connection
+import os
 
 
 def read_data(paramsInput_filePath, dataset_filePath):
@@ -14,33 +15,98 @@ def read_data(paramsInput_filePath, dataset_filePath):
         paramsInput = json.load(json_data)
 
     if paramsInput['load_diagram_exists'] == 1:
+        # read load diagram (JSON, CSV, Parquet or Feather)
+        dataset = read_load_diagram(dataset_filePath)
+
+        ## verify minute resolution and missing data
+        dataset = verify_1min_resolution(dataset)
+    else:
+        # read input water usage calendar
+        dataset = read_usage_calendar(dataset_filePath)
+
+    return dataset, paramsInput
+
+
+##############################################
+##          Columnar Input Files            ##
+##############################################
+# Parquet/Feather files are read through pandas (pyarrow), with typed columns and only the requested ones
+def read_load_diagram(dataset_filePath, columns=None):
+    ## load diagram (timestamp, load) from a JSON, CSV, Parquet or Feather file.
+    ## columns selects the timestamp and load columns of a file with more columns
+    if _columnar_format(dataset_filePath) is not None:
+        dataset = read_columnar(dataset_filePath, columns=columns)
+    else:
         try:
             # read load diagram JSON
             dataset = pd.read_json(dataset_filePath, convert_dates=False)
         except:
             # read load diagram CSV
             dataset = pd.read_csv(dataset_filePath)
-        # rename the two column
-        dataset.columns = ['timestamp', 'load']
-        # convert to datetime
-        dataset['timestamp'] = pd.to_datetime(dataset['timestamp'], dayfirst=True, utc=True)
+        if columns is not None:
+            dataset = dataset[list(columns)]
+    # rename the two column
+    dataset.columns = ['timestamp', 'load']
+    # convert to datetime
+    dataset['timestamp'] = _utc_timestamps(dataset['timestamp'])
 
-        ## verify minute resolution and missing data
-        dataset = verify_1min_resolution(dataset)
-    else:
-        # read input water usage calendar
+    return dataset
+
+
+def read_usage_calendar(dataset_filePath, columns=None):
+    ## water usage calendar (start, duration) from a JSON, Parquet or Feather file
+    if _columnar_format(dataset_filePath) is None:
         with open(dataset_filePath) as json_data:
-            dataset = json.load(json_data)
+            return json.load(json_data)
+    dataset = read_columnar(dataset_filePath, columns=columns)
+    dataset.columns = ['start', 'duration']
 
-    ## verify if the data is larger than 1 month (43200 minutes)
-    try:
-        len(dataset) < 43500
-    except:
-        print("The file contains data with more than 30 days.\n")
-        sys.exit(1)
+    return dataset
 
 
-    return dataset, paramsInput
+def read_price_curve(filePath, columns=None):
+    ## dynamic price curve (timestamp, price) from a JSON, CSV, Parquet or Feather file, indexed by timestamp
+    ## (paramsInput['ewh_specs']['price_dynamic'], for tariff 3)
+    if _columnar_format(filePath) is not None:
+        price_dynamic = read_columnar(filePath, columns=columns)
+    else:
+        if os.path.splitext(filePath)[1].lower() == '.json':
+            price_dynamic = pd.read_json(filePath, convert_dates=False)
+        else:
+            price_dynamic = pd.read_csv(filePath)
+        if columns is not None:
+            price_dynamic = price_dynamic[list(columns)]
+    price_dynamic.columns = ['timestamp', 'price']
+    price_dynamic['timestamp'] = _utc_timestamps(price_dynamic['timestamp'])
+
+    return price_dynamic.set_index('timestamp', drop=False)
+
+
+def read_columnar(filePath, columns=None):
+    ## reads a Parquet/Feather file (only the given columns)
+    _format = _columnar_format(filePath)
+    if _format == 'parquet':
+        return pd.read_parquet(filePath, columns=None if columns is None else list(columns))
+    if _format == 'feather':
+        return pd.read_feather(filePath, columns=None if columns is None else list(columns))
+    raise ValueError('Unknown columnar file ' + str(filePath) + ', please use a .parquet or .feather file.')
+
+
+def _columnar_format(filePath):
+    # columnar format from the file extension (None for JSON/CSV)
+    _extension = os.path.splitext(str(filePath))[1].lower()
+    if _extension in ['.parquet', '.pq']:
+        return 'parquet'
+    if _extension in ['.feather', '.arrow']:
+        return 'feather'
+    return None
+
+
+def _utc_timestamps(timestamps):
+    # typed timestamps are kept (naive ones as UTC), text is parsed day first
+    if pd.api.types.is_datetime64_any_dtype(timestamps):
+        return pd.to_datetime(timestamps, utc=True)
+    return pd.to_datetime(timestamps, dayfirst=True, utc=True)
 
 
 def gui_data(guiBackpack):
@@ -50,30 +116,25 @@ def gui_data(guiBackpack):
 
     if (inputType == 'Data Space'):
         endpoint = guiBackpack['endpoint']
-        # request data from DataSpace
-        response = dataspace_connection(guiBackpack)
-        # parse data depending on endpoint
-        dataset = data_space_parser(response, endpoint)
+        # the Data Space client (tsg_client, dotenv) is only imported when it is used
+        from .dataspace_connection import dataspace_fetch, default_dataspace_client
+        # request data from DataSpace (day by day, in parallel), parsed depending on endpoint
+        user_id = guiBackpack['user_id']
+        datasets, errors = dataspace_fetch(default_dataspace_client(), [user_id], guiBackpack['datetime_start'],
+                                           guiBackpack['datetime_end'], endpoint=endpoint)
+        if user_id in errors:
+            raise RuntimeError(f'Cannot fetch the load diagram from the Data Space ({errors[user_id]}), please try again.')
+        dataset = datasets[user_id]
         ## verify minute resolution and missing data
         dataset = verify_1min_resolution(dataset)
 
     elif (inputType == 'Upload JSON/CSV'):
-        if guiBackpack['file_type'] == 'json':
-            dataset = pd.read_json(guiBackpack['dataset'], convert_dates=False)
-        else:
-            dataset = pd.read_csv(guiBackpack['dataset'])
-        # rename the two column
-        dataset.columns = ['timestamp', 'load']
-        # convert to datetime
-        dataset['timestamp'] = pd.to_datetime(dataset['timestamp'], dayfirst=True, utc=True)
+        # the GUI sends the upload already parsed (cached by content), the file is parsed here otherwise
+        dataset = guiBackpack['dataset']
+        if not isinstance(dataset, pd.DataFrame):
+            dataset = parse_upload(dataset.getvalue(), guiBackpack['file_type'], ['timestamp', 'load'], dayfirst=True)
         ## verify minute resolution and missing data
         dataset = verify_1min_resolution(dataset)
-        ## verify if the data is larger than 1 month (43200 minutes)
-        try:
-            len(dataset) < 43500
-        except:
-            print("The file contains data with more than 30 days.\n")
-            sys.exit(1)
     else:
         dataset = pd.DataFrame({'start': [], 'duration': []})
         for row in range(guiBackpack['num_rows']):
@@ -104,22 +165,36 @@ def gui_data(guiBackpack):
 
     if (pricing_choice == "Upload pricing diagram"):
         price_dynamic = guiBackpack['price_dynamic']
-        if price_dynamic.type == 'application/json':
-            price_dynamic = pd.read_json(price_dynamic, convert_dates=False)
-        else:
-            price_dynamic = pd.read_csv(price_dynamic)
-            # rename the two column
-        price_dynamic.columns = ['timestamp', 'price']
-        try:
-            price_dynamic['timestamp'] = pd.to_datetime(price_dynamic['timestamp'], utc=True)
-        except:
-            price_dynamic['timestamp'] = pd.to_datetime(price_dynamic['timestamp'], dayfirst=True, utc=True)
+        if not isinstance(price_dynamic, pd.DataFrame):
+            fileType = 'json' if price_dynamic.type == 'application/json' else 'csv'
+            price_dynamic = parse_upload(price_dynamic.getvalue(), fileType, ['timestamp', 'price'], dayfirst=None)
 
         paramsInput['ewh_specs']['price_dynamic'] = price_dynamic
 
     return dataset, paramsInput
 
 
+def parse_upload(content, fileType, columns, dayfirst=True):
+    # uploaded JSON/CSV file (bytes) -> DataFrame with the given column names and UTC timestamps
+    # dayfirst=None tries ISO timestamps first (price diagrams), and day-first dates if they don't parse
+    if fileType == 'json':
+        df = pd.read_json(io.BytesIO(content), convert_dates=False)
+    else:
+        df = pd.read_csv(io.BytesIO(content))
+    # rename the two column
+    df.columns = columns
+    # convert to datetime
+    if dayfirst is None:
+        try:
+            df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
+        except (ValueError, TypeError):
+            df['timestamp'] = pd.to_datetime(df['timestamp'], dayfirst=True, utc=True)
+    else:
+        df['timestamp'] = pd.to_datetime(df['timestamp'], dayfirst=dayfirst, utc=True)
+
+    return df
+
+
 
 def verify_1min_resolution(dataset):
     ## creates template from start and finish timestamps with minute resolution
@@ -133,21 +208,10 @@ def verify_1min_resolution(dataset):
     _start = df['timestamp'].iloc[0].strftime('%Y-%m-%d')
     # extract end date
     _end = df['timestamp'].iloc[-1].strftime('%Y-%m-%d 23:59')
-    # create full length template, with 1-min res.
-    _template = pd.DataFrame(pd.date_range(_start, _end, freq='min', tz='UTC'), columns=['timestamp'])
-    # resample the original dataset to 1-min
-    df = df.resample('1min', on='timestamp').sum().reset_index()
-    # merge to the template
-    df = _template.merge(df, how='left', left_on='timestamp', right_on='timestamp').fillna(0)
+    # full length template with 1-min res., merged with the original dataset resampled to 1-min
+    df = _minute_template(df, _start, _end)
     # find average working value for fixing high values
-    # delete observations with zero/ low values (<250W)
-    _df = df.loc[df['load'] > 250]
-    # calculate load threshold (1.25 times higher than the median)
-    _threshold = 1.25*_df['load'].median()
-    # delete observations where load is over threshold
-    _df = _df.loc[df['load'] < _threshold]
-    # estimated load is the median of the selected observations
-    _median_load = _df['load'].median()
+    _median_load = _median_load_value(df['load'])
     # update threshold
     _threshold = 1.25 * _median_load
     # find the high values
@@ -155,59 +219,256 @@ def verify_1min_resolution(dataset):
 
     # if there is outliers
     if len(_outliers) > 0:
-
-        # for loop for finding aggregated values from missing measurements
         # with a missing value, the following should appear with the sum
-        # of both. This loop finds the high value, and fix the attribution
-        for idx_out in _outliers.index:
-            # if it is the first value, replace immediately
-            if idx_out == 0:
-                df.loc[idx_out, 'load'] = _median_load
+        # of both. This step finds the high values, and fixes their attribution
+        df['load'] = _repair_outliers(df['load'], _outliers.index.to_numpy(), _median_load)
+
+    return df
+
+
+def _minute_template(df, start, end):
+    # creates full length template, with 1-min res., from start to end (inclusive)
+    _template = pd.DataFrame(pd.date_range(start, end, freq='min', tz='UTC'), columns=['timestamp'])
+    # period without readings
+    if len(df) == 0:
+        return _template.assign(load=0.0)
+    # resample the original dataset to 1-min
+    df = df.resample('1min', on='timestamp').sum().reset_index()
+    # merge to the template
+    return _template.merge(df, how='left', left_on='timestamp', right_on='timestamp').fillna(0)
+
+
+def _median_load_value(load):
+    # delete observations with zero/ low values (<250W)
+    _load = load.loc[load > 250]
+    # calculate load threshold (1.25 times higher than the median)
+    _threshold = 1.25*_load.median()
+    # delete observations where load is over threshold
+    _load = _load.loc[_load < _threshold]
+    # estimated load is the median of the selected observations
+    return _load.median()
+
+
+def _repair_outliers(load, idx_out, median_load):
+    ## redistributes each outlier through the block of zeros right before it.
+    ## a repair only writes on its own zero block, so all blocks can be measured
+    ## on the original series and every redistribution applied at once
+
+    _load = load.to_numpy(dtype=float)
+    _outliers = _load[idx_out]
+    # position of the last non-zero observation up to each instance (-1 if none)
+    _last_nonzero = np.maximum.accumulate(np.where(_load != 0, np.arange(len(_load)), -1))
+    _previous = np.where(idx_out > 0, _last_nonzero[np.maximum(idx_out - 1, 0)], -1)
+    # length of the zeros block right before each outlier
+    _block = idx_out - 1 - _previous
+
+    # calculate the ratio between the outlier and the median
+    # the ratio should cover at least 2 observations
+    _ratio = np.maximum(np.round(_outliers / median_load), 2).astype(np.int64)
+    # calculate the new load value
+    _new_load = np.round(_outliers / _ratio)
+
+    # if there is no zero before (or it is the first value), just replace by the median
+    _first = idx_out.copy()
+    _value = np.full(len(idx_out), median_load)
+    # if block length the same or bigger than ratio, fill the last observations of the block
+    _fill_ratio = (idx_out > 0) & (_block >= _ratio)
+    _first[_fill_ratio] = (idx_out - _ratio + 1)[_fill_ratio]
+    # if the block is shorter, fill the whole block
+    _fill_block = (idx_out > 0) & (_block > 0) & (_block < _ratio)
+    _first[_fill_block] = (idx_out - _block)[_fill_block]
+    _value[_fill_ratio | _fill_block] = _new_load[_fill_ratio | _fill_block]
+    # a shorter block reaching the start of the series is left untouched
+    _keep = _fill_block & (_previous < 0)
+
+    # apply all redistributions in bulk
+    _first, _last, _value = _first[~_keep], idx_out[~_keep], _value[~_keep]
+    _length = _last - _first + 1
+    _offset = np.arange(_length.sum()) - np.repeat(np.cumsum(_length) - _length, _length)
+    _load[np.repeat(_first, _length) + _offset] = np.repeat(_value, _length)
+
+    # keep integer loads as integers when the repair allows it
+    if np.issubdtype(load.dtype, np.integer) and np.array_equal(_load, np.round(_load)):
+        return pd.Series(_load.astype(load.dtype), index=load.index)
+    return pd.Series(_load, index=load.index)
+
+
+##############################################
+##        Chunked Load Diagram Ingest       ##
+##############################################
+def read_load_chunks(dataset_filePath, chunkDays=7, readRows=100000, columns=None):
+    ## reads a load diagram file (CSV, JSON lines or array of records, Parquet or Feather) readRows at a time, and yields it
+    ## in periods of chunkDays (periodStart, periodEnd, rows), so long histories (e.g. a year of 1-min readings) are never
+    ## fully in memory. the file must be sorted by timestamp
+
+    _extension = os.path.splitext(dataset_filePath)[1].lower()
+    if _columnar_format(dataset_filePath) == 'parquet':
+        import pyarrow.parquet as pq
+        reader = (batch.to_pandas() for batch in pq.ParquetFile(dataset_filePath).iter_batches(batch_size=readRows, columns=columns))
+    elif _columnar_format(dataset_filePath) == 'feather':
+        reader = _feather_batches(dataset_filePath)
+    elif _extension in ['.jsonl', '.ndjson']:
+        reader = pd.read_json(dataset_filePath, lines=True, convert_dates=False, chunksize=readRows)
+    elif _extension == '.json':
+        reader = _json_record_batches(dataset_filePath, readRows)
+    else:
+        reader = pd.read_csv(dataset_filePath, chunksize=readRows, usecols=columns)
+
+    period = pd.Timedelta(days=chunkDays)
+    periodStart = None
+    pending = []
+    for rows in reader:
+        if len(rows) == 0:
+            continue
+        # timestamp and load columns, in this order
+        if columns is not None:
+            rows = rows[list(columns)]
+        # rename the two column
+        rows.columns = ['timestamp', 'load']
+        # convert to datetime
+        rows['timestamp'] = _utc_timestamps(rows['timestamp'])
+        # periods start at midnight of the first day
+        if periodStart is None:
+            periodStart = rows['timestamp'].min().floor('D')
+        if (rows['timestamp'] < periodStart).any():
+            raise ValueError('The load diagram is not sorted by timestamp, please sort it before the chunked reading.')
+        # yield every period that ends inside these rows (periods without readings are yielded empty)
+        while (rows['timestamp'] >= periodStart + period).any():
+            _inside = rows['timestamp'] < periodStart + period
+            pending.append(rows.loc[_inside])
+            rows = rows.loc[~_inside]
+            yield periodStart, periodStart + period, pd.concat(pending, ignore_index=True)
+            pending = []
+            periodStart = periodStart + period
+        pending.append(rows)
+
+    if periodStart is None:
+        raise ValueError('The load diagram is empty, please check the file.')
+    # the last period ends with the last day
+    rows = pd.concat(pending, ignore_index=True)
+    yield periodStart, rows['timestamp'].max().floor('D') + pd.Timedelta(days=1), rows
+
+
+def _feather_batches(filePath):
+    # record batches of a Feather (Arrow IPC) file, memory mapped and converted one at a time
+    import pyarrow as pa
+    with pa.memory_map(str(filePath)) as source:
+        reader = pa.ipc.open_file(source)
+        for k in range(reader.num_record_batches):
+            yield reader.get_batch(k).to_pandas()
+
+
+def _json_record_batches(filePath, readRows, readSize=1 << 20):
+    # readRows records at a time of a JSON array of records ([{"timestamp": ..., "load": ...}, ...]), decoded as the
+    # file is read (readSize characters at a time)
+    decoder = json.JSONDecoder()
+    records = []
+    with open(filePath) as json_data:
+        buffer = json_data.read(readSize).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError('Only JSON arrays of records can be read in chunks, please convert ' + str(filePath) +
+                             ' to records or to JSON lines (.jsonl).')
+        position = 1
+        while True:
+            # skip the separators up to the next record
+            while (position < len(buffer)) and (buffer[position] in ' \t\r\n,'):
+                position += 1
+            if (position < len(buffer)) and (buffer[position] == ']'):
+                break
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the record goes on in the next part of the file
+                more = json_data.read(readSize)
+                if more == '':
+                    raise
+                buffer = buffer[position:] + more
+                position = 0
                 continue
+            records.append(record)
+            position = end
+            if len(records) == readRows:
+                yield pd.DataFrame(records)
+                records = []
+    if len(records) > 0:
+        yield pd.DataFrame(records)
 
-            # calculate the ratio between the outlier and the median
-            _ratio = round(_outliers.loc[idx_out]/_median_load)
-            # the ratio should cover at least 2 observations
-            if _ratio < 2:
-                _ratio = 2
-            # calculate the new load value
-            _new_load = round(_outliers.loc[idx_out] / _ratio)
-            # start the empty block
-            _block = 0
-            # reverse loop starting from the previous value to find zeros blocks
-            for i_all in reversed(range(0, idx_out)):
-                # if there is no zero before, just replace and go to next outlier
-                if (df.loc[i_all, 'load'] != 0) & (_block == 0):
-                    df.loc[idx_out, 'load'] = _median_load
-                    break
-                # else start counting zeros
-                if df.loc[i_all, 'load'] == 0:
-                    _block += 1
-                    # if block length the same or bigger than ratio, fill and continue
-                    if _block >= _ratio:
-                        df.loc[(idx_out - _ratio + 1):idx_out, 'load'] = _new_load
-                        break
-                    continue
-                # block end detection
-                if (df.loc[i_all, 'load'] != 0) & (_block != 0):
-                    # if zero block size is >= _ratio, replace all block by median
-                    if _block >= _ratio:
-                        df.loc[(idx_out - _ratio + 1):idx_out, 'load'] = _new_load
-                    else:
-                        df.loc[(idx_out - _block):idx_out, 'load'] = _new_load
-                    # close block
-                    _block = 0
-                    break
 
-    return df
+def load_statistics(chunks, binWidth=1):
+    ## median working load (for fixing high values) of a chunked load diagram, and the count of its 1-min loads over 250W
+    ## (for the EWH power detection, without the high values). the 1-min loads are counted in bins of binWidth W (the
+    ## lower bound of each bin), so the memory does not grow with the length of the load diagram; with loads in whole W,
+    ## both are the same as verify_1min_resolution
+    _counts = pd.Series(dtype=np.int64)
+    for periodStart, periodEnd, rows in chunks:
+        _load = rows.resample('1min', on='timestamp')['load'].sum()
+        _load = _load.loc[_load > 250]
+        _bins = pd.Series(np.floor(_load.to_numpy(dtype=float) / binWidth) * binWidth).value_counts()
+        _counts = _counts.add(_bins, fill_value=0)
+    _counts = _counts.sort_index().astype(np.int64)
+    if len(_counts) == 0:
+        return np.nan, _counts
+
+    # same steps as _median_load_value, on the counts
+    _median_load = _counts_median(_counts.loc[_counts.index < 1.25 * _counts_median(_counts)])
+    _counts = _counts.loc[_counts.index <= 1.25 * _median_load]
+
+    return _median_load, _counts
+
+
+def _counts_median(counts):
+    # median of the values counted in counts (value: count, sorted by value)
+    if len(counts) == 0:
+        return np.nan
+    _values = counts.index.to_numpy(dtype=float)
+    _cumulative = np.cumsum(counts.to_numpy())
+    # the two middle values (the same one, for an odd number of values)
+    _middle = np.searchsorted(_cumulative, [(_cumulative[-1] - 1) // 2, _cumulative[-1] // 2], side='right')
+    return (_values[_middle[0]] + _values[_middle[1]]) / 2
+
+
+def verify_1min_resolution_chunks(chunks, medianLoad, maxCarryDays=7):
+    ## verify_1min_resolution over the chunks of read_load_chunks, with the median load of load_statistics.
+    ## the zeros after the last reading of a chunk are carried over to the next one (up to maxCarryDays),
+    ## since a high value right after them is redistributed through them. yields the verified rows
+    _threshold = 1.25 * medianLoad
+    _max_carry = int(maxCarryDays * 1440)
+    carry = None
+    for periodStart, periodEnd, rows in chunks:
+        # full length template of the period, with 1-min res.
+        df = _minute_template(rows, periodStart, periodEnd - pd.Timedelta(minutes=1))
+        _carried = 0
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+            _carried = len(carry)
+        # fix the high values of this period (the carried rows were already checked)
+        _outliers = np.flatnonzero(df['load'].to_numpy() > _threshold)
+        _outliers = _outliers[_outliers >= _carried]
+        if len(_outliers) > 0:
+            df['load'] = _repair_outliers(df['load'], _outliers, medianLoad)
+
+        # carry over the last non-zero observation and the zeros after it
+        _nonzero = np.flatnonzero(df['load'].to_numpy() != 0)
+        _split = max(_nonzero[-1] if len(_nonzero) > 0 else 0, len(df) - _max_carry)
+        carry = df.iloc[_split:].reset_index(drop=True)
+        if _split > 0:
+            yield df.iloc[:_split].reset_index(drop=True)
+
+    if carry is not None:
+        yield carry
+
 
 def data_space_parser(response, endpoint):
+    data = response.json()["data"]
+    # periods without readings (e.g. a day of a chunked fetch)
+    if len(data) == 0:
+        return pd.DataFrame({'timestamp': pd.Series(dtype='datetime64[ns, UTC]'), 'load': pd.Series(dtype=float)})
     # convert to dataframe
-    df = pd.DataFrame(response.json()["data"])
+    df = pd.DataFrame(data)
     # convert to datetime
     df['datetime'] = pd.to_datetime(df['datetime'], utc=True)
     # make all seconds 0, for duplicate detection
-    df['datetime'] = df['datetime'].apply(lambda t: t.replace(second=0))
+    df['datetime'] = df['datetime'] - pd.to_timedelta(df['datetime'].dt.second, unit='s')
     # remove duplicates
     df = df.drop_duplicates(subset='datetime', keep="last")
     # retain only necessary columns
@@ -2,19 +2,21 @@
 ##            Results Functions             ##
 ##############################################
 
-import matplotlib.pyplot as plt
-from matplotlib.lines import Line2D
-from matplotlib.patches import Patch
 import json
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
+import os
+import numpy as np
+import pandas as pd
 
-from .auxiliary_functions import create_empty_nested_dict
+from .auxiliary_functions import create_empty_nested_dict, run_length_encode
 
 ##############################################
 ##              Plot Results                ##
 ##############################################
 def plot_results(opt_output, plotOption='w', writePath = './output/results.png'):
+    # matplotlib is only imported when plotting
+    import matplotlib.pyplot as plt
+    from matplotlib.lines import Line2D
+    from matplotlib.patches import Patch
 
     # unpack some variables
     opt_diagrams = opt_output['opt_diagrams']
@@ -87,17 +89,18 @@ def plot_results(opt_output, plotOption='w', writePath = './output/results.png')
     if plotOption == 'w': plt.savefig(writePath)
     if plotOption == 'p': plt.show()
 
-def plot_results_plotly(opt_output, plotOption='w', writePath='./output/results.png'):
+def plot_results_plotly(opt_output, plotOption='w', writePath='./output/results.png', maxPoints=5000):
+            ## line traces longer than maxPoints are downsampled (largest triangle three buckets, keeps the peaks and valleys),
+            ## and the usage/heating/flexibility blocks are found at once and added as a single list of shapes
+            # plotly is only imported when plotting
+            from plotly.subplots import make_subplots
+            import plotly.graph_objects as go
 
             opt_diagrams = opt_output['opt_diagrams']
-            opt_diagrams['tempSet'] = opt_output['tempSet']
-            tempSet = opt_diagrams['tempSet']
-            original_load = opt_diagrams['original_load']
-            optimized_load = opt_diagrams['optimized_load']
+            tempSet = opt_output['tempSet']
+            timestamps = opt_diagrams['timestamp']
             original_load_kwh = opt_output['original_load']
             optimized_load_kwh = opt_output['optimized_load']
-            opt_diagrams['old_index'] = opt_diagrams.index
-            opt_diagrams = opt_diagrams.set_index('timestamp')
 
             fig = make_subplots(rows=3, cols=1,
                                 subplot_titles=("EWH Water Temperature & Usage", "EWH Optimized Energy Consumption",
@@ -111,25 +114,30 @@ def plot_results_plotly(opt_output, plotOption='w', writePath='./output/results.
             fig.update_yaxes(title_text='Load (W)', row=2, col=1, title_font=dict(size=10))
             fig.update_yaxes(title_text='Load (W)', row=3, col=1, title_font=dict(size=10))
 
-            fig.add_trace(go.Scatter(name='User-Defined Hot Water Confort Temperature', x=opt_diagrams.index, y=tempSet,
+            # the comfort temperature is constant, so only the first and last points are needed
+            fig.add_trace(go.Scatter(name='User-Defined Hot Water Confort Temperature', x=timestamps.iloc[[0, -1]], y=[tempSet, tempSet],
                                      mode='lines', line_width=3, line_dash="dash", line_color="limegreen",
                                      opacity=0.75), row=1, col=1)
+            _idx = _lttb(opt_diagrams['temp'], maxPoints)
             fig.add_trace(
-                go.Scatter(name='EWH Water Temperature', x=opt_diagrams.index, y=opt_diagrams.temp, mode='lines',
+                go.Scatter(name='EWH Water Temperature', x=timestamps.iloc[_idx], y=opt_diagrams['temp'].iloc[_idx], mode='lines',
                            line_color='royalblue'), row=1, col=1)
-            fig.add_trace(go.Scatter(name='EWH Optimized Energy Consumption', x=opt_diagrams.index, y=optimized_load,
+            _idx = _lttb(opt_diagrams['optimized_load'], maxPoints)
+            fig.add_trace(go.Scatter(name='EWH Optimized Energy Consumption', x=timestamps.iloc[_idx], y=opt_diagrams['optimized_load'].iloc[_idx],
                                      mode='lines', line_color='darkorange'), row=2, col=1)
+            _idx = _lttb(opt_diagrams['original_load'], maxPoints)
             fig.add_trace(
-                go.Scatter(name='EWH Original Energy Consumption', x=opt_diagrams.index, y=original_load, mode='lines',
+                go.Scatter(name='EWH Original Energy Consumption', x=timestamps.iloc[_idx], y=opt_diagrams['original_load'].iloc[_idx], mode='lines',
                            line_color='goldenrod'), row=3, col=1)
 
-            fig.add_trace(go.Bar(name='Detected Hot Water Usage', x=opt_diagrams.index, y=tempSet, marker_color='red',
+            # legend entries of the blocks (without data)
+            fig.add_trace(go.Bar(name='Detected Hot Water Usage', x=[None], y=[None], marker_color='red',
                                  opacity=0.6), row=3, col=1)
             fig.add_trace(
-                go.Bar(name='Optmized EWH ON Status', x=opt_diagrams.index, y=tempSet, marker_color='lightskyblue',
+                go.Bar(name='Optmized EWH ON Status', x=[None], y=[None], marker_color='lightskyblue',
                        opacity=0.5), row=3, col=1)
             fig.add_trace(
-                go.Bar(name='Flexibility Available', x=opt_diagrams.index, y=tempSet, marker_color='palegreen',
+                go.Bar(name='Flexibility Available', x=[None], y=[None], marker_color='palegreen',
                        opacity=0.5), row=3, col=1)
 
             fig.update_layout(title_text='Original Load = ' + "{:.2f}".format(
@@ -138,135 +146,128 @@ def plot_results_plotly(opt_output, plotOption='w', writePath='./output/results.
             fig.update_xaxes(showgrid=True)
             fig.update_yaxes(showgrid=True)
 
-            block_red = 0
-            block_blue = 0
-            block_green = 0
-            for i in opt_diagrams.index:
-                # auxiliary index
-                j = opt_diagrams.loc[i, 'old_index']
-                if (opt_diagrams.loc[i, 'delta_in'] == 1) & (block_blue == 0):
-                    block_blue = 1
-                    start_blue = opt_diagrams.index[j]
-                if (opt_diagrams.loc[i, 'delta_in'] == 0) & (block_blue == 1):
-                    end_blue = opt_diagrams.index[j]
-                    block_blue = 0
-                    fig.add_vrect(x0=start_blue, x1=end_blue,
-                                  fillcolor='lightskyblue', opacity=0.3,
-                                  layer="below", line_width=1, line_color='lightskyblue',
-                                  row=1, col=1)
-                    fig.add_vrect(x0=start_blue, x1=end_blue,
-                                  fillcolor='lightskyblue', opacity=0.3,
-                                  layer="below", line_width=1, line_color='lightskyblue',
-                                  row=2, col=1)
-                if (opt_diagrams.loc[i, 'delta_use'] == 1) & (block_red == 0):
-                    block_red = 1
-                    start_red = opt_diagrams.index[j]
-                if (opt_diagrams.loc[i, 'delta_use'] == 0) & (block_red == 1):
-                    end_red = opt_diagrams.index[j]
-                    block_red = 0
-                    fig.add_vrect(x0=start_red, x1=end_red,
-                                  fillcolor='red', opacity=0.6,
-                                  layer="below", line_width=1, line_color='red')
-                if (opt_diagrams.loc[i, 'delta_in'] == 0) & (block_green == 0):
-                    block_green = 1
-                    start_green = opt_diagrams.index[j]
-                if ((opt_diagrams.loc[i, 'delta_in'] == 1) & (block_green == 1)):
-                    end_green = opt_diagrams.index[j - 1]
-                    block_green = 0
-                    fig.add_vrect(x0=start_green, x1=end_green,
-                                  fillcolor='palegreen', opacity=0.2,
-                                  layer="below", line_width=1, line_color='palegreen',
-                                  row=2, col=1)
-                if ((i == opt_diagrams.index[-1]) & (opt_diagrams.loc[i, 'delta_in'] == 0)):
-                    end_green = opt_diagrams.index[j]
-                    block_green = 0
-                    fig.add_vrect(x0=start_green, x1=end_green,
-                                  fillcolor='palegreen', opacity=0.2,
-                                  layer="below", line_width=1, line_color='palegreen',
-                                  row=2, col=1)
+            # EWH ON blocks (from the first ON to the next OFF), on the temperature and optimized load plots
+            delta_in = opt_diagrams['delta_in'].to_numpy(dtype=float)
+            _starts, _ends = _block_edges(delta_in, 1, 0)
+            shapes = _block_shapes(timestamps, _starts, _ends, 'lightskyblue', 0.3, ['', '2'])
+            # hot water usage blocks, on all plots
+            _starts, _ends = _block_edges(opt_diagrams['delta_use'].to_numpy(dtype=float), 1, 0)
+            shapes += _block_shapes(timestamps, _starts, _ends, 'red', 0.6, ['', '2', '3'])
+            # flexibility blocks (from the first OFF to the step before the next ON), on the optimized load plot
+            _starts, _ends = _block_edges(delta_in, 0, 1)
+            _ends = _ends - 1
+            # the last block is closed at the end, if it ends OFF
+            if (len(_starts) > len(_ends)) & (delta_in[-1] == 0):
+                _ends = np.r_[_ends, len(delta_in) - 1]
+            shapes += _block_shapes(timestamps, _starts, _ends, 'palegreen', 0.2, ['2'])
+            fig.update_layout(shapes=shapes)
 
             if plotOption == 'w': fig.write_image(writePath, width=1920, height=1080)
             return fig
 
 
+def _block_edges(values, on, off):
+    # first and last positions of the blocks that start at an on value and end at the next off value
+    # (other values, e.g. a partial delta_in or NaN, keep the block as it is). a block without end is left out of the ends
+    _positions = np.flatnonzero((values == on) | (values == off))
+    _on = values[_positions] == on
+    _was_on = np.r_[False, _on[:-1]]
+    return _positions[_on & ~_was_on], _positions[~_on & _was_on]
+
+
+def _block_shapes(timestamps, starts, ends, color, opacity, axes):
+    # rectangles (full height) of the closed blocks, on the subplots of the given axes ('' for the first, '2' for the second...)
+    _x0 = timestamps.iloc[starts[:len(ends)]].tolist()
+    _x1 = timestamps.iloc[ends].tolist()
+    return [dict(type='rect', xref='x' + _axis, yref='y' + _axis + ' domain', x0=_start, x1=_end, y0=0, y1=1, fillcolor=color,
+                 opacity=opacity, layer='below', line=dict(width=1, color=color))
+            for _axis in axes for _start, _end in zip(_x0, _x1)]
+
+
+def _lttb(values, maxPoints):
+    # positions of maxPoints samples of a series (on a regular time step) that keep its shape, through the largest triangle
+    # three buckets algorithm: the first and last points, and the point of each bucket that makes the largest triangle
+    # with the point chosen in the previous bucket and the average of the next bucket
+    y = np.asarray(values, dtype=float)
+    n = len(y)
+    if (maxPoints is None) or (n <= maxPoints) or (maxPoints < 3):
+        return np.arange(n)
+    x = np.arange(n, dtype=float)
+    # buckets of the points between the first and the last one, and the average of each bucket (NaN are left out)
+    _edges = np.linspace(1, n - 1, maxPoints - 1).astype(np.int64)
+    _valid = ~np.isnan(y)
+    _count = np.add.reduceat(_valid.astype(float), _edges[:-1])
+    _avg_x = np.add.reduceat(np.where(_valid, x, 0), _edges[:-1]) / np.maximum(_count, 1)
+    _avg_y = np.add.reduceat(np.where(_valid, y, 0), _edges[:-1]) / np.maximum(_count, 1)
+    # the bucket after the last one is the last point
+    _avg_x = np.r_[_avg_x[1:], x[-1]]
+    _avg_y = np.r_[_avg_y[1:], y[-1]]
+
+    idx = np.empty(maxPoints, dtype=np.int64)
+    idx[0] = 0
+    idx[-1] = n - 1
+    a = 0
+    for k in range(maxPoints - 2):
+        _lo, _hi = _edges[k], _edges[k + 1]
+        _area = np.abs((x[a] - _avg_x[k]) * (y[_lo:_hi] - y[a]) - (x[a] - x[_lo:_hi]) * (_avg_y[k] - y[a]))
+        a = _lo + int(np.argmax(np.nan_to_num(_area, nan=-1)))
+        idx[k + 1] = a
+
+    return idx
+
+
 
 ##############################################
 ##             Export Results               ##
 ##############################################
-def write_results(opt_output, writePath="./output/results.json"):
+def write_results(opt_output, writePath="./output/results.json", calendarFormat='records'):
 
-    # organize data to be exported
-    opt_diagrams = opt_output['opt_diagrams']
-    user = opt_output['user']
-    simulation_period_start = opt_diagrams['timestamp'].astype(str)[0]
-    simulation_period_end = opt_diagrams['timestamp'].astype(str)[opt_diagrams.index[-1]]
-    days_in_simulation = opt_output['simulated_period']
-    original_energy = round(opt_output['original_load'],4)
-    optimized_energy = round(opt_output['optimized_load'],4)
-    avg_daily_energy = round(opt_output['avg_daily_consumption'],4)
-    total_flexibility = opt_output['total_flexibility']
-    perc_flexibility = round(opt_output['perc_flexibility'],2)
-    avg_daily_flexibility = round(opt_output['avg_daily_flexibility'],0)
-    original_price = round(opt_output['original_price'],2)
-    optimized_price = round(opt_output['optimized_price'],2)
-    savings_cost = round(opt_output['savings_cost'],2)
-    savings_energy = round(opt_output['savings_energy'],4)
-    original_usage_profile = opt_diagrams[['timestamp','delta_use']].copy()
-    original_usage_profile['timestamp'] = original_usage_profile['timestamp'].astype(str)
-    original_usage_profile = original_usage_profile.rename(columns={"delta_use": "hot_water_usage"})
-    original_usage_profile = original_usage_profile.to_dict('records')
-    optimized_calendar = opt_diagrams[['timestamp','delta_in']].copy()
-    optimized_calendar['timestamp'] = optimized_calendar['timestamp'].astype(str)
-    optimized_calendar = optimized_calendar.rename(columns={"delta_in": "ewh_on"})
-    optimized_calendar = optimized_calendar.to_dict('records')
-
-
-    # list of variables to fill in results dictionary
-    list_of_keys = ['user', 'simulation_period', 'original_energy', 'optimized_energy', 'original_price',
-                    'optimized_price', 'avg_daily_energy', 'total_flexibility', 'perc_flexibility',
-                    'avg_daily_flexibility', 'savings_cost', 'savings_energy', 'original_usage_profile',
-                    'optimized_calendar']
-
-    # create empty nested dictionary
-    results = create_empty_nested_dict(list_of_keys)
-    # fill dictionary
-    results['user'] = user
-    results['simulation_period']['start'] = simulation_period_start
-    results['simulation_period']['end'] = simulation_period_end
-    results['simulation_period']['days_in_simulation'] = days_in_simulation
-    results['original_energy']['value'] = original_energy
-    results['original_energy']['unit'] = 'kWh'
-    results['optimized_energy']['value'] = optimized_energy
-    results['optimized_energy']['unit'] = 'kWh'
-    results['original_price']['value'] = original_price
-    results['original_price']['unit'] = 'Euro'
-    results['optimized_price']['value'] = optimized_price
-    results['optimized_price']['unit'] = 'Euro'
-    results['avg_daily_energy']['value'] = avg_daily_energy
-    results['avg_daily_energy']['unit'] = 'kWh'
-    results['total_flexibility']['value'] = total_flexibility
-    results['total_flexibility']['unit'] = 'minutes'
-    results['perc_flexibility']['value'] = perc_flexibility
-    results['perc_flexibility']['unit'] = 'Percent'
-    results['avg_daily_flexibility']['value'] = avg_daily_flexibility
-    results['avg_daily_flexibility']['unit'] = 'kWh'
-    results['savings_cost']['value'] = savings_cost
-    results['savings_cost']['unit'] = 'Euro'
-    results['savings_energy']['value'] = savings_energy
-    results['savings_energy']['unit'] = 'kWh'
-    results['original_usage_profile'] = original_usage_profile
-    results['optimized_calendar'] = optimized_calendar
+    # same results as return_results, written to a JSON file
+    results = return_results(opt_output, calendarFormat=calendarFormat)
 
     with open(writePath, "w") as outfile:
         json.dump(results, outfile)
 
-def return_results(opt_output):
+
+def write_results_columnar(opt_output, writePath="./output/results.parquet"):
+    ## opt_diagrams as a Parquet/Feather table (from the file extension), with typed columns and timestamps,
+    ## and the KPI block as a one row table next to it (e.g. results_kpis.parquet). returns both paths
+    _root, _extension = os.path.splitext(writePath)
+    kpisPath = _root + '_kpis' + _extension
+    _format = _extension.lower()
+    if _format not in ['.parquet', '.pq', '.feather', '.arrow']:
+        raise ValueError('Unknown columnar file ' + str(writePath) + ', please use a .parquet or .feather file.')
+
+    opt_diagrams = opt_output['opt_diagrams'].reset_index(drop=True)
+    # scalar outputs (user, simulated period, prices, loads, flexibility and savings) and the simulated period
+    kpis = {key: [value] for key, value in opt_output.items() if not isinstance(value, (dict, list, pd.DataFrame))}
+    kpis['simulation_period_start'] = [opt_diagrams['timestamp'].iloc[0]]
+    kpis['simulation_period_end'] = [opt_diagrams['timestamp'].iloc[-1]]
+    kpis = pd.DataFrame(kpis)
+
+    if _format in ['.parquet', '.pq']:
+        opt_diagrams.to_parquet(writePath, index=False)
+        kpis.to_parquet(kpisPath, index=False)
+    else:
+        opt_diagrams.to_feather(writePath)
+        kpis.to_feather(kpisPath)
+
+    return writePath, kpisPath
+
+def return_results(opt_output, calendarFormat='records'):
+    ## the usage profile and the optimized calendar are returned either as one {timestamp, value} record per time step
+    ## (calendarFormat='records'), or as the intervals of equal consecutive values {start, end, value}, with the end
+    ## excluded (calendarFormat='intervals'), which is much smaller for long periods
+    if calendarFormat not in ['records', 'intervals']:
+        raise ValueError('Unknown calendar format ' + str(calendarFormat) + ", please use 'records' or 'intervals'.")
 
     # organize data to be exported
     opt_diagrams = opt_output['opt_diagrams']
     user = opt_output['user']
-    simulation_period_start = opt_diagrams['timestamp'].astype(str)[0]
-    simulation_period_end = opt_diagrams['timestamp'].astype(str)[opt_diagrams.index[-1]]
+    # timestamps are converted to text only once, for both diagrams
+    timestamps = _timestamp_strings(opt_diagrams['timestamp'])
+    simulation_period_start = timestamps[0]
+    simulation_period_end = timestamps[-1]
     days_in_simulation = opt_output['simulated_period']
     original_energy = round(opt_output['original_load'],4)
     optimized_energy = round(opt_output['optimized_load'],4)
@@ -278,14 +279,11 @@ def return_results(opt_output):
     optimized_price = round(opt_output['optimized_price'],2)
     savings_cost = round(opt_output['savings_cost'],2)
     savings_energy = round(opt_output['savings_energy'],4)
-    original_usage_profile = opt_diagrams[['timestamp','delta_use']].copy()
-    original_usage_profile['timestamp'] = original_usage_profile['timestamp'].astype(str)
-    original_usage_profile = original_usage_profile.rename(columns={"delta_use": "hot_water_usage"})
-    original_usage_profile = original_usage_profile.to_dict('records')
-    optimized_calendar = opt_diagrams[['timestamp','delta_in']].copy()
-    optimized_calendar['timestamp'] = optimized_calendar['timestamp'].astype(str)
-    optimized_calendar = optimized_calendar.rename(columns={"delta_in": "ewh_on"})
-    optimized_calendar = optimized_calendar.to_dict('records')
+    if calendarFormat == 'intervals':
+        # end of the last interval (one time step after the last timestamp)
+        timestamps += _timestamp_strings(opt_diagrams['timestamp'].iloc[-1:] + pd.Timedelta(minutes=opt_output['time_resolution']))
+    original_usage_profile = _calendar_results(timestamps, opt_diagrams['delta_use'], 'hot_water_usage', calendarFormat)
+    optimized_calendar = _calendar_results(timestamps, opt_diagrams['delta_in'], 'ewh_on', calendarFormat)
 
 
     # list of variables to fill in results dictionary
@@ -325,3 +323,23 @@ def return_results(opt_output):
     results['optimized_calendar'] = optimized_calendar
 
     return results
+
+
+def _calendar_results(timestamps, values, name, calendarFormat):
+    # diagram as a list of records (per time step) or of intervals (per block of equal values)
+    if calendarFormat == 'records':
+        return [{'timestamp': _timestamp, name: _value} for _timestamp, _value in zip(timestamps, values.tolist())]
+    _starts, _ends, _values = run_length_encode(values.to_numpy())
+    return [{'start': timestamps[_start], 'end': timestamps[_end + 1], name: _value}
+            for _start, _end, _value in zip(_starts.tolist(), _ends.tolist(), _values.tolist())]
+
+
+def _timestamp_strings(timestamps):
+    # same text as astype(str), through numpy for whole-second UTC (or naive) timestamps
+    timestamps = pd.Series(timestamps)
+    _tz = timestamps.dt.tz
+    _values = (timestamps if _tz is None else timestamps.dt.tz_localize(None)).to_numpy(dtype='datetime64[ns]')
+    if ((_tz is not None) & (str(_tz) != 'UTC')) | (_values.astype(np.int64) % 10**9 != 0).any() | np.isnat(_values).any():
+        return timestamps.astype(str).tolist()
+    _suffix = '' if _tz is None else '+00:00'
+    return [_timestamp.replace('T', ' ') + _suffix for _timestamp in np.datetime_as_string(_values, unit='s').tolist()]
@@ -1,6 +1,7 @@
 from ewh_flex import read_data
 from ewh_flex import ewh_optimization
 from ewh_flex import (plot_results_plotly, write_results)
+import shutil
 
 ##############################################
 ##            Read Input Data               ##
@@ -22,9 +23,11 @@ dataset, paramsInput = read_data(paramsInput_filePath, dataset_filePath)
 ##              Optimization                ##
 ##############################################
 
-# Select Solver between 'HiGHS' (recommended) and 'CBC'. HiGHS solver requires 'solverPath' to respective binaries
+# Select Solver between 'HiGHS' (recommended) and 'CBC'. HiGHS runs with the binaries in 'solverPath' if given,
+# otherwise in-process with highspy (if installed, or with highs in the system PATH). The bundled binaries are only
+# given if they can be executed
 # Select resample between 'no','15m','1h'
-opt_output = ewh_optimization(paramsInput, dataset, resample='no', optSolver='HiGHS', solverPath=r'../HiGHS/bin/highs.exe')
+opt_output = ewh_optimization(paramsInput, dataset, resample='no', optSolver='HiGHS', solverPath=shutil.which(r'../HiGHS/bin/highs.exe'))
 
 
 
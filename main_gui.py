@@ -1,11 +1,14 @@
-from ewh_flex import ewh_optimization
+from ewh_flex import start_job_workers, submit_job, job_status, job_result, cancel_job, delete_job
 from ewh_flex import plot_results_plotly
 from ewh_flex import return_results
 from ewh_flex import gui_data
+from ewh_flex import parse_upload
 from ewh_flex import is_valid_time_format
 import streamlit as st
 import datetime
 import json
+import shutil
+import time
 
 
 
@@ -40,6 +43,24 @@ if "disabled" not in st.session_state:
     st.session_state.disabled = False
 
 
+# optimization jobs of all the GUI sessions, run by a single pool of workers (one optimization per core)
+JOB_QUEUE_PATH = './output/gui_jobs.sqlite'
+
+
+@st.cache_resource
+def job_workers():
+    return start_job_workers(JOB_QUEUE_PATH)
+
+
+job_workers()
+
+
+# uploads are parsed once, and cached by file content (reruns and new runs with the same file skip the parsing)
+@st.cache_data(show_spinner=False, max_entries=8)
+def cached_upload(content, fileType, columns, dayfirst):
+    return parse_upload(content, fileType, columns, dayfirst=dayfirst)
+
+
 # request EWH Specifications
 ewh_capacity = st.number_input('EWH Capacity (liters)', value=100)
 if ((ewh_capacity >= 30) & (ewh_capacity <= 300)) == False:
@@ -257,74 +278,122 @@ if submit_button:
     if (inputType == 'Upload JSON/CSV'):
         if dataset is None:
             st.error(f"Please upload the dataset!")
+            st.session_state.disabled = False
             st.stop()
 
-    with st.spinner('Running Optimization... Please Wait!'):
-
+    with st.spinner('Preparing Data... Please Wait!'):
 
         ##############################################
         ##             Prepare Data                 ##
         ##############################################
 
-        dataset, paramsInput = gui_data(guiBackpack)
+        if (inputType == 'Upload JSON/CSV'):
+            guiBackpack['dataset'] = cached_upload(dataset.getvalue(), guiBackpack['file_type'], ['timestamp', 'load'], True)
+        if (pricing_choice == "Upload pricing diagram"):
+            if price_dynamic is not None:
+                _fileType = 'json' if price_dynamic.type == 'application/json' else 'csv'
+                guiBackpack['price_dynamic'] = cached_upload(price_dynamic.getvalue(), _fileType, ['timestamp', 'price'], None)
 
+        dataset, paramsInput = gui_data(guiBackpack)
 
-        ##############################################
-        ##              Optimization                ##
-        ##############################################
+    ##############################################
+    ##              Optimization                ##
+    ##############################################
+
+    # the optimization is queued for the worker pool, so the page keeps responding (progress and cancel)
+    # Select Solver between 'HiGHS' (recommended) and 'CBC'. HiGHS runs with the binaries in 'solverPath' if given,
+    # otherwise in-process with highspy (if installed, or with highs in the system PATH). The bundled binaries are only
+    # given if they can be executed
+    # Select resample between 'no','15m','1h'
+    for _key in ['opt_output', 'fig', 'results_json', 'job_message']:
+        st.session_state.pop(_key, None)
+    st.session_state.job_id = submit_job(JOB_QUEUE_PATH, paramsInput, dataset, resample='no', optSolver='HiGHS',
+                                         solverPath=shutil.which(r'./highs/bin/highs.exe'))
+
+
+if 'job_id' in st.session_state:
+    job_id = st.session_state.job_id
+    job = job_status(JOB_QUEUE_PATH, job_id)
+    if job['status'] in ['queued', 'running', 'cancelling']:
+        if job['status'] == 'queued':
+            st.progress(0.0, text='Waiting for a free worker... (%d optimizations ahead)' % job['position'])
+        else:
+            _stage = '' if job['stage'] is None else ' (' + job['stage'] + ')'
+            st.progress(job['progress'], text='Running Optimization... Please Wait!' + _stage)
+        if st.button('Cancel', disabled=job['status'] == 'cancelling'):
+            cancel_job(JOB_QUEUE_PATH, job_id)
+        else:
+            time.sleep(0.5)
+        st.rerun()
 
-        # Select Solver between 'HiGHS' (recommended) and 'CBC'. HiGHS solver requires 'solverPath' to respective binaries
-        # Select resample between 'no','15m','1h'
-        opt_output = ewh_optimization(paramsInput, dataset, resample='no', optSolver='HiGHS', solverPath=r'./highs/bin/highs.exe')
+    if job['status'] == 'optimized':
+        opt_output = job_result(JOB_QUEUE_PATH, job_id)
 
         ##############################################
         ##              Plot Results                ##
         ##############################################
 
         ## Select plot option between showing plot ('p') or writing ('w'). If writing, fill writePath
-        fig = plot_results_plotly(opt_output, plotOption='p')
+        st.session_state.fig = plot_results_plotly(opt_output, plotOption='p')
 
         ##############################################
         ##              Return Results              ##
         ##############################################
 
-        results = return_results(opt_output)
-
-
-
-
-
-        st.success('✅ Done! Check Results Below!')
+        st.session_state.results_json = json.dumps(return_results(opt_output))
+        st.session_state.opt_output = opt_output
 
-        st.divider()
-        st.header('📊 Results')
-        st.markdown('#')
-
-        relative_savings = 100 * (opt_output['optimized_load'] - opt_output['original_load']) / opt_output['original_load']
-        col1, col2, col3 = st.columns(3)
-        col1.metric("🔌 Original Load", (('%.2f' % opt_output['original_load']) + ' kWh'))
-        col2.metric("🔌 Optimized Load", (('%.2f' % opt_output['optimized_load']) + ' kWh'),
-                    delta=(('%.2f' % relative_savings) + '%'), delta_color='inverse')
-        col3.metric("🗓️ Simulated Period", (str(opt_output['simulated_period']) + ' Days'))
-
-        _hours = '%.0f' % (opt_output['total_flexibility'] // 60)
-        _minutes = '%.0f' % (opt_output['total_flexibility'] % 60)
-        pricing_diff = opt_output['optimized_price'] - opt_output['original_price']
-        total_flex = "{}h {}m".format(_hours, _minutes)
-        col4, col5, col6 = st.columns(3)
-        col4.metric("💶 Original Pricing", (('%.2f' % opt_output['original_price']) + ' €'))
-        col5.metric("💶 Optimized Pricing", (('%.2f' % opt_output['optimized_price']) + ' €'),
-                    delta=(('%.2f' % pricing_diff) + '€'), delta_color='inverse')
-        col6.metric("📈 Total Flexibility", total_flex)
-
-        st.markdown('#')
-        st.plotly_chart(fig)
+    st.session_state.job_message = (job['status'], job['error'], job['elapsed'])
+    # the results are kept in the session, no longer in the queue
+    delete_job(JOB_QUEUE_PATH, job_id)
+    del st.session_state.job_id
+    # enables the Run button again
+    st.session_state.disabled = False
+    st.rerun()
 
-        json_string = json.dumps(results)
-        st.download_button(
-            label="📄 Download Results JSON",
-            file_name="results.json",
-            mime="application/json",
-            data=json_string,
-        )
 
+if 'job_message' in st.session_state:
+    status, error, elapsed = st.session_state.job_message
+    if status == 'optimized':
+        st.success('✅ Done in %.0f s! Check Results Below!' % elapsed)
+    elif status == 'cancelled':
+        st.warning('Optimization cancelled.')
+    else:
+        st.error('Optimization failed, please check the inputs.')
+        with st.expander('Error details'):
+            st.code(error)
+
+
+if 'opt_output' in st.session_state:
+    opt_output = st.session_state.opt_output
+
+    st.divider()
+    st.header('📊 Results')
+    st.markdown('#')
+
+    relative_savings = 100 * (opt_output['optimized_load'] - opt_output['original_load']) / opt_output['original_load']
+    col1, col2, col3 = st.columns(3)
+    col1.metric("🔌 Original Load", (('%.2f' % opt_output['original_load']) + ' kWh'))
+    col2.metric("🔌 Optimized Load", (('%.2f' % opt_output['optimized_load']) + ' kWh'),
+                delta=(('%.2f' % relative_savings) + '%'), delta_color='inverse')
+    col3.metric("🗓️ Simulated Period", (str(opt_output['simulated_period']) + ' Days'))
+
+    _hours = '%.0f' % (opt_output['total_flexibility'] // 60)
+    _minutes = '%.0f' % (opt_output['total_flexibility'] % 60)
+    pricing_diff = opt_output['optimized_price'] - opt_output['original_price']
+    total_flex = "{}h {}m".format(_hours, _minutes)
+    col4, col5, col6 = st.columns(3)
+    col4.metric("💶 Original Pricing", (('%.2f' % opt_output['original_price']) + ' €'))
+    col5.metric("💶 Optimized Pricing", (('%.2f' % opt_output['optimized_price']) + ' €'),
+                delta=(('%.2f' % pricing_diff) + '€'), delta_color='inverse')
+    col6.metric("📈 Total Flexibility", total_flex)
+
+    st.markdown('#')
+    st.plotly_chart(st.session_state.fig)
+
+    st.download_button(
+        label="📄 Download Results JSON",
+        file_name="results.json",
+        mime="application/json",
+        data=st.session_state.results_json,
+    )
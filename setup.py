@@ -6,7 +6,6 @@ PANDAS_MIN_VERSION = '2.2.2'
 PLOTLY_MIN_VERSION = '5.24.1'
 PULP_MIN_VERSION = '2.9.0'
 PYTEST_MIN_VERSION = '8.3.3'
-SCIKITLEARN_MIN_VERSION = '1.5.2'
 STREAMLIT_MIN_VERSION = '1.38.0'
 TSG_CLIENT_GIT = 'tsg-client @ git+https://github.com/CPES-Power-and-Energy-Systems/tsg-client.git'
 
@@ -31,7 +30,6 @@ setup(
         'plotly >= {0}'.format(PLOTLY_MIN_VERSION),
         'PuLP >= {0}'.format(PULP_MIN_VERSION),
         'pytest >= {0}'.format(PYTEST_MIN_VERSION),
-        'scikit-learn >= {0}'.format(SCIKITLEARN_MIN_VERSION),
         'streamlit >= {0}'.format(STREAMLIT_MIN_VERSION),
         TSG_CLIENT_GIT
     ],
@@ -1,15 +1,50 @@
 from ewh_flex import read_data
 from ewh_flex import ewh_optimization
+from ewh_flex import ewh_price_sweep_optimization
+from ewh_flex import ewh_chunked_optimization
 from ewh_flex import return_results
+from ewh_flex import read_load_diagram, verify_1min_resolution, write_results_columnar
+import importlib.util
 import json
+import pandas as pd
+import shutil
+import subprocess
+import sys
+import pytest
 
 with open(r'./tests/data/results_test.json') as json_data:
     results_test = json.load(json_data)
 
+# input parameters and data of the test household (usage calendar) and of the example one (7 days of load diagram)
+HOUSEHOLD = (r'./tests/data/input_parameters.json', r'./tests/data/input_data.json')
+HOUSEHOLD_7_DAYS = (r'./examples/data/input/input_parameters.json', r'./examples/data/input/data_example_7_days.json')
+
+requires_highspy = pytest.mark.skipif(importlib.util.find_spec('highspy') is None, reason='HiGHS python bindings (highspy) not installed')
+requires_highs_binary = pytest.mark.skipif(shutil.which('highs') is None, reason='HiGHS binary not in the system PATH')
+# HiGHS binary shipped with the repository (Windows), or highs in the system PATH
+HIGHS_BINARY = shutil.which(r'./HiGHS/bin/highs.exe') or shutil.which('highs')
+
+
+@pytest.fixture
+def household():
+    # (dataset, paramsInput) of the test household, read for each test (the pipeline updates them)
+    return read_data(*HOUSEHOLD)
+
+
+@pytest.fixture
+def household_7_days():
+    return read_data(*HOUSEHOLD_7_DAYS)
+
+
+def assert_results_test(results):
+    for _key, _value in results.items():
+        assert _value == results_test.get(_key), f'{_key}'
+
 ##############################################
 ##            Read Input Data               ##
 ##############################################
 
+@pytest.mark.skipif(HIGHS_BINARY is None, reason='HiGHS binary not found')
 def test_ewh_flex():
     # Input parameters JSON filepath
     paramsInput_filePath = r'./tests/data/input_parameters.json'
@@ -19,10 +54,606 @@ def test_ewh_flex():
     # read data
     dataset, paramsInput = read_data(paramsInput_filePath, dataset_filePath)
     # run optimization
-    opt_output = ewh_optimization(paramsInput, dataset, resample='no', optSolver='HiGHS', solverPath=r'./HiGHS/bin/highs.exe')
+    opt_output = ewh_optimization(paramsInput, dataset, resample='no', optSolver='HiGHS', solverPath=HIGHS_BINARY)
     # get results
     results = return_results(opt_output)
     for _key, _value in results.items():
         assert _value == results_test.get(_key), f'{_key}'
 
-test_ewh_flex()
\ No newline at end of file
+if HIGHS_BINARY is not None:
+    test_ewh_flex()
+
+def test_milp_matrix_matches_pulp(household, tmp_path):
+    from ewh_flex import (build_varBackpack, create_usage_dataset, real_ewh_load_estimator, update_dataset_backpack,
+                          linear_regressors, build_milp_pulp, build_milpBackpack, export_milp)
+    import gzip
+
+    dataset, paramsInput = household
+    varBackpack = build_varBackpack(paramsInput, dataset)
+    dataset = create_usage_dataset(dataset)
+    dataset['load'] = real_ewh_load_estimator(dataset, varBackpack)
+    dataset, varBackpack = update_dataset_backpack(dataset, varBackpack, 'no')
+    varBackpack = linear_regressors(dataset, varBackpack)
+
+    # both model backends must hand over the exact same model to the solver
+    export_milp(build_milp_pulp(varBackpack)[0], str(tmp_path / 'pulp.mps.gz'))
+    export_milp(build_milpBackpack(varBackpack), str(tmp_path / 'matrix.mps.gz'))
+    assert gzip.open(tmp_path / 'pulp.mps.gz').read() == gzip.open(tmp_path / 'matrix.mps.gz').read()
+
+
+@requires_highspy
+def test_ewh_flex_highspy(household):
+    dataset, paramsInput = household
+    # with highspy, the milp is solved in-process (no solver binary)
+    opt_output = ewh_optimization(paramsInput, dataset, resample='no', optSolver='HiGHS')
+    assert_results_test(return_results(opt_output))
+
+
+@requires_highs_binary
+def test_ewh_flex_highs_cmd(household):
+    dataset, paramsInput = household
+    # the HiGHS binary is used even with highspy installed (same .mps file as the expected results)
+    opt_output = ewh_optimization(paramsInput, dataset, resample='no', optSolver='HiGHS_CMD')
+    assert_results_test(return_results(opt_output))
+
+
+def test_convert_load_usage_starting_heating():
+    import numpy as np
+    from ewh_flex import convert_load_usage, usage_blanks_stats, convert_load_usage_chunks
+
+    # heating/blank blocks of 20, 101, 20, 11, 20 and 5 minutes: the first heating block has no blank before it and
+    # takes the last blank block (10 min, under 90% of the average), so it is flagged as usage, as the third one
+    load = np.concatenate([np.full(20, 2000), np.zeros(101), np.full(20, 2000), np.zeros(11), np.full(20, 2000), np.zeros(5)])
+    dataset = pd.DataFrame({'timestamp': pd.date_range('2022-12-07', periods=len(load), freq='min', tz='UTC'), 'load': load})
+    varBackpack = {'ewh_power_original': 1800, 'ewh_max_temp': 80, 'tempSet': 40}
+    usage = convert_load_usage(dataset, varBackpack).to_numpy()
+    assert usage.tolist() == [1, 1] + [0] * 150 + [1, 1] + [0] * 23
+
+    # same flags over chunks
+    chunks = lambda: (dataset.iloc[k:k + 50] for k in range(0, len(dataset), 50))
+    blanksMean, lastBlankTime = usage_blanks_stats(chunks(), varBackpack)
+    assert lastBlankTime == 10
+    chunked = np.concatenate([rows['delta_use'].to_numpy() for rows in convert_load_usage_chunks(chunks(), varBackpack, blanksMean,
+                                                                                                   lastBlankTime)])
+    assert chunked.tolist() == usage.tolist()
+
+
+@requires_highspy
+def test_ewh_fleet_optimization(household):
+    from ewh_flex import ewh_fleet_optimization, fleet_summary
+
+    dataset, paramsInput = household
+    # the second household has no usage data and must fail alone
+    households = [(dict(paramsInput, user='house_1'), dataset), (dict(paramsInput, user='house_2'), None),
+                  (dict(paramsInput, user='house_3'), dataset)]
+    fleetResults = list(ewh_fleet_optimization(households, resample='15m', maxWorkers=2, maxPending=2))
+    summary = fleet_summary(fleetResults)
+
+    assert sorted(result['user'] for result in fleetResults) == ['house_1', 'house_2', 'house_3']
+    assert summary['optimized'] == 2
+    assert summary['failed_users'] == ['house_2']
+
+
+class _WorkerExit:
+    # dataset that ends the worker process unpickling it (as a worker killed by the system)
+    def __reduce__(self):
+        import os
+        return os._exit, (1,)
+
+
+@requires_highspy
+def test_ewh_fleet_optimization_worker_exit(household):
+    from ewh_flex import ewh_fleet_optimization, fleet_summary
+
+    dataset, paramsInput = household
+    # the worker of the second household dies, and the next households are optimized in a new pool
+    households = [(dict(paramsInput, user='house_1'), dataset), (dict(paramsInput, user='house_2'), _WorkerExit()),
+                  (dict(paramsInput, user='house_3'), dataset), (dict(paramsInput, user='house_4'), dataset)]
+    fleetResults = list(ewh_fleet_optimization(households, resample='15m', solverMsg=False, maxWorkers=1, maxPending=1))
+    summary = fleet_summary(fleetResults)
+
+    assert [result['user'] for result in fleetResults] == ['house_1', 'house_2', 'house_3', 'house_4']
+    assert summary['failed_users'] == ['house_2']
+    assert 'BrokenProcessPool' in fleetResults[1]['error']
+
+
+@requires_highspy
+def test_ewh_rolling_horizon(household_7_days):
+    dataset, paramsInput = household_7_days
+    opt_output = ewh_optimization(paramsInput, dataset, resample='15m')
+    dataset, paramsInput = read_data(*HOUSEHOLD_7_DAYS)
+    rolling_output = ewh_optimization(paramsInput, dataset, resample='15m', windowDays=2, commitDays=1)
+
+    # the stitched calendar covers the whole period, at (almost) the same cost
+    assert rolling_output['opt_diagrams']['delta_in'].notna().all()
+    assert len(rolling_output['opt_diagrams']) == len(opt_output['opt_diagrams'])
+    assert rolling_output['optimized_price'] == pytest.approx(opt_output['optimized_price'], rel=0.01)
+
+
+@requires_highspy
+def test_ewh_chunked_optimization(household_7_days):
+    dataset, paramsInput = household_7_days
+    rolling_output = ewh_optimization(paramsInput, dataset, resample='15m', windowDays=2, commitDays=1)
+    # same rolling horizon, with the file read 2 days at a time
+    _, paramsInput = read_data(*HOUSEHOLD_7_DAYS)
+    chunked_output = ewh_chunked_optimization(paramsInput, HOUSEHOLD_7_DAYS[1], chunkDays=2, resample='15m', windowDays=2, commitDays=1)
+    assert chunked_output['opt_diagrams'].equals(rolling_output['opt_diagrams'])
+    assert chunked_output['optimized_price'] == rolling_output['optimized_price']
+    # without the parsed chunks kept in memory, the file is read on each pass
+    _, paramsInput = read_data(*HOUSEHOLD_7_DAYS)
+    reread_output = ewh_chunked_optimization(paramsInput, HOUSEHOLD_7_DAYS[1], chunkDays=2, resample='15m', windowDays=2, commitDays=1,
+                                             cacheRows=0)
+    assert reread_output['opt_diagrams'].equals(rolling_output['opt_diagrams'])
+
+
+@requires_highspy
+def test_ewh_chunked_optimization_stopped(household_7_days, monkeypatch):
+    import numpy as np
+    from ewh_flex import ewh_opt_functions
+
+    # the 2nd window is not solved: the remaining days are prepared at once, without more solves, and left without solution
+    solve_milp, calls = ewh_opt_functions.solve_milp, {'solve_milp': 0, 'resample_data': 0}
+
+    def failed_solve(varBackpack, **kwargs):
+        calls['solve_milp'] += 1
+        stat, opt_val, solution, milpStats = solve_milp(varBackpack, **kwargs)
+        if calls['solve_milp'] == 2:
+            return 'Not Solved', None, {name: np.full(len(values), np.nan) for name, values in solution.items()}, milpStats
+        return stat, opt_val, solution, milpStats
+
+    def counted_resample(dataset, resolution='15m', resample_data=ewh_opt_functions.resample_data):
+        calls['resample_data'] += 1
+        return resample_data(dataset, resolution=resolution)
+
+    def stitched_output(dataset, varBackpack, opt_diagrams, msg=True):
+        # indicators are left out (they need a solution for every time step)
+        return {'opt_diagrams': opt_diagrams, 'networkPrice': varBackpack['networkPrice']}
+
+    monkeypatch.setattr(ewh_opt_functions, 'solve_milp', failed_solve)
+    monkeypatch.setattr(ewh_opt_functions, 'resample_data', counted_resample)
+    monkeypatch.setattr(ewh_opt_functions, 'ewh_kpis', stitched_output)
+    dataset, paramsInput = household_7_days
+    opt_output = ewh_chunked_optimization(paramsInput, HOUSEHOLD_7_DAYS[1], chunkDays=2, resample='15m', windowDays=2, commitDays=1,
+                                          solverMsg=False)
+    assert calls == {'solve_milp': 2, 'resample_data': 3}
+    delta_in = opt_output['opt_diagrams']['delta_in']
+    assert delta_in.iloc[:96].notna().all() & delta_in.iloc[96:].isna().all()
+    assert len(delta_in) == len(opt_output['networkPrice']) == 7 * 96
+
+
+@requires_highspy
+def test_ewh_warm_start(household):
+    dataset, paramsInput = household
+    opt_output = ewh_optimization(paramsInput, dataset, resample='15m')
+    # start from the non-optimized EWH operation, and from the previous calendar
+    for warmStart in ['baseline', opt_output['opt_diagrams']]:
+        dataset, paramsInput = read_data(*HOUSEHOLD)
+        warm_output = ewh_optimization(paramsInput, dataset, resample='15m', warmStart=warmStart)
+        assert warm_output['milp_stats']['warm_start']
+        assert warm_output['optimized_price'] == pytest.approx(opt_output['optimized_price'], rel=0.015)
+
+
+@requires_highspy
+def test_ewh_price_sweep(household):
+    dataset, paramsInput = household
+    sweep_output = ewh_price_sweep_optimization(paramsInput, dataset, resample='15m')
+    assert [opt_output['price_scenario'] for opt_output in sweep_output] == ['tariff_1', 'tariff_2']
+    # same results as optimizing the household under each tariff from scratch
+    for tariff, opt_output in zip([1, 2], sweep_output):
+        dataset, paramsInput = read_data(*HOUSEHOLD)
+        paramsInput['ewh_specs']['tariff'] = tariff
+        tariff_output = ewh_optimization(paramsInput, dataset, resample='15m')
+        assert opt_output['original_price'] == pytest.approx(tariff_output['original_price'])
+        assert opt_output['optimized_price'] == pytest.approx(tariff_output['optimized_price'], rel=0.015)
+
+
+@requires_highspy
+def test_solve_milp_prices_zero_prices(household):
+    import numpy as np
+    from ewh_flex import (build_varBackpack, create_usage_dataset, real_ewh_load_estimator, update_dataset_backpack,
+                          linear_regressors, build_milp_model, solve_milp_prices, solve_milp)
+
+    dataset, paramsInput = household
+    varBackpack = build_varBackpack(paramsInput, dataset)
+    dataset = create_usage_dataset(dataset)
+    dataset['load'] = real_ewh_load_estimator(dataset, varBackpack)
+    dataset, varBackpack = update_dataset_backpack(dataset, varBackpack, '15m')
+    varBackpack = linear_regressors(dataset, varBackpack)
+
+    # free night energy drops the night delta_in entries of the matrix, and the dual tariff brings them back
+    milpModel = build_milp_model(varBackpack, msg=False)
+    dual = np.asarray(dataset.price2, dtype=float)
+    freeNight = np.where(dataset['timestamp'].dt.hour < 8, 0, dual)
+    for networkPrice in [dual, freeNight, dual]:
+        stat, opt_val, _, _ = solve_milp_prices(milpModel, networkPrice, varBackpack['tariff_dual'])
+        # the HiGHS model is the one of the (rebuilt) model arrays
+        lp = milpModel['highs'].getLp()
+        assert list(lp.a_matrix_.start_) == milpModel['milpBackpack']['a_start'].tolist()
+        assert np.asarray(lp.a_matrix_.value_) == pytest.approx(milpModel['milpBackpack']['a_value'], rel=1e-12)
+        _, scratch_val, _, _ = solve_milp(dict(varBackpack, networkPrice=networkPrice.tolist(), networkTariff=varBackpack['tariff_dual']),
+                                          msg=False)
+        assert stat == 'Optimal'
+        assert opt_val == pytest.approx(scratch_val, rel=0.015)
+
+
+@requires_highspy
+def test_columnar_io(household_7_days, tmp_path):
+    pytest.importorskip('pyarrow')
+
+    dataset, paramsInput = household_7_days
+    # same load diagram from a Parquet file with typed timestamps (and an extra column)
+    load_diagram = pd.read_json(HOUSEHOLD_7_DAYS[1], convert_dates=False)
+    load_diagram['timestamp'] = pd.to_datetime(load_diagram['timestamp'], dayfirst=True)
+    load_diagram['meter'] = 'sample_meter'
+    load_diagram.to_parquet(tmp_path / 'load.parquet', index=False)
+    assert verify_1min_resolution(read_load_diagram(str(tmp_path / 'load.parquet'), columns=['timestamp', 'load'])).equals(dataset)
+
+    opt_output = ewh_optimization(paramsInput, dataset, resample='1h')
+    diagramsPath, kpisPath = write_results_columnar(opt_output, str(tmp_path / 'results.parquet'))
+    assert pd.read_parquet(diagramsPath).equals(opt_output['opt_diagrams'])
+    assert pd.read_parquet(kpisPath)['optimized_price'].iloc[0] == opt_output['optimized_price']
+
+
+@requires_highspy
+def test_return_results_intervals(household):
+    dataset, paramsInput = household
+    opt_output = ewh_optimization(paramsInput, dataset, resample='15m')
+    records = return_results(opt_output)
+    intervals = return_results(opt_output, calendarFormat='intervals')
+    assert len(intervals['optimized_calendar']) < len(records['optimized_calendar'])
+    # each interval covers the records from its start to its end (excluded)
+    for _key, _name in [('original_usage_profile', 'hot_water_usage'), ('optimized_calendar', 'ewh_on')]:
+        _timestamps = [_row['timestamp'] for _row in records[_key]] + [intervals[_key][-1]['end']]
+        _expanded = []
+        for _interval in intervals[_key]:
+            _expanded += [_interval[_name]] * (_timestamps.index(_interval['end']) - _timestamps.index(_interval['start']))
+        assert _expanded == [_row[_name] for _row in records[_key]]
+
+
+@requires_highspy
+def test_plot_results_plotly(household):
+    pytest.importorskip('plotly')
+    from ewh_flex import plot_results_plotly
+
+    dataset, paramsInput = household
+    opt_output = ewh_optimization(paramsInput, dataset, resample='no')
+    fig = plot_results_plotly(opt_output, plotOption='none', maxPoints=500)
+    # downsampled lines keep the first and last points, and the legend entries carry no data
+    assert [len(trace.x) for trace in fig.data] == [2, 500, 500, 500, 1, 1, 1]
+    assert fig.data[1].y[0] == opt_output['opt_diagrams']['temp'].iloc[0]
+    assert fig.data[1].y[-1] == opt_output['opt_diagrams']['temp'].iloc[-1]
+    # one shape per block and subplot (hot water usage is shown on the 3 subplots)
+    delta_use = opt_output['opt_diagrams']['delta_use']
+    usage_blocks = ((delta_use == 1) & (delta_use.shift(fill_value=0) == 0)).sum()
+    assert len([shape for shape in fig.layout.shapes if shape.fillcolor == 'red']) == 3 * usage_blocks
+    assert {shape.fillcolor for shape in fig.layout.shapes} == {'lightskyblue', 'red', 'palegreen'}
+
+
+def test_import_time():
+    # a plain import only loads the package, and the solver functions don't load plotting/Data Space dependencies
+    code = ('import sys, time, json; _start = time.perf_counter(); import ewh_flex; elapsed = time.perf_counter() - _start; '
+            'heavy = ["pandas", "pulp", "matplotlib", "plotly", "tsg_client", "dotenv"]; '
+            'loaded = [m for m in heavy if m in sys.modules]; from ewh_flex import ewh_optimization; '
+            'print(json.dumps([elapsed, loaded, [m for m in heavy if m in sys.modules]]))')
+    elapsed, loaded, solver_loaded = json.loads(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout)
+    assert elapsed < 0.1
+    assert loaded == []
+    assert solver_loaded == ['pandas']
+
+
+def test_lazy_function_named_as_submodule():
+    # dataspace_connection is the function, whether its submodule was loaded through the package or not
+    code = ('import types, ewh_flex; from ewh_flex import read_load_diagram, dataspace_fetch; '
+            'import ewh_flex.dataspace_connection; print(isinstance(ewh_flex.dataspace_connection, types.FunctionType))')
+    assert subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.split() == ['True']
+    from ewh_flex import dataspace_connection
+    assert callable(dataspace_connection) & (dataspace_connection.__name__ == 'dataspace_connection')
+
+
+@requires_highspy
+def test_ewh_diagnostics(household, capsys):
+    dataset, paramsInput = household
+    hook_output = []
+    opt_output = ewh_optimization(paramsInput, dataset, resample='15m', solverMsg=False, traceMemory=True, diagnosticsHook=hook_output.append)
+    diagnostics = opt_output['diagnostics']
+    assert hook_output == [diagnostics]
+    for stage in ['create_usage_dataset', 'real_ewh_load_estimator', 'linear_regressors', 'build_model', 'solve', 'results']:
+        assert diagnostics['stages'][stage]['time'] >= 0
+        assert diagnostics['stages'][stage]['peak_memory'] > 0
+    assert diagnostics['model']['num_binary'] > 0
+    assert diagnostics['solver']['status'] == 'Optimal'
+    assert diagnostics['solver']['nodes'] >= 0
+    # solverMsg=False keeps the solver log and the results summary out of stdout
+    assert capsys.readouterr().out == ''
+
+
+def test_diagnostics_stage_nested_peaks():
+    import numpy as np
+    import tracemalloc
+    from ewh_flex.auxiliary_functions import diagnostics_stage
+
+    # a nested stage does not hide the peak of the stage around it (tracemalloc has one peak for the process)
+    diagnostics = {'stages': {}}
+    tracemalloc.start()
+    try:
+        with diagnostics_stage(diagnostics, 'outer'):
+            outer = np.ones(1000000)
+            del outer
+            with diagnostics_stage(diagnostics, 'inner'):
+                inner = np.ones(100000)
+                del inner
+    finally:
+        tracemalloc.stop()
+    assert 8000000 <= diagnostics['stages']['outer']['peak_memory'] < 9000000
+    assert 800000 <= diagnostics['stages']['inner']['peak_memory'] < 900000
+
+
+@requires_highspy
+def test_optimization_job(household):
+    import time
+    from ewh_flex import start_optimization_job, poll_optimization_job, cancel_optimization_job
+
+    dataset, paramsInput = household
+    job = start_optimization_job(paramsInput, dataset, resample='15m', optSolver='HiGHS', solverMsg=False)
+    stages = []
+    while poll_optimization_job(job) == 'running':
+        stages.append(job['stage'])
+        time.sleep(0.05)
+    assert job['status'] == 'optimized', job['error']
+    assert job['progress'] == 1.0
+    assert job['opt_output']['optimized_price'] == ewh_optimization(paramsInput, dataset, resample='15m', solverMsg=False)['optimized_price']
+
+    # a cancelled job stops its process
+    job = start_optimization_job(paramsInput, dataset, resample='no', optSolver='HiGHS', solverMsg=False)
+    assert cancel_optimization_job(job) == 'cancelled'
+    assert not job['process'].is_alive()
+    assert poll_optimization_job(job) == 'cancelled'
+
+    # a job cancelled while solving stops without waiting for the solver (7 days at 1 min take ~30 s to solve)
+    dataset, paramsInput = read_data(*HOUSEHOLD_7_DAYS)
+    job = start_optimization_job(paramsInput, dataset, resample='no', optSolver='HiGHS', solverMsg=False)
+    while (poll_optimization_job(job) == 'running') & (job['stage'] != 'solve'):
+        time.sleep(0.05)
+    assert job['stage'] == 'solve'
+    time.sleep(1)
+    _start = time.perf_counter()
+    assert cancel_optimization_job(job) == 'cancelled'
+    assert time.perf_counter() - _start < 10
+    assert not job['process'].is_alive()
+
+    # without waiting, the job process is only signalled, and reaped by a later poll
+    job = start_optimization_job(paramsInput, dataset, resample='no', optSolver='HiGHS', solverMsg=False)
+    while (poll_optimization_job(job) == 'running') & (job['stage'] != 'solve'):
+        time.sleep(0.05)
+    _start = time.perf_counter()
+    assert cancel_optimization_job(job, wait=False) == 'cancelling'
+    assert time.perf_counter() - _start < 0.5
+    while poll_optimization_job(job) == 'cancelling':
+        time.sleep(0.05)
+    assert job['status'] == 'cancelled'
+    assert time.perf_counter() - _start < 10
+    assert not job['process'].is_alive()
+
+
+@requires_highspy
+def test_job_queue(household, tmp_path):
+    import time
+    from ewh_flex import submit_job, job_status, job_result, cancel_job, start_job_workers
+
+    dbPath = str(tmp_path / 'jobs.sqlite')
+    dataset, paramsInput = household
+    # jobs are queued until a worker pool runs them
+    jobs = [submit_job(dbPath, paramsInput, dataset, resample='15m', solverMsg=False) for _ in range(3)]
+    failedJob = submit_job(dbPath, paramsInput, None, resample='15m')
+    cancelledJob = submit_job(dbPath, paramsInput, dataset, resample='15m')
+    assert job_status(dbPath, jobs[2])['position'] == 2
+    cancel_job(dbPath, cancelledJob)
+
+    thread, stopEvent = start_job_workers(dbPath, numWorkers=2, pollInterval=0.05)
+    try:
+        for jobId in jobs + [failedJob]:
+            while job_status(dbPath, jobId)['status'] in ['queued', 'running']:
+                time.sleep(0.05)
+    finally:
+        stopEvent.set()
+        thread.join()
+
+    optimizedPrice = ewh_optimization(paramsInput, dataset, resample='15m', solverMsg=False)['optimized_price']
+    for jobId in jobs:
+        assert job_status(dbPath, jobId)['status'] == 'optimized'
+        assert job_result(dbPath, jobId)['optimized_price'] == optimizedPrice
+    assert job_status(dbPath, failedJob)['status'] == 'failed'
+    assert job_status(dbPath, cancelledJob)['status'] == 'cancelled'
+    assert job_result(dbPath, cancelledJob) is None
+
+
+@requires_highspy
+def test_job_queue_cancel_solving(household, tmp_path):
+    import time
+    from ewh_flex import submit_job, job_status, cancel_job, start_job_workers
+
+    dbPath = str(tmp_path / 'jobs.sqlite')
+    thread, stopEvent = start_job_workers(dbPath, numWorkers=2, pollInterval=0.05)
+    try:
+        # a long job is cancelled while solving (7 days at 1 min take ~30 s to solve), and the other job runs meanwhile
+        longDataset, longParams = read_data(*HOUSEHOLD_7_DAYS)
+        longJob = submit_job(dbPath, longParams, longDataset, resample='no', solverMsg=False)
+        while (job_status(dbPath, longJob)['status'] in ['queued', 'running']) & (job_status(dbPath, longJob)['stage'] != 'solve'):
+            time.sleep(0.05)
+        assert job_status(dbPath, longJob)['stage'] == 'solve'
+        dataset, paramsInput = household
+        shortJob = submit_job(dbPath, paramsInput, dataset, resample='15m', solverMsg=False)
+        _start = time.perf_counter()
+        cancel_job(dbPath, longJob)
+        while job_status(dbPath, longJob)['status'] != 'cancelled':
+            assert job_status(dbPath, longJob)['status'] == 'cancelling'
+            time.sleep(0.05)
+        assert time.perf_counter() - _start < 10
+        while job_status(dbPath, shortJob)['status'] in ['queued', 'running']:
+            time.sleep(0.05)
+        assert job_status(dbPath, shortJob)['status'] == 'optimized'
+    finally:
+        stopEvent.set()
+        thread.join()
+
+
+@requires_highspy
+def test_ewh_optimization_async(household):
+    import asyncio
+    from ewh_flex import ewh_optimization_async
+
+    dataset, paramsInput = household
+    opt_output = ewh_optimization(paramsInput, dataset.copy(), resample='15m', solverMsg=False)
+
+    async def optimize():
+        # two concurrent calls, solved one at a time
+        solveSemaphore = asyncio.Semaphore(1)
+        return await asyncio.gather(*[ewh_optimization_async(paramsInput, dataset.copy(), resample='15m', solverMsg=False,
+                                                             solveSemaphore=solveSemaphore) for _ in range(2)])
+
+    for async_output in asyncio.run(optimize()):
+        pd.testing.assert_frame_equal(async_output['opt_diagrams'], opt_output['opt_diagrams'])
+        assert async_output['optimized_price'] == opt_output['optimized_price']
+
+    # the solver is stopped on timeout
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(ewh_optimization_async(paramsInput, dataset.copy(), resample='no', solverMsg=False, timeout=0.5))
+
+
+def _stub_dataspace(metering):
+    # local stub connector (self-description, OpenAPI specs, and metering(params, headers) -> (status code, body)),
+    # and a Data Space client of it, through a stub of the TSG controller
+    import http.server
+    import threading
+    import types
+    import urllib.error
+    import urllib.parse
+    import urllib.request
+    from ewh_flex import dataspace_client
+
+    paths = []
+
+    class StubConnector(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            paths.append(url.path)
+            if url.path == '/selfdescription':
+                status, body = 200, {'agent': 'urn:stub:data-app'}
+            elif url.path == '/openapi':
+                status, body = 200, [{'agent': 'urn:stub:data-app'}]
+            else:
+                status, body = metering(dict(urllib.parse.parse_qsl(url.query)), self.headers)
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubConnector)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    accessUrl = f'http://127.0.0.1:{server.server_port}'
+
+    def get(url, headers={}):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            return error.code, None
+
+    class StubController:
+        # same calls as the TSG controller, as plain HTTP requests
+        def get_connector_selfdescription(self, access_url, connector_id, agent_id):
+            return get(access_url + '/selfdescription')[1]
+
+        def get_openapi_specs(self, self_description, api_version):
+            return get(accessUrl + '/openapi')[1]
+
+        def openapi_request(self, headers, external_access_url, data_app_agent_id, api_version, endpoint, params, method):
+            status_code, body = get(external_access_url + endpoint + '?' + urllib.parse.urlencode(params), headers)
+            return types.SimpleNamespace(status_code=status_code, json=lambda: body)
+
+    client = dataspace_client(config={'TOKEN': 'stub_token'}, ttl=3600, controller=StubController())
+    externalConnector = {'CONNECTOR_ID': 'urn:stub:connector', 'ACCESS_URL': accessUrl, 'AGENT_ID': 'urn:stub:agent'}
+
+    return server, client, externalConnector, paths
+
+
+def test_dataspace_client():
+    import datetime
+    from ewh_flex import dataspace_request
+
+    server, client, externalConnector, paths = _stub_dataspace(
+        lambda params, headers: (200, {'params': params, 'authorization': headers['Authorization']}))
+    try:
+        # the specs are fetched once for many households
+        start, end = datetime.date(2022, 12, 7), datetime.date(2022, 12, 13)
+        responses = [dataspace_request(client, shelly_id, start, end, externalConnector=externalConnector)
+                     for shelly_id in ['shelly_1', 'shelly_2', 'shelly_3']]
+        assert [response.status_code for response in responses] == [200, 200, 200]
+        assert [response.json()['params']['shelly_id'] for response in responses] == ['shelly_1', 'shelly_2', 'shelly_3']
+        assert responses[0].json()['authorization'] == 'Token stub_token'
+        assert paths.count('/selfdescription') == 1
+        assert paths.count('/openapi') == 1
+
+        # expired specs are fetched again
+        client['ttl'] = 0
+        dataspace_request(client, 'shelly_1', start, end, externalConnector=externalConnector)
+        assert paths.count('/selfdescription') == 2
+    finally:
+        server.shutdown()
+
+
+def test_dataspace_fetch():
+    import datetime
+    import threading
+    import time
+    from ewh_flex import dataspace_request, dataspace_fetch
+    from ewh_flex.read_data_functions import data_space_parser
+
+    # 1-min readings (plus a repeated one every 10 minutes) of the requested days, with the first request of some
+    # days failing, and an unknown meter
+    lock = threading.Lock()
+    requested, active = [], [0, 0]
+
+    def metering(params, headers):
+        with lock:
+            requested.append((params['shelly_id'], params['start_date']))
+            active[0] += 1
+            active[1] = max(active)
+        time.sleep(0.01)
+        with lock:
+            active[0] -= 1
+        if params['shelly_id'] == 'unknown':
+            return 404, None
+        if (params['start_date'][8:10] in ['08', '10']) & (requested.count((params['shelly_id'], params['start_date'])) == 1):
+            return 500, None
+        minutes = pd.date_range(params['start_date'], params['end_date'], freq='min', tz='UTC')
+        readings = [{'datetime': t.isoformat(), 'value': float(t.day * 1440 + t.hour * 60 + t.minute)} for t in minutes]
+        readings += [{'datetime': (t + pd.Timedelta(seconds=30)).isoformat(), 'value': -1.0} for t in minutes[::10]]
+        return 200, {'data': sorted(readings, key=lambda reading: reading['datetime'])}
+
+    server, client, externalConnector, paths = _stub_dataspace(metering)
+    try:
+        start, end = datetime.date(2022, 12, 7), datetime.date(2022, 12, 11)
+        datasets, errors = dataspace_fetch(client, ['shelly_1', 'shelly_2', 'unknown'], start, end,
+                                           externalConnector=externalConnector, maxWorkers=3, retries=2, backoff=0.01)
+        # same load diagram as a single request of the whole period
+        dataset = data_space_parser(dataspace_request(client, 'shelly_1', start, end, externalConnector=externalConnector, msg=False),
+                                    'sentinel')
+    finally:
+        server.shutdown()
+
+    assert sorted(datasets) == ['shelly_1', 'shelly_2']
+    assert list(errors) == ['unknown']
+    assert len(datasets['shelly_1']) == 5 * 1440
+    pd.testing.assert_frame_equal(datasets['shelly_1'], dataset.reset_index(drop=True), check_dtype=False)
+    pd.testing.assert_frame_equal(datasets['shelly_2'], datasets['shelly_1'])
+    # chunks of a day, at most maxWorkers requests at the same time
+    assert ('shelly_1', '2022-12-09 00:00') in requested
+    assert active[1] <= 3
+    # server errors are requested again, the unknown meter (404) only once more, with the specs fetched again
+    assert requested.count(('shelly_1', '2022-12-08 00:00')) == 2
+    assert 1 <= requested.count(('unknown', '2022-12-07 00:00')) <= 2